@@ -0,0 +1,61 @@
+import sys
+import os
+myPath = os.path.abspath(os.getcwd())
+sys.path.insert(0, myPath)
+import shutil
+import stat
+import tempfile
+
+from trubblestack.control import ControlServer, ControlUnavailable, PendingRun, request
+
+
+def _handler(request, send):
+    if request['function'] == 'test.fail':
+        raise ValueError('boom')
+    send({'status': 'accepted'})
+    send({'status': 'running'})
+    send({'status': 'done', 'ret': (request['function'], request['args'])})
+
+
+class TestControl():
+
+    def setup_method(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'control.sock')
+        self.server = ControlServer(self.path, _handler, max_clients=2)
+        assert self.server.start()
+
+    def teardown_method(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def test_permissions(self):
+        assert stat.S_IMODE(os.stat(self.path).st_mode) == 0o600
+
+    def test_request(self):
+        replies = list(request(self.path, {'function': 'test.ping', 'args': ['a']}))
+        assert [reply['status'] for reply in replies] == ['accepted', 'running', 'done']
+        # Replies keep their python types
+        assert replies[-1]['ret'] == ('test.ping', [u'a'])
+
+    def test_handler_error(self):
+        replies = list(request(self.path, {'function': 'test.fail'}))
+        assert replies[-1]['status'] == 'error'
+        assert 'boom' in replies[-1]['error']
+
+    def test_no_daemon(self):
+        self.server.stop()
+        assert not os.path.exists(self.path)
+        try:
+            list(request(self.path, {'function': 'test.ping'}))
+        except ControlUnavailable:
+            pass
+        else:
+            assert False, 'expected ControlUnavailable'
+
+    def test_pending_run(self):
+        pending = PendingRun()
+        assert not pending.wait(0.01)
+        pending.finish('result')
+        assert pending.wait(0.01)
+        assert pending.result == 'result'
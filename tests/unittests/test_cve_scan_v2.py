@@ -0,0 +1,73 @@
+import sys
+import os
+myPath = os.path.abspath(os.getcwd())
+sys.path.insert(0, myPath)
+import shutil
+import tempfile
+
+import trubblestack.files.trubblestack_nova.cve_scan_v2 as cve_scan_v2
+
+CVE_DATA = [
+    {'_source': {'affectedPackage': [{'OS': 'CentOS', 'OSVersion': '7', 'operator': 'lt',
+                                      'packageName': 'krb5-libs',
+                                      'packageVersion': '1.13.2-12.el7_2'},
+                                     {'OS': 'CentOS', 'OSVersion': '6', 'operator': 'lt',
+                                      'packageName': 'krb5-libs',
+                                      'packageVersion': '1.10.3-42.el6'},
+                                     {'OS': 'CentOS', 'OSVersion': '6',
+                                      'packageName': 'krb5-server'}],
+                 'cvelist': ['CVE-2015-8631', 'CVE-2015-8630'],
+                 'cvss': {'score': 6.8},
+                 'href': 'http://lists.centos.org/pipermail/centos-announce/2016-March/021788.html',
+                 'reporter': 'CentOS Project',
+                 'title': 'Moderate krb5 Security Update'}},
+    {'_source': {'affectedPackage': [{'OS': 'CentOS', 'OSVersion': 'any', 'operator': 'le',
+                                      'packageName': 'ntp', 'packageVersion': '4.2.6p5-22.el7'}],
+                 'cvss': {'score': 5.0}}},
+]
+
+
+class TestCveScanStore():
+
+    def setup_method(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.tmpdir, 'cve.sqlite')
+        cve_scan_v2.__grains__ = {'osmajorrelease': 7, 'osrelease': '7.4.1708'}
+
+    def teardown_method(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_store_lookup(self):
+        store = cve_scan_v2._build_store(CVE_DATA, self.store_path)
+        pkgs = cve_scan_v2._get_store_vulnerabilities(store, ['krb5-libs', 'ntp', 'bash'])
+        store.close()
+        expected = cve_scan_v2._get_cve_vulnerabilities(CVE_DATA, '7.4.1708')
+        assert sorted(pkgs) == sorted(expected) == ['krb5-libs', 'ntp']
+        for name in expected:
+            assert [vars(pkg) for pkg in pkgs[name]] == [vars(pkg) for pkg in expected[name]]
+        assert pkgs['ntp'][0].title == 'No Title Given'
+        assert os.listdir(self.tmpdir) == ['cve.sqlite']
+
+    def test_open_store(self):
+        assert cve_scan_v2._open_store(60, self.store_path) is None
+        cve_scan_v2._build_store(CVE_DATA, self.store_path).close()
+        store = cve_scan_v2._open_store(60, self.store_path)
+        assert cve_scan_v2._get_store_vulnerabilities(store, ['ntp'])['ntp'][0].score == 5.0
+        store.close()
+        # Expired
+        assert cve_scan_v2._open_store(0, self.store_path) is None
+        # Built with another layout
+        store = cve_scan_v2._open_store(60, self.store_path)
+        store.execute('PRAGMA user_version = 0')
+        store.close()
+        assert cve_scan_v2._open_store(60, self.store_path) is None
+
+    def test_format_error(self):
+        data = [{'_source': {'affectedPackage': [{'OSVersion': '7', 'packageName': 'ntp'}],
+                             'cvss': {'score': 5.0}}}]
+        try:
+            cve_scan_v2._build_store(data, self.store_path)
+            assert False
+        except KeyError:
+            pass
+        assert os.listdir(self.tmpdir) == []
@@ -0,0 +1,199 @@
+import sys
+import os
+myPath = os.path.abspath(os.getcwd())
+sys.path.insert(0, myPath)
+import shutil
+import tempfile
+import threading
+import time
+
+from trubblestack.dispatch import ReturnerDispatcher
+
+
+class Sender(object):
+
+    def __init__(self, gate=None, fail=False):
+        self.sent = []
+        self.waiting = []
+        self.gate = gate
+        self.fail = fail
+
+    def __call__(self, returner, payload):
+        if self.gate is not None:
+            self.waiting.append(payload)
+            self.gate.wait(10)
+        if self.fail:
+            raise ValueError('endpoint down')
+        self.sent.append((returner, payload))
+
+
+def _wait(predicate, timeout=5):
+    end = time.time() + timeout
+    while not predicate() and time.time() < end:
+        time.sleep(0.01)
+    return predicate()
+
+
+class TestReturnerDispatcher():
+
+    def test_send(self):
+        sender = Sender()
+        dispatcher = ReturnerDispatcher(sender, workers=2)
+        dispatcher.start()
+        for i in range(10):
+            assert dispatcher.submit('splunk_nova_return.returner', {'jid': i})
+        dispatcher.stop(timeout=5)
+        assert sorted(p['jid'] for _, p in sender.sent) == list(range(10))
+        stats = dispatcher.stats()
+        assert stats['submitted'] == 10
+        assert stats['sent'] == 10
+        assert stats['queue_depth'] == 0
+        assert stats['send_seconds_total'] >= 0
+
+    def test_failures_are_counted(self):
+        dispatcher = ReturnerDispatcher(Sender(fail=True), workers=1)
+        dispatcher.start()
+        dispatcher.submit('foo.returner', {})
+        dispatcher.stop(timeout=5)
+        assert dispatcher.stats()['failed'] == 1
+
+    def test_drop_oldest(self):
+        gate = threading.Event()
+        sender = Sender(gate=gate)
+        dispatcher = ReturnerDispatcher(sender, maxsize=2, workers=1,
+                                        backpressure='drop_oldest')
+        dispatcher.start()
+        dispatcher.submit('foo.returner', {'jid': 0})
+        # wait for the sender to pick up the first item and block
+        assert _wait(lambda: dispatcher.queue.qsize() == 0)
+        for i in range(1, 5):
+            dispatcher.submit('foo.returner', {'jid': i})
+        assert dispatcher.stats()['dropped'] == 2
+        gate.set()
+        dispatcher.stop(timeout=5)
+        assert [p['jid'] for _, p in sender.sent] == [0, 3, 4]
+
+    def test_spill(self):
+        spill_dir = tempfile.mkdtemp()
+        try:
+            gate = threading.Event()
+            sender = Sender(gate=gate)
+            dispatcher = ReturnerDispatcher(sender, maxsize=2, workers=1,
+                                            backpressure='spill', spill_dir=spill_dir)
+            dispatcher.start()
+            dispatcher.submit('foo.returner', {'jid': 0})
+            assert _wait(lambda: dispatcher.queue.qsize() == 0)
+            for i in range(1, 6):
+                assert dispatcher.submit('foo.returner', {'jid': i})
+            stats = dispatcher.stats()
+            assert stats['spilled'] == 3
+            assert stats['spill_depth'] == 3
+            gate.set()
+            assert _wait(lambda: len(sender.sent) == 6)
+            dispatcher.stop(timeout=5)
+            assert sorted(p['jid'] for _, p in sender.sent) == list(range(6))
+            assert dispatcher.stats()['spill_depth'] == 0
+        finally:
+            shutil.rmtree(spill_dir)
+
+    def test_spill_survives_restart(self):
+        spill_dir = tempfile.mkdtemp()
+        try:
+            gate = threading.Event()
+            dispatcher = ReturnerDispatcher(Sender(gate=gate), maxsize=1, workers=1,
+                                            backpressure='spill', spill_dir=spill_dir)
+            dispatcher.submit('foo.returner', {'jid': 0})
+            dispatcher.submit('foo.returner', {'jid': 1})
+            assert dispatcher.stats()['spill_depth'] == 1
+
+            sender = Sender()
+            dispatcher = ReturnerDispatcher(sender, maxsize=10, workers=1,
+                                            backpressure='spill', spill_dir=spill_dir)
+            dispatcher.start()
+            dispatcher.stop(timeout=5)
+            assert sender.sent == [('foo.returner', {'jid': 1})]
+        finally:
+            shutil.rmtree(spill_dir)
+
+    def test_unspilled_kept_until_sent(self):
+        spill_dir = tempfile.mkdtemp()
+        try:
+            ReturnerDispatcher(Sender(), maxsize=1, backpressure='spill',
+                               spill_dir=spill_dir)._spill(('foo.returner', {'jid': 0}, 0, None))
+            gate = threading.Event()
+            sender = Sender(gate=gate)
+            dispatcher = ReturnerDispatcher(sender, workers=1, backpressure='spill',
+                                            spill_dir=spill_dir)
+            dispatcher.start()
+            assert _wait(lambda: sender.waiting)
+            # Being sent, but not sent yet
+            assert len(os.listdir(spill_dir)) == 1
+            assert dispatcher.stats()['spill_depth'] == 0
+            gate.set()
+            dispatcher.stop(timeout=5)
+            assert sender.sent == [('foo.returner', {'jid': 0})]
+            assert os.listdir(spill_dir) == []
+        finally:
+            shutil.rmtree(spill_dir)
+
+    def test_stop_spills_unsent(self):
+        spill_dir = tempfile.mkdtemp()
+        try:
+            gate = threading.Event()
+            sender = Sender(gate=gate)
+            dispatcher = ReturnerDispatcher(sender, workers=1, spill_dir=spill_dir)
+            dispatcher.start()
+            threads = list(dispatcher._threads)
+            dispatcher.submit('foo.returner', {'jid': 0})
+            assert _wait(lambda: sender.waiting)
+            dispatcher.submit('foo.returner', {'jid': 1})
+            dispatcher.submit('foo.returner', {'jid': 2})
+            # The sender is stuck on the first return
+            dispatcher.stop(timeout=0.1)
+            assert dispatcher.stats()['spill_depth'] == 2
+            # Once it's done, it leaves the spilled returns alone
+            gate.set()
+            for thread in threads:
+                thread.join(5)
+                assert not thread.is_alive()
+            assert sender.sent == [('foo.returner', {'jid': 0})]
+            assert dispatcher.stats()['spill_depth'] == 2
+
+            sender = Sender()
+            dispatcher = ReturnerDispatcher(sender, workers=1, spill_dir=spill_dir)
+            dispatcher.start()
+            dispatcher.stop(timeout=5)
+            assert sender.sent == [('foo.returner', {'jid': 1}), ('foo.returner', {'jid': 2})]
+            assert os.listdir(spill_dir) == []
+        finally:
+            shutil.rmtree(spill_dir)
+
+    def test_stop_with_full_spill_queue(self):
+        spill_dir = tempfile.mkdtemp()
+        try:
+            gate = threading.Event()
+            sender = Sender(gate=gate)
+            dispatcher = ReturnerDispatcher(sender, maxsize=1, workers=2,
+                                            backpressure='spill', spill_dir=spill_dir)
+            dispatcher.start()
+            threads = list(dispatcher._threads)
+            # Both senders get stuck
+            dispatcher.submit('foo.returner', {'jid': 0})
+            assert _wait(lambda: len(sender.waiting) == 1)
+            dispatcher.submit('foo.returner', {'jid': 1})
+            assert _wait(lambda: len(sender.waiting) == 2)
+            dispatcher.submit('foo.returner', {'jid': 2})
+            dispatcher.submit('foo.returner', {'jid': 3})
+            assert dispatcher.queue.full()
+            started = time.time()
+            dispatcher.stop(timeout=0.5)
+            assert time.time() - started < 5
+            assert dispatcher.stats()['spill_depth'] == 2
+            gate.set()
+            for thread in threads:
+                thread.join(5)
+                assert not thread.is_alive()
+            assert sorted(p['jid'] for _, p in sender.sent) == [0, 1]
+            assert dispatcher.stats()['spill_depth'] == 2
+        finally:
+            shutil.rmtree(spill_dir)
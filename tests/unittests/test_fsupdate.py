@@ -0,0 +1,123 @@
+import sys
+import os
+myPath = os.path.abspath(os.getcwd())
+sys.path.insert(0, myPath)
+import shutil
+import tempfile
+import threading
+import time
+
+from trubblestack.fsupdate import FileserverUpdater, current_snapshot, load_snapshot, \
+    mark_updated
+from trubblestack.metrics import MetricsRegistry
+
+
+class FakeFileserver(object):
+
+    def __init__(self):
+        self.files = {'base': {'top.nova': 'aaa', 'cis/centos-7.yaml': 'bbb'}}
+        self.updates = 0
+        self.fail = False
+        self.block = None
+
+    def update(self):
+        if self.block is not None:
+            self.block.wait()
+        if self.fail:
+            raise IOError('remote unreachable')
+        self.updates += 1
+
+    def envs(self):
+        return list(self.files)
+
+    def file_list(self, load):
+        return list(self.files[load['saltenv']])
+
+    def file_hash(self, load):
+        return {'hash_type': 'sha256', 'hsum': self.files[load['saltenv']][load['path']]}
+
+
+class FakeChannel(object):
+
+    def __init__(self):
+        self.fs = FakeFileserver()
+
+
+class FakeFileclient(object):
+
+    def __init__(self):
+        self.channel = FakeChannel()
+
+
+class TestFileserverUpdater():
+
+    def setup_method(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.fc = FakeFileclient()
+        self.registry = MetricsRegistry()
+        self.updater = FileserverUpdater(self.fc, self.cachedir, 3600,
+                                         retry_interval=60, registry=self.registry)
+
+    def teardown_method(self):
+        self.updater.stop()
+        shutil.rmtree(self.cachedir)
+
+    def test_publish(self):
+        assert self.updater.update()
+        snapshot = load_snapshot(self.cachedir)
+        assert snapshot['generation'] == 1
+        assert snapshot['files']['base']['top.nova'] == 'aaa'
+        # Unchanged content keeps its generation
+        assert self.updater.update()
+        assert load_snapshot(self.cachedir)['generation'] == 1
+        self.fc.channel.fs.files['base']['top.nova'] = 'ccc'
+        assert self.updater.update()
+        assert load_snapshot(self.cachedir)['generation'] == 2
+        assert self.registry.get('trubble_fileserver_updates_total',
+                                 {'outcome': 'ok'}) == 3
+        assert self.registry.get('trubble_fileserver_snapshot_generation') == 2
+
+    def test_current_snapshot(self):
+        mark_updated(self.cachedir)
+        assert current_snapshot(self.cachedir) is None
+        self.updater.publish()
+        assert current_snapshot(self.cachedir)['generation'] == 1
+        # The fileserver cache was updated by a process which doesn't publish
+        mark_updated(self.cachedir)
+        assert current_snapshot(self.cachedir) is None
+        assert load_snapshot(self.cachedir)['generation'] == 1
+
+    def test_failed_update_keeps_snapshot(self):
+        self.updater.update()
+        self.fc.channel.fs.fail = True
+        self.fc.channel.fs.files['base']['top.nova'] = 'ccc'
+        assert not self.updater.update()
+        assert load_snapshot(self.cachedir)['files']['base']['top.nova'] == 'aaa'
+        assert self.registry.get('trubble_fileserver_updates_total',
+                                 {'outcome': 'error'}) == 1
+
+    def test_background(self):
+        # The caller isn't held up by a slow update
+        self.fc.channel.fs.block = threading.Event()
+        started = time.time()
+        self.updater.start()
+        end = time.time() + 5
+        while not self.updater.running and time.time() < end:
+            time.sleep(0.01)
+        assert self.updater.running
+        assert time.time() - started < 1
+        assert load_snapshot(self.cachedir) is None
+        self.fc.channel.fs.block.set()
+        while load_snapshot(self.cachedir) is None and time.time() < end:
+            time.sleep(0.01)
+        assert load_snapshot(self.cachedir)['generation'] == 1
+        assert self.fc.channel.fs.updates == 1
+
+    def test_start_later(self):
+        # Startup already updated, so only publish a snapshot
+        self.updater.start(next_update=time.time() + 3600)
+        end = time.time() + 5
+        while load_snapshot(self.cachedir) is None and time.time() < end:
+            time.sleep(0.01)
+        assert load_snapshot(self.cachedir)['generation'] == 1
+        assert self.fc.channel.fs.updates == 0
@@ -0,0 +1,140 @@
+import sys
+import os
+myPath = os.path.abspath(os.getcwd())
+sys.path.insert(0, myPath)
+import shutil
+import tempfile
+import threading
+import time
+
+from trubblestack import governor
+from trubblestack.governor import ResourcePolicy, apply, setup_cgroups
+from trubblestack.jobpool import JobPool, JobRun
+
+
+def _runner(function, args, kwargs):
+    time.sleep(args[0])
+    return os.getpid()
+
+
+class TestResourcePolicy():
+
+    def setup_method(self):
+        self.loadavg = governor.loadavg
+
+    def teardown_method(self):
+        governor.loadavg = self.loadavg
+
+    def test_parse(self):
+        assert ResourcePolicy.from_data('job', {'function': 'test.ping'}) is None
+        policy = ResourcePolicy.from_data('job', {'nice': 10, 'ionice': 'best-effort:7',
+                                                  'cpu_quota': 50})
+        assert policy.nice == 10
+        assert policy.ionice == (2, 7)
+        assert policy.process_limits and policy.uses_cgroup
+        assert not ResourcePolicy('job', {'max_loadavg': 4}).process_limits
+        for data in ({'ionice': 'fast'}, {'nice': 'low'}, {'cpu_quota': 'half'}):
+            try:
+                ResourcePolicy('job', data)
+            except ValueError as exc:
+                assert 'invalid resource policy' in str(exc)
+            else:
+                assert False, 'expected ValueError for {0}'.format(data)
+
+    def test_defer(self):
+        loads = [8.0, 8.0, 1.0]
+        governor.loadavg = lambda: loads.pop(0) if loads else 1.0
+        sleeps = []
+        policy = ResourcePolicy('job', {'max_loadavg': 4})
+        policy.defer(sleep=sleeps.append)
+        assert len(sleeps) == 1
+        # Capped by max_defer
+        governor.loadavg = lambda: 8.0
+        policy = ResourcePolicy('job', {'max_loadavg': 4, 'max_defer': 0.1})
+        assert policy.defer(sleep=lambda _: time.sleep(0.02)) >= 0.1
+
+
+class TestCgroups():
+
+    def setup_method(self):
+        self.root = tempfile.mkdtemp()
+        self.base = os.path.join(self.root, 'system.slice', 'trubble.service')
+        os.makedirs(self.base)
+        for directory in (self.root, self.base):
+            with open(os.path.join(directory, 'cgroup.controllers'), 'w') as fh_:
+                fh_.write('cpuset cpu io memory pids\n')
+
+    def teardown_method(self):
+        governor.CGROUP_BASE = None
+        shutil.rmtree(self.root)
+
+    def _read(self, *path):
+        with open(os.path.join(self.base, *path)) as fh_:
+            return fh_.read()
+
+    def test_setup(self):
+        assert setup_cgroups(self.root, '/system.slice/trubble.service') == self.base
+        assert self._read('daemon', 'cgroup.procs') == str(os.getpid())
+        assert self._read('cgroup.subtree_control') == '+cpu +memory'
+        # After a restart, we already are in the leaf
+        assert setup_cgroups(self.root, '/system.slice/trubble.service/daemon') == self.base
+
+    def test_unavailable(self):
+        os.remove(os.path.join(self.root, 'cgroup.controllers'))
+        assert setup_cgroups(self.root, '/system.slice/trubble.service') is None
+        assert setup_cgroups('/nonexistent') is None
+
+    def test_apply(self):
+        setup_cgroups(self.root, '/system.slice/trubble.service')
+        policy = ResourcePolicy('audit daily', {'cpu_quota': 50, 'memory_max_mb': 256})
+        cgroup = apply(policy, pid=12345)
+        assert cgroup.path == os.path.join(self.base, 'job-audit_daily')
+        assert self._read('job-audit_daily', 'cpu.max') == '50000 100000'
+        assert self._read('job-audit_daily', 'memory.max') == str(256 * 1024 * 1024)
+        assert self._read('job-audit_daily', 'cgroup.procs') == '12345'
+        with open(os.path.join(cgroup.path, 'cpu.stat'), 'w') as fh_:
+            fh_.write('usage_usec 100\nthrottled_usec 2500000\n')
+        assert cgroup.throttled_since_created() == 2.5
+
+
+class TestPause():
+
+    def setup_method(self):
+        self.loadavg = governor.loadavg
+        self.interval = governor.LOAD_POLL_INTERVAL
+        governor.LOAD_POLL_INTERVAL = 0.05
+
+    def teardown_method(self):
+        governor.loadavg = self.loadavg
+        governor.LOAD_POLL_INTERVAL = self.interval
+
+    def test_defer_and_pause(self):
+        window = [0, time.time() + 0.5]
+        governor.loadavg = lambda: 8.0 if window[0] <= time.time() < window[1] else 1.0
+        results = []
+        done = threading.Event()
+
+        def on_complete(run, result):
+            results.append(result)
+            done.set()
+
+        pool = JobPool(_runner, lanes={'default': {'mode': 'process', 'workers': 1}},
+                       on_complete=on_complete)
+        pool.start()
+        policy = ResourcePolicy('job', {'max_loadavg': 4, 'loadavg_pause': True})
+        try:
+            # Deferred while the load is high
+            pool.submit(JobRun('job', 'test.sleep', args=[0.2], policy=policy))
+            assert done.wait(10)
+            assert results[0].ok
+            assert results[0].deferred_time >= 0.4
+            # Paused while the load is high
+            done.clear()
+            window[:] = [time.time() + 0.2, time.time() + 0.8]
+            pool.submit(JobRun('job', 'test.sleep', args=[0.4], policy=policy))
+            assert done.wait(10)
+            assert results[1].ok
+            assert results[1].deferred_time == 0.0
+            assert results[1].paused_time >= 0.3
+        finally:
+            pool.shutdown()
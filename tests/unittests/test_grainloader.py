@@ -0,0 +1,105 @@
+import sys
+import os
+myPath = os.path.abspath(os.getcwd())
+sys.path.insert(0, myPath)
+import shutil
+import tempfile
+import time
+
+import salt.loader
+
+import trubblestack.grainloader
+
+
+class Grains(object):
+
+    def __init__(self, slow=0):
+        self.slow = slow
+        self.calls = []
+
+    def funcs(self):
+        def core_os():
+            self.calls.append('core.os')
+            return {'os': 'Linux', 'fqdn': 'from-core'}
+
+        def fqdn():
+            self.calls.append('fqdn.fqdn')
+            return {'fqdn': 'host.example.com'}
+
+        def cloud():
+            self.calls.append('cloud_details.get_cloud_details')
+            time.sleep(self.slow)
+            return {'cloud_type': 'aws', 'slow': self.slow}
+
+        return {'fqdn.fqdn': fqdn,
+                'core.os': core_os,
+                'cloud_details.get_cloud_details': cloud}
+
+
+class TestGrainLoader():
+
+    def setup_method(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.opts = {'cachedir': self.cachedir, 'grains_timeout': 0.5}
+        self.grain_funcs = salt.loader.grain_funcs
+
+    def teardown_method(self):
+        salt.loader.grain_funcs = self.grain_funcs
+        # Let grains which missed their deadline finish
+        end = time.time() + 5
+        while trubblestack.grainloader._RUNNING and time.time() < end:
+            time.sleep(0.05)
+        shutil.rmtree(self.cachedir)
+
+    def _collect(self, grains):
+        salt.loader.grain_funcs = lambda opts: grains.funcs()
+        return trubblestack.grainloader.collect(self.opts)
+
+    def test_merge_order(self):
+        ret = self._collect(Grains())
+        # Core grains are merged first, like salt.loader.grains
+        assert ret['fqdn'] == 'host.example.com'
+        assert ret['os'] == 'Linux'
+        assert ret['cloud_type'] == 'aws'
+
+    def test_deadline_serves_cached_value(self):
+        self._collect(Grains(slow=0))
+        started = time.time()
+        ret = self._collect(Grains(slow=2))
+        assert time.time() - started < 1.5
+        # The slow grain serves its last known value
+        assert ret['slow'] == 0
+        assert ret['os'] == 'Linux'
+
+    def test_deadline_without_cache(self):
+        ret = self._collect(Grains(slow=2))
+        assert 'cloud_type' not in ret
+        assert ret['os'] == 'Linux'
+
+    def test_ttl(self):
+        self.opts['grains_cache_ttl'] = {'cloud_details': 3600}
+        self._collect(Grains())
+        grains = Grains(slow=0.1)
+        ret = self._collect(grains)
+        assert 'cloud_details.get_cloud_details' not in grains.calls
+        assert 'fqdn.fqdn' in grains.calls
+        assert ret['slow'] == 0
+
+    def test_snapshot(self):
+        trubblestack.grainloader.save_snapshot(self.opts, {'os': 'Linux'})
+        assert trubblestack.grainloader.load_snapshot(self.opts, 60) == {'os': 'Linux'}
+        assert trubblestack.grainloader.load_snapshot(self.opts, -1) is None
+
+    def test_snapshot_types(self):
+        grains = {'osrelease_info': (7, 4), 'ipv4': ['127.0.0.1'],
+                  'cpu': {'flags': ('fpu',), 'count': 2}}
+        trubblestack.grainloader.save_snapshot(self.opts, grains)
+        assert trubblestack.grainloader.load_snapshot(self.opts, 60) == grains
+
+    def test_snapshot_not_serializable(self):
+        trubblestack.grainloader.save_snapshot(self.opts, {'os': 'Linux'})
+        trubblestack.grainloader.save_snapshot(self.opts, {'os': 'Linux',
+                                                           'roles': set(['web'])})
+        assert trubblestack.grainloader.load_snapshot(self.opts, 60) is None
+        trubblestack.grainloader.save_snapshot(self.opts, {'os': 'Linux', 'ports': {22: 'ssh'}})
+        assert trubblestack.grainloader.load_snapshot(self.opts, 60) is None
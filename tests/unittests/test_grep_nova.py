@@ -2,7 +2,12 @@ import sys
 import os
 myPath = os.path.abspath(os.getcwd())
 sys.path.insert(0, myPath)
+import copy
+import shutil
+import tempfile
+
 import trubblestack.files.trubblestack_nova.grep
+from trubblestack.extmods.modules import trubble
 
 
 class TestGrep():
@@ -100,6 +105,37 @@ class TestGrep():
         assert val['CIS-5.1.4'] != 0
         assert val['CIS-9.3.6'] != 0
 
+    def test_get_tags_from_audit_plan(self):
+        trubblestack.files.trubblestack_nova.grep.__grains__ = {'osfinger': 'Ubuntu-16.04'}
+        data_list = [('ubuntu-1604-level-1-scored-v1-0-0',
+                      {'grep':
+                       {'blacklist': {'talk': {'data': {'Ubuntu-16.04': [{'/etc/inetd.conf': {'pattern': '^talk', 'tag': 'CIS-5.1.4'}}], '*': [{'/etc/inetd.conf': {'pattern': '^ntalk', 'tag': 'CIS-5.1.5'}}]}, 'labels': ['critical']}},
+                        'whitelist': {'ssh_ignore_rhosts': {'data': {'CentOS*, Ubuntu*': [{'/etc/ssh/sshd_config': {'pattern': 'IgnoreRhosts', 'tag': 'CIS-9.3.6', 'match_output': 'yes'}}]}}}}})]
+        for labels in (None, ['critical']):
+            plan = trubble.AuditPlan(data_list, labels, 'Ubuntu-16.04')
+            planned = trubblestack.files.trubblestack_nova.grep._get_tags(
+                plan.section('grep', ('blacklist', 'whitelist')))
+            data = {}
+            for profile, profile_data in copy.deepcopy(data_list):
+                trubblestack.files.trubblestack_nova.grep._merge_yaml(data, profile_data, profile)
+            data = trubblestack.files.trubblestack_nova.grep.apply_labels(data, labels)
+            assert planned == trubblestack.files.trubblestack_nova.grep._get_tags(data)
+        assert sorted(planned) == ['CIS-5.1.4']
+
+    def test_inputs(self):
+        trubblestack.files.trubblestack_nova.grep.__grains__ = {'osfinger': 'Ubuntu-16.04'}
+        data_list = [('ubuntu-1604-level-1-scored-v1-0-0',
+                      {'grep':
+                       {'blacklist': {'talk': {'data': {'*': [{'/etc/inetd.conf': {'pattern': '^talk', 'tag': 'CIS-5.1.4'}}]}}},
+                        'whitelist': {'ssh_ignore_rhosts': {'data': {'*': [{'/etc/ssh/sshd_config': {'pattern': 'IgnoreRhosts', 'tag': 'CIS-9.3.6', 'grep_args': ['-i']}}]}}}}})]
+        val = trubblestack.files.trubblestack_nova.grep.inputs(data_list, '*', None)
+        assert sorted(set(val)) == [('file', '/etc/inetd.conf'), ('file', '/etc/ssh/sshd_config')]
+        val = trubblestack.files.trubblestack_nova.grep.inputs(data_list, 'CIS-5*', None)
+        assert set(val) == set([('file', '/etc/inetd.conf')])
+        # A recursive grep reads files which can't be told in advance
+        data_list[0][1]['grep']['whitelist']['ssh_ignore_rhosts']['data']['*'][0]['/etc/ssh/sshd_config']['grep_args'] = ['-r']
+        assert trubblestack.files.trubblestack_nova.grep.inputs(data_list, '*', None) is None
+
     def test_get_tags_with_empty_list(self):
         trubblestack.files.trubblestack_nova.grep.__grains__ = {'osfinger': 'Ubuntu-16.04'}
         data = {'grep':
@@ -122,3 +158,61 @@ class TestGrep():
         val = trubblestack.files.trubblestack_nova.grep._grep(path, pattern, arg)
         trubblestack.files.trubblestack_nova.grep.__salt__ = {}
         assert val['stdout'] == 'tmpfs /dev/shm tmpfs rw,nosuid,nodev 0 0'
+
+
+class TestGrepEngine():
+
+    def setup_method(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sshd_config')
+        with open(self.path, 'w') as fh_:
+            fh_.write('# comment\nPermitRootLogin no\n  PermitRootLogin yes\nProtocol 2\n'
+                      'UMASK 027\nfoo|bar\n')
+        self.commands = []
+
+        def cmd_run_all(cmd, python_shell=False, ignore_retcode=False):
+            self.commands.append(cmd)
+            return {'pid': 1, 'retcode': 0, 'stderr': '', 'stdout': 'from grep'}
+        trubblestack.files.trubblestack_nova.grep.__salt__ = {'cmd.run_all': cmd_run_all}
+        self.engine = trubblestack.files.trubblestack_nova.grep.GrepEngine()
+
+    def teardown_method(self):
+        trubblestack.files.trubblestack_nova.grep.__salt__ = {}
+        shutil.rmtree(self.tmpdir)
+
+    def _grep(self, pattern, *args):
+        return self.engine.grep(self.path, pattern, *args)['stdout']
+
+    def test_patterns(self):
+        assert self._grep('^PermitRootLogin') == 'PermitRootLogin no'
+        assert self._grep("'^[[:space:]]*PermitRootLogin'") == 'PermitRootLogin no\n  PermitRootLogin yes'
+        assert self._grep("'Protocol[[:space:]]\\+2'") == 'Protocol 2'
+        assert self._grep('foo|bar') == 'foo|bar'
+        assert self._grep('foo|baz', '-E') == 'foo|bar'
+        assert self._grep("'permitrootlogin no'", '-i') == 'PermitRootLogin no'
+        assert self._grep("'UMASK 027'", '-F') == 'UMASK 027'
+        assert self._grep("'UMASK 02.'", '-F') == ''
+        assert self.commands == []
+
+    def test_options(self):
+        assert self._grep('PermitRootLogin', '-c') == '2'
+        assert self._grep('PermitRootLogin', '-v', '-c') == '4'
+        assert self._grep('Protocol', '-B1') == '  PermitRootLogin yes\nProtocol 2'
+        assert self._grep('comment', '-A', '1', '-n') == '1:# comment\n2-PermitRootLogin no'
+        assert self._grep('o', '-x') == ''
+        assert self.engine.grep(os.path.join(self.tmpdir, 'missing'), 'x')['stdout'] == ''
+        assert self.commands == []
+
+    def test_fallback(self):
+        assert self._grep('PermitRootLogin', '-z') == 'from grep'
+        assert self._grep("'Protocol\\d'") == 'from grep'
+        # Without quotes, grep would search the file 'no' as well
+        assert self._grep('permitrootlogin no', '-i') == 'from grep'
+        assert len(self.commands) == 3
+        assert self.commands[0].endswith('PermitRootLogin {0}'.format(self.path))
+
+    def test_reads_files_once(self):
+        self._grep('PermitRootLogin')
+        os.remove(self.path)
+        assert self._grep('Protocol') == 'Protocol 2'
+
@@ -0,0 +1,243 @@
+import sys
+import os
+myPath = os.path.abspath(os.getcwd())
+sys.path.insert(0, myPath)
+import logging
+import threading
+import time
+
+from trubblestack.jobpool import JobPool, JobRun
+from trubblestack.metrics import MetricsRegistry
+
+
+def _runner(function, args, kwargs):
+    if function == 'test.sleep':
+        time.sleep(args[0])
+        return os.getpid()
+    if function == 'test.fail':
+        raise ValueError('boom')
+    if function == 'test.log':
+        logging.getLogger(__name__).warning('logged by the worker')
+    return os.getpid()
+
+
+class Collector(object):
+
+    def __init__(self):
+        self.results = []
+        self.event = threading.Event()
+
+    def __call__(self, run, result):
+        self.results.append((run, result))
+        self.event.set()
+
+    def wait_for(self, count, timeout=10):
+        end = time.time() + timeout
+        while len(self.results) < count and time.time() < end:
+            self.event.wait(0.05)
+            self.event.clear()
+        return len(self.results) >= count
+
+
+class TestJobPool():
+
+    def _pool(self, lanes=None):
+        collector = Collector()
+        pool = JobPool(_runner, lanes=lanes, on_complete=collector)
+        pool.start()
+        return pool, collector
+
+    def test_default_lanes(self):
+        pool = JobPool(_runner)
+        assert pool.lane_for(JobRun('a', 'pulsar.process')).name == 'pulsar'
+        assert pool.lane_for(JobRun('b', 'trubble.audit')).name == 'default'
+        assert pool.lane_for(JobRun('c', 'trubble.audit', lane='nope')).name == 'default'
+
+    def test_thread_lane(self):
+        pool, collector = self._pool({'default': {'mode': 'thread', 'workers': 1}})
+        try:
+            assert pool.submit(JobRun('job', 'test.ping')) == 'started'
+            assert collector.wait_for(1)
+            run, result = collector.results[0]
+            assert result.ok
+            assert result.ret == os.getpid()
+            assert result.wall_time >= 0
+        finally:
+            pool.shutdown()
+
+    def test_process_lane(self):
+        pool, collector = self._pool({'default': {'mode': 'process', 'workers': 1}})
+        try:
+            pool.submit(JobRun('job', 'test.ping'))
+            pool.submit(JobRun('failing', 'test.fail'))
+            assert collector.wait_for(2)
+            results = dict((run.name, result) for run, result in collector.results)
+            assert results['job'].ok
+            assert results['job'].ret != os.getpid()
+            assert results['job'].cpu_time >= 0
+            assert results['job'].result_bytes > 0
+            assert not results['failing'].ok
+            assert 'boom' in results['failing'].error
+        finally:
+            pool.shutdown()
+
+    def test_process_lane_with_logging(self):
+        handler = logging.StreamHandler(open(os.devnull, 'w'))
+        logging.getLogger().addHandler(handler)
+        pool, collector = self._pool({'default': {'mode': 'process', 'workers': 1}})
+        try:
+            pool.submit(JobRun('job', 'test.log'))
+            assert collector.wait_for(1)
+            result = collector.results[0][1]
+            assert result.ok
+            assert result.ret != os.getpid()
+        finally:
+            pool.shutdown()
+            logging.getLogger().removeHandler(handler)
+            handler.stream.close()
+
+    def test_recycle_after_jobs(self):
+        registry = MetricsRegistry()
+        collector = Collector()
+        pool = JobPool(_runner, lanes={'default': {'mode': 'process', 'workers': 1,
+                                                   'max_jobs': 2}},
+                       on_complete=collector, registry=registry)
+        pool.start()
+        try:
+            for num in range(3):
+                pool.submit(JobRun('job{0}'.format(num), 'test.ping'))
+                assert collector.wait_for(num + 1)
+            pids = [result.ret for _, result in collector.results]
+            assert pids[0] == pids[1] != pids[2]
+            assert registry.get('trubble_worker_recycles_total',
+                                {'lane': 'default', 'reason': 'jobs'}) == 1
+            assert registry.get('trubble_worker_rss_bytes', {'worker': 'trubble-default-0'}) > 0
+        finally:
+            pool.shutdown()
+
+    def test_recycle_above_rss(self):
+        pool, collector = self._pool({'default': {'mode': 'process', 'workers': 1,
+                                                  'max_jobs': 0, 'max_rss_mb': 1}})
+        try:
+            for num in range(2):
+                pool.submit(JobRun('job{0}'.format(num), 'test.ping'))
+                assert collector.wait_for(num + 1)
+            pids = [result.ret for _, result in collector.results]
+            assert pids[0] != pids[1]
+        finally:
+            pool.shutdown()
+
+    def test_skip_overlap(self):
+        pool, collector = self._pool({'default': {'mode': 'thread', 'workers': 2}})
+        try:
+            assert pool.submit(JobRun('job', 'test.sleep', args=[0.3])) == 'started'
+            assert pool.submit(JobRun('job', 'test.sleep', args=[0.3])) == 'skipped'
+            assert pool.active('job') == 1
+            assert collector.wait_for(1)
+            time.sleep(0.2)
+            assert len(collector.results) == 1
+        finally:
+            pool.shutdown()
+
+    def test_queue_overlap(self):
+        pool, collector = self._pool({'default': {'mode': 'thread', 'workers': 2}})
+        try:
+            assert pool.submit(JobRun('job', 'test.sleep', args=[0.2], overlap='queue')) == 'started'
+            assert pool.submit(JobRun('job', 'test.sleep', args=[0.2], overlap='queue')) == 'queued'
+            assert pool.submit(JobRun('job', 'test.sleep', args=[0.2], overlap='queue')) == 'skipped'
+            assert collector.wait_for(2)
+            first, second = [result for _, result in collector.results]
+            assert second.started >= first.finished
+        finally:
+            pool.shutdown()
+
+    def test_max_concurrency(self):
+        pool, collector = self._pool({'default': {'mode': 'thread', 'workers': 2}})
+        try:
+            assert pool.submit(JobRun('job', 'test.sleep', args=[0.2], max_concurrency=2)) == 'started'
+            assert pool.submit(JobRun('job', 'test.sleep', args=[0.2], max_concurrency=2)) == 'started'
+            assert pool.submit(JobRun('job', 'test.sleep', args=[0.2], max_concurrency=2)) == 'skipped'
+            assert collector.wait_for(2)
+        finally:
+            pool.shutdown()
+
+    def test_kill_overlap(self):
+        pool, collector = self._pool({'default': {'mode': 'process', 'workers': 1}})
+        try:
+            assert pool.submit(JobRun('job', 'test.sleep', args=[30], overlap='kill')) == 'started'
+            end = time.time() + 5
+            while pool.lanes['default'].slots[0].current is None and time.time() < end:
+                time.sleep(0.05)
+            assert pool.submit(JobRun('job', 'test.sleep', args=[0], overlap='kill')) == 'killed'
+            # Only the replacement run is reported
+            assert collector.wait_for(1)
+            run, result = collector.results[0]
+            assert result.ok
+            assert result.wall_time < 5
+        finally:
+            pool.shutdown()
+
+    def test_pulsar_lane_not_blocked(self):
+        pool, collector = self._pool({'default': {'mode': 'thread', 'workers': 1}})
+        try:
+            pool.submit(JobRun('audit', 'test.sleep', args=[1]))
+            pool.submit(JobRun('pulsar', 'pulsar.process'))
+            assert collector.wait_for(1)
+            assert collector.results[0][0].name == 'pulsar'
+        finally:
+            pool.shutdown()
+
+    def test_fork_in_main_thread(self):
+        woken = threading.Event()
+        collector = Collector()
+        pool = JobPool(_runner, lanes={'default': {'mode': 'process', 'workers': 1,
+                                                   'max_jobs': 1}},
+                       on_complete=collector, wake=woken.set)
+        pool.start()
+        try:
+            pool.submit(JobRun('job0', 'test.ping'))
+            assert collector.wait_for(1)
+            # The slot needs a new worker, and waits for this thread to fork it
+            pool.submit(JobRun('job1', 'test.ping'))
+            assert woken.wait(5)
+            assert not collector.wait_for(2, timeout=0.2)
+            pool.serve_forks()
+            assert collector.wait_for(2)
+            pids = [result.ret for _, result in collector.results]
+            assert pids[0] != pids[1]
+        finally:
+            pool.shutdown()
+
+    def test_stop(self):
+        pool, collector = self._pool({'default': {'mode': 'process', 'workers': 1}})
+        run = JobRun('audit', 'test.sleep', args=[30])
+        pool.submit(run)
+        pool.submit(JobRun('queued', 'test.ping'))
+        end = time.time() + 5
+        while run.started is None and time.time() < end:
+            time.sleep(0.01)
+        worker = pool.lanes['default'].slots[0].worker
+        started = time.time()
+        pool.stop(timeout=5)
+        assert time.time() - started < 5
+        assert not worker.alive()
+        assert not pool.lanes['default'].slots[0].thread.is_alive()
+        # Neither the killed nor the queued run is reported
+        assert collector.results == []
+
+    def test_paused(self):
+        pool, collector = self._pool({'default': {'mode': 'thread', 'workers': 1}})
+        try:
+            run = JobRun('running', 'test.sleep', args=[0.3])
+            pool.submit(run)
+            end = time.time() + 5
+            while run.started is None and time.time() < end:
+                time.sleep(0.01)
+            with pool.paused():
+                # The running job was waited for, new ones are held back
+                assert len(collector.results) == 1
+                pool.submit(JobRun('held', 'test.ping'))
+                assert not collector.wait_for(2, timeout=0.2)
+            assert collector.wait_for(2)
+        finally:
+            pool.shutdown()
@@ -0,0 +1,97 @@
+import sys
+import os
+myPath = os.path.abspath(os.getcwd())
+sys.path.insert(0, myPath)
+import shutil
+import socket
+import tempfile
+
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+from trubblestack.jobpool import JobResult, JobRun
+from trubblestack.metrics import MetricsHTTPServer, MetricsRegistry, ResourceUsage, record_job
+from trubblestack.metrics import deep_sizeof, largest_keys
+
+
+class TestMetrics():
+
+    def test_render(self):
+        registry = MetricsRegistry()
+        registry.inc('trubble_test_total', {'job': 'a"b'}, help_text='Test counter')
+        registry.inc('trubble_test_total', {'job': 'a"b'})
+        registry.set('trubble_test_gauge', 1.5)
+        registry.observe('trubble_test_seconds', 2, {'job': 'x'})
+        registry.observe('trubble_test_seconds', 3, {'job': 'x'})
+        registry.add_collector(lambda: [('trubble_test_collected', 'gauge', '', None, 7)])
+        text = registry.render()
+        assert '# HELP trubble_test_total Test counter' in text
+        assert '# TYPE trubble_test_total counter' in text
+        assert 'trubble_test_total{job="a\\"b"} 2.0' in text
+        assert 'trubble_test_gauge 1.5' in text
+        assert 'trubble_test_seconds_sum{job="x"} 5.0' in text
+        assert 'trubble_test_seconds_count{job="x"} 2' in text
+        assert 'trubble_test_collected 7.0' in text
+
+    def test_textfile(self):
+        directory = tempfile.mkdtemp()
+        try:
+            registry = MetricsRegistry()
+            registry.set('trubble_test_gauge', 1)
+            path = os.path.join(directory, 'trubble.prom')
+            registry.write_textfile(path)
+            with open(path) as fh_:
+                assert 'trubble_test_gauge 1.0' in fh_.read()
+            assert os.listdir(directory) == ['trubble.prom']
+        finally:
+            shutil.rmtree(directory)
+
+    def test_resource_usage(self):
+        with ResourceUsage(process=True) as usage:
+            data = [0] * 1000000
+            sum(i * i for i in range(200000))
+        assert usage.cpu_time > 0
+        assert usage.rss_delta >= 0
+        del data
+
+    def test_record_job(self):
+        registry = MetricsRegistry()
+        result = JobResult(True, ret={}, started=10, finished=12.5, cpu_time=1.0,
+                           rss_delta=1024, result_bytes=10)
+        record_job(registry, JobRun('audit', 'trubble.audit'), result)
+        labels = {'job': 'audit', 'function': 'trubble.audit'}
+        assert registry.get('trubble_job_last_wall_seconds', labels) == 2.5
+        assert registry.get('trubble_job_wall_seconds', labels) == (2.5, 1)
+        assert registry.get('trubble_job_runs_total', dict(labels, status='ok')) == 1
+        assert registry.get('trubble_job_last_result_bytes', labels) == 10
+
+    def test_largest_keys(self):
+        shared = ['x' * 1000]
+        context = {'small': 1,
+                   'checksums': dict(('/etc/file{0}'.format(num), 'a' * 64)
+                                     for num in range(100)),
+                   'shared': shared,
+                   'shared_again': shared}
+        assert deep_sizeof(context['checksums']) > 100 * 64
+        assert largest_keys(context, top=1)[0][0] == 'checksums'
+        # Objects referenced twice are only counted once
+        sizes = dict(largest_keys(context))
+        assert min(sizes['shared'], sizes['shared_again']) < 1000
+        assert max(sizes['shared'], sizes['shared_again']) > 1000
+
+    def test_http(self):
+        registry = MetricsRegistry()
+        registry.set('trubble_test_gauge', 3)
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        server = MetricsHTTPServer(registry, port)
+        server.start()
+        try:
+            body = urlopen('http://127.0.0.1:{0}/metrics'.format(port), timeout=5).read()
+            assert b'trubble_test_gauge 3.0' in body
+        finally:
+            server.stop()
@@ -0,0 +1,93 @@
+import sys
+import os
+myPath = os.path.abspath(os.getcwd())
+sys.path.insert(0, myPath)
+import shutil
+import tempfile
+import time
+
+import yaml
+
+from trubblestack.extmods.modules import nova_loader
+from trubblestack.extmods.modules.nova_loader import NovaLazyLoader
+
+
+class TestNovaLazyLoader():
+
+    def setup_method(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.module_dir = os.path.join(self.tmpdir, 'trubblestack_nova')
+        self.profile_dir = os.path.join(self.tmpdir, 'trubblestack_nova_profiles')
+        self.cachedir = os.path.join(self.tmpdir, 'cache')
+        os.makedirs(self.module_dir)
+        os.makedirs(self.profile_dir)
+        self._write(self.module_dir, 'grep.py', 'def audit(*args, **kwargs):\n'
+                                                '    return {"Success": ["v1"]}\n')
+        self._write(self.profile_dir, 'cis.yaml', 'grep: {version: 1}\n')
+        self._write(self.profile_dir, 'misc.yaml', 'grep: {version: 1}\n')
+        self.safe_load = yaml.safe_load
+        self.parsed = []
+
+        def _safe_load(stream):
+            self.parsed.append(stream)
+            return self.safe_load(stream)
+        nova_loader.yaml.safe_load = _safe_load
+
+    def teardown_method(self):
+        nova_loader.yaml.safe_load = self.safe_load
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, dirname, filename, content):
+        path = os.path.join(dirname, filename)
+        mtime = os.stat(path).st_mtime if os.path.exists(path) else None
+        with open(path, 'w') as fh_:
+            fh_.write(content)
+        if mtime is not None:
+            # Make sure the change is seen on filesystems with coarse mtimes
+            os.utime(path, (time.time(), mtime + 1))
+
+    def _loader(self):
+        return NovaLazyLoader((self.module_dir, self.profile_dir), {'cachedir': self.cachedir},
+                              {'os': 'Linux'}, {}, {})
+
+    def test_refresh_reloads_changed_files(self):
+        loader = self._loader()
+        assert loader.__data__['/cis.yaml'] == {'grep': {'version': 1}}
+        # Both profiles have the same content, it's parsed once
+        assert len(self.parsed) == 1
+
+        func = loader._dict['/grep.py']
+        self._write(self.profile_dir, 'cis.yaml', 'grep: {version: 2}\n')
+        os.remove(os.path.join(self.profile_dir, 'misc.yaml'))
+        loader.refresh({'os': 'Windows'}, {}, {})
+        assert loader.__data__ == {'/cis.yaml': {'grep': {'version': 2}}}
+        assert len(self.parsed) == 2
+        # Unchanged modules are kept, with the new grains
+        assert loader._dict['/grep.py'] is func
+        assert loader.modules['/grep.py'].__grains__ == {'os': 'Windows'}
+
+        self._write(self.module_dir, 'grep.py', 'def audit(*args, **kwargs):\n'
+                                                '    return {"Success": ["v2"]}\n')
+        loader.refresh({}, {}, {})
+        assert loader._dict['/grep.py']([], '*', None) == {'Success': ['v2']}
+
+    def test_profile_cache(self):
+        self._loader()
+        assert len(self.parsed) == 1
+        assert os.path.isfile(os.path.join(self.cachedir, nova_loader.PROFILE_CACHE))
+
+        # A new loader (after a restart) reads the parsed profiles from the cache
+        loader = self._loader()
+        assert len(self.parsed) == 1
+        assert loader.__data__['/misc.yaml'] == {'grep': {'version': 1}}
+
+    def test_profiles_not_shared(self):
+        loader = self._loader()
+        cis, misc = loader.__data__['/cis.yaml'], loader.__data__['/misc.yaml']
+        assert cis == misc
+        assert cis is not misc
+        # Changes made by the nova modules don't reach the other profile
+        # or the cache
+        cis['grep']['version'] = 3
+        assert misc == {'grep': {'version': 1}}
+        assert loader.profile_cache.values() == [{'grep': {'version': 1}}]
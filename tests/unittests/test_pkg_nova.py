@@ -21,6 +21,14 @@ class TestPkg():
         val = trubblestack.files.trubblestack_nova.pkg._merge_yaml(ret, data, profile)
         assert val['pkg'] == {'blacklist': [{'talk': {'nova_profile': 'ubuntu-1604-level-1-scored-v1-0-0', 'data': {'Ubuntu-16.04': [{'/etc/inetd.conf': {'pattern': '^talk', 'tag': 'CIS-5.1.4'}}, {'/etc/inetd.conf': {'pattern': '^ntalk', 'tag': 'CIS-5.1.4'}}]}, 'description': 'Ensure talk server is not enabled'}}],
                               'whitelist': [{'ssh_ignore_rhosts': {'nova_profile': 'ubuntu-1604-level-1-scored-v1-0-0', 'data': {'Ubuntu-16.04': [{'/etc/ssh/sshd_config': {'pattern': 'IgnoreRhosts', 'tag': 'CIS-9.3.6', 'match_output': 'yes'}}]}, 'description': 'Set SSH IgnoreRhosts to Yes'}}]}
+        # The profile data is left as it was
+        assert 'nova_profile' not in data['pkg']['blacklist']['talk']
+
+    def test_merge_yaml_same_data(self):
+        data = {'pkg': {'blacklist': {'talk': {'data': {'Ubuntu-16.04': [{'talk': 'CIS-5.1.4'}]}}}}}
+        ret = trubblestack.files.trubblestack_nova.pkg._merge_yaml({}, data, 'cis')
+        ret = trubblestack.files.trubblestack_nova.pkg._merge_yaml(ret, data, 'misc')
+        assert [check['talk']['nova_profile'] for check in ret['pkg']['blacklist']] == ['cis', 'misc']
 
     def test_merge_yaml_recurssive(self):
         ret = {}
@@ -53,6 +61,23 @@ class TestPkg():
         assert len(val['Success']) != 0
         assert len(val['Failure']) == 0
 
+    def test_audit_with_pkg_inventory(self):
+        data_list = [('ubuntu-1604-level-1-scored-v1-0-0',
+                     {'pkg':
+                      {'blacklist': {'nis': {'data': {'Ubuntu-16.04': [{'nis': 'CIS-5.1.1'}]}, 'description': 'Ensure NIS is not installed'}},
+                       'whitelist': {'ntp': {'data': {'Ubuntu-16.04': [{'ntp': {'tag': 'CIS-6.5', 'version': '>=4.2'}}]}, 'description': 'Configure Network Time Protocol (NTP)'}}}})]
+        trubblestack.files.trubblestack_nova.pkg.__grains__ = {'osfinger': 'Ubuntu-16.04'}
+        # The package snapshot is used instead of pkg.version
+        trubblestack.files.trubblestack_nova.pkg.__salt__ = {}
+
+        class FakeInventory(object):
+            def version(self, name):
+                return {'ntp': '4.2.8p4'}.get(name, '')
+        val = trubblestack.files.trubblestack_nova.pkg.audit(data_list, 'CIS-*', None,
+                                                              pkg_inventory=FakeInventory())
+        assert sorted(tag_data['tag'] for tag_data in val['Success']) == ['CIS-5.1.1', 'CIS-6.5']
+        assert val['Failure'] == []
+
     def test_audit_for_incorrect_input(self):
         val = {}
         data_list = []
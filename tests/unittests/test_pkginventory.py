@@ -0,0 +1,104 @@
+import sys
+import os
+myPath = os.path.abspath(os.getcwd())
+sys.path.insert(0, myPath)
+import shutil
+import tempfile
+import time
+
+from trubblestack import pkginventory
+
+DPKG_STATUS = '''Package: openssh-server
+Status: install ok installed
+Architecture: amd64
+Version: 1:7.2p2-4ubuntu2.8
+Description: secure shell (SSH) server
+ multiline description
+
+Package: libc6
+Status: install ok installed
+Architecture: i386
+Version: 2.23-0ubuntu11
+
+Package: telnet
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 0.17-40
+
+Package: tzdata
+Status: hold ok installed
+Architecture: all
+Version: 2019c-0ubuntu0.16.04
+'''
+
+RPM_PACKAGES = '''openssh-server\t(none)\t7.4p1\t16.el7\tx86_64
+glibc\t(none)\t2.17\t292.el7\ti686
+tzdata\t0\t2019c\t1.el7\tnoarch
+kernel\t(none)\t3.10.0\t1062.el7\tx86_64
+kernel\t(none)\t3.10.0\t957.el7\tx86_64
+perl-Pod-Escapes\t1\t1.04\t294.el7_6\tnoarch
+'''
+
+
+class TestPackageInventory():
+
+    def setup_method(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dpkg_status = pkginventory.DPKG_STATUS
+        self.pkg_dbs = pkginventory.PKG_DBS
+        pkginventory.DPKG_STATUS = os.path.join(self.tmpdir, 'status')
+        pkginventory.PKG_DBS = (pkginventory.DPKG_STATUS,)
+        pkginventory._SNAPSHOT.update({'key': None, 'packages': None})
+        with open(pkginventory.DPKG_STATUS, 'w') as fh_:
+            fh_.write(DPKG_STATUS)
+        self.grains = {'os_family': 'Debian', 'osarch': 'amd64', 'cpuarch': 'x86_64'}
+        self.calls = []
+
+    def teardown_method(self):
+        pkginventory.DPKG_STATUS = self.dpkg_status
+        pkginventory.PKG_DBS = self.pkg_dbs
+        pkginventory._SNAPSHOT.update({'key': None, 'packages': None})
+        shutil.rmtree(self.tmpdir)
+
+    def _run_all(self, cmd, python_shell=False, output_loglevel=None):
+        self.calls.append(cmd)
+        return {'retcode': 0, 'stdout': RPM_PACKAGES, 'stderr': ''}
+
+    def test_dpkg(self):
+        inventory = pkginventory.PackageInventory({}, self.grains)
+        assert inventory.list_pkgs() == {'openssh-server': '1:7.2p2-4ubuntu2.8',
+                                         'libc6:i386': '2.23-0ubuntu11',
+                                         'tzdata': '2019c-0ubuntu0.16.04'}
+        assert inventory.version('telnet') == ''
+        assert inventory.version('openssh*') == {'openssh-server': '1:7.2p2-4ubuntu2.8'}
+
+    def test_rpm(self):
+        self.grains = {'os_family': 'RedHat', 'osarch': 'x86_64'}
+        inventory = pkginventory.PackageInventory({'cmd.run_all': self._run_all}, self.grains)
+        assert inventory.list_pkgs(versions_as_list=True) == {
+            'openssh-server': ['7.4p1-16.el7'],
+            'glibc.i686': ['2.17-292.el7'],
+            'tzdata': ['2019c-1.el7'],
+            'kernel': ['3.10.0-1062.el7', '3.10.0-957.el7'],
+            'perl-Pod-Escapes': ['1:1.04-294.el7_6']}
+        assert inventory.version('kernel') == '3.10.0-1062.el7,3.10.0-957.el7'
+        assert len(self.calls) == 1
+
+    def test_snapshot_shared_until_db_changes(self):
+        salt = {'pkg.list_pkgs': lambda versions_as_list=False: self.calls.append(1) or {}}
+        first = pkginventory.PackageInventory(salt, self.grains).packages
+        assert pkginventory.PackageInventory(salt, self.grains).packages is first
+
+        mtime = os.stat(pkginventory.DPKG_STATUS).st_mtime
+        with open(pkginventory.DPKG_STATUS, 'a') as fh_:
+            fh_.write('\nPackage: nis\nStatus: install ok installed\nVersion: 3.17\n')
+        os.utime(pkginventory.DPKG_STATUS, (time.time(), mtime + 1))
+        assert pkginventory.PackageInventory(salt, self.grains).version('nis') == '3.17'
+        assert self.calls == []
+
+        # Without a package database, pkg.list_pkgs is asked every time
+        pkginventory.PKG_DBS = (os.path.join(self.tmpdir, 'missing'),)
+        self.grains['os_family'] = 'Arch'
+        pkginventory.PackageInventory(salt, self.grains).packages
+        pkginventory.PackageInventory(salt, self.grains).packages
+        assert len(self.calls) == 2
@@ -0,0 +1,258 @@
+import sys
+import os
+myPath = os.path.abspath(os.getcwd())
+sys.path.insert(0, myPath)
+import threading
+import time
+
+from datetime import datetime
+
+from trubblestack.scheduler import CronSchedule, Scheduler, ScheduledJob, Waker
+from trubblestack.scheduler import bucket_offset, stable_fraction
+
+
+class TestScheduledJob():
+
+    def test_invalid_data(self):
+        for data in (None, 'bogus', {'seconds': 10}, {'function': 'test.ping'}):
+            try:
+                ScheduledJob('job1', data)
+            except ValueError:
+                pass
+            else:
+                assert False, 'expected ValueError for {0}'.format(data)
+
+    def test_invalid_seconds(self):
+        try:
+            ScheduledJob('job1', {'function': 'test.ping', 'seconds': 'often'})
+        except ValueError as exc:
+            assert 'invalid value for seconds' in str(exc)
+        else:
+            assert False
+
+    def test_invalid_args(self):
+        try:
+            ScheduledJob('job1', {'function': 'test.ping', 'seconds': 10, 'args': 'foo'})
+        except ValueError as exc:
+            assert 'args not formed as a list' in str(exc)
+        else:
+            assert False
+
+    def test_returner_list(self):
+        job = ScheduledJob('job1', {'function': 'test.ping', 'seconds': 10,
+                                    'returner': 'splunk_nova_return'})
+        assert job.returners == ['splunk_nova_return']
+
+    def test_first_run(self):
+        now = 1000.0
+        job = ScheduledJob('job1', {'function': 'test.ping', 'seconds': 10})
+        assert job.first_run(now) == 1010.0
+        job = ScheduledJob('job1', {'function': 'test.ping', 'seconds': 10,
+                                    'run_on_start': True})
+        assert job.first_run(now) == now
+        job = ScheduledJob('job1', {'function': 'test.ping', 'seconds': 10,
+                                    'run_on_start': True, 'splay': 5})
+        assert now <= job.first_run(now) <= now + 5
+        job = ScheduledJob('job1', {'function': 'test.ping', 'seconds': 10,
+                                    'splay': 5})
+        assert now + 10 <= job.first_run(now) <= now + 15
+
+
+def _ts(*args):
+    return time.mktime(datetime(*args).timetuple())
+
+
+class TestCronSchedule():
+
+    def test_invalid(self):
+        try:
+            ScheduledJob('job1', {'function': 'test.ping', 'seconds': 60,
+                                  'cron': 'every minute'})
+        except ValueError as exc:
+            assert 'invalid value' in str(exc)
+        else:
+            assert False
+
+    def test_per_minute(self):
+        cron = CronSchedule('*/15 * * * *')
+        now = _ts(2024, 3, 5, 10, 7, 30)
+        assert cron.next_after(now) == _ts(2024, 3, 5, 10, 15)
+        assert cron.last_before(now) == _ts(2024, 3, 5, 10, 0)
+        # A fire time is its own last run, and is not its own next run
+        assert cron.last_before(_ts(2024, 3, 5, 10, 15)) == _ts(2024, 3, 5, 10, 15)
+        assert cron.next_after(_ts(2024, 3, 5, 10, 15)) == _ts(2024, 3, 5, 10, 30)
+
+    def test_per_second(self):
+        cron = CronSchedule('* * * * * */10')
+        now = _ts(2024, 3, 5, 10, 7, 31)
+        assert cron.next_after(now) == _ts(2024, 3, 5, 10, 7, 40)
+        assert cron.last_before(now + 0.5) == _ts(2024, 3, 5, 10, 7, 30)
+
+    def test_irregular(self):
+        # Not a fixed interval: 09:00 and 17:00 on weekdays
+        job = ScheduledJob('job1', {'function': 'test.ping', 'seconds': 60,
+                                    'cron': '0 9,17 * * 1-5'})
+        # Friday 18:00
+        now = _ts(2024, 3, 8, 18, 0)
+        assert job.first_run(now) == _ts(2024, 3, 11, 9, 0)
+        assert job.last_run == _ts(2024, 3, 8, 17, 0)
+        assert job.fired(job.next_run) == _ts(2024, 3, 11, 17, 0)
+
+    def test_period(self):
+        assert CronSchedule('*/15 * * * *').period(_ts(2024, 3, 5, 10, 7)) == 900
+        assert CronSchedule('0 9,17 * * 1-5').period(_ts(2024, 3, 8, 18, 0)) == 8 * 3600
+        job = ScheduledJob('job1', {'function': 'test.ping', 'seconds': 60,
+                                    'cron': '* * * * * */10'})
+        assert job.seconds == 10
+
+    def test_splay(self):
+        job = ScheduledJob('job1', {'function': 'test.ping', 'seconds': 60,
+                                    'cron': '*/5 * * * *', 'splay': 30})
+        now = _ts(2024, 3, 5, 10, 4, 50)
+        first = job.first_run(now)
+        assert first == _ts(2024, 3, 5, 10, 5) + job.offset
+        assert 0 <= job.offset <= 30
+        # Every run keeps the host's delay
+        assert job.fired(first) == _ts(2024, 3, 5, 10, 10) + job.offset
+        assert job.fired(job.next_run + 0.5) == _ts(2024, 3, 5, 10, 15) + job.offset
+
+    def test_buckets(self):
+        job = ScheduledJob('job1', {'function': 'test.ping', 'seconds': 60,
+                                    'cron': '0 * * * *', 'buckets': 'spread'})
+        now = _ts(2024, 3, 5, 10, 0)
+        first = job.first_run(now, host_id='host-a')
+        assert job.offset == bucket_offset('host-a', 3600, 'spread')
+        assert first == _ts(2024, 3, 5, 10, 0) + job.offset
+        assert job.fired(first) == _ts(2024, 3, 5, 11, 0) + job.offset
+
+
+class TestBuckets():
+
+    def test_stable_fraction(self):
+        assert stable_fraction('host-a') == stable_fraction(u'host-a')
+        assert 0 <= stable_fraction('host-a') < 1
+        assert stable_fraction('host-a') != stable_fraction('host-b')
+
+    def test_uniform_buckets(self):
+        counts = [0] * 16
+        for num in range(16000):
+            counts[int(bucket_offset('host-{0}'.format(num), 1600, 16)) // 100] += 1
+        assert min(counts) > 800 and max(counts) < 1200
+
+    def test_spread(self):
+        offset = bucket_offset('host-a', 3600, 'spread')
+        assert offset == bucket_offset('host-a', 3600, 'spread')
+        # One slot per host
+        assert bucket_offset('host-a', 3600, 'spread', fleet_size=100) % 36 == 0
+
+    def test_first_run(self):
+        now = 1000000.0
+        job = ScheduledJob('job1', {'function': 'test.ping', 'seconds': 3600,
+                                    'buckets': 'spread'})
+        next_run = job.first_run(now, host_id='host-a')
+        assert now < next_run <= now + 3600
+        assert abs(next_run % 3600 - bucket_offset('host-a', 3600, 'spread')) < 1e-6
+        assert job.first_run(now, host_id='host-a') == next_run
+
+    def test_invalid_buckets(self):
+        try:
+            ScheduledJob('job1', {'function': 'test.ping', 'seconds': 60,
+                                  'buckets': 'many'})
+        except ValueError as exc:
+            assert 'invalid value for buckets' in str(exc)
+        else:
+            assert False
+
+
+class TestScheduler():
+
+    def test_load_skips_invalid_jobs(self):
+        sched = Scheduler()
+        assert sched.load({'good': {'function': 'test.ping', 'seconds': 10},
+                           'bad': {'function': 'test.ping'}}, now=0)
+        assert list(sched.jobs) == ['good']
+
+    def test_pop_due_order(self):
+        sched = Scheduler()
+        sched.load({'slow': {'function': 'test.ping', 'seconds': 30},
+                    'fast': {'function': 'test.ping', 'seconds': 10},
+                    'now': {'function': 'test.ping', 'seconds': 60, 'run_on_start': True}},
+                   now=0)
+        assert sched.next_run() == 0
+        assert [job.name for job in sched.pop_due(now=0)] == ['now']
+        assert sched.pop_due(now=5) == []
+        assert sched.seconds_until_next(now=5) == 5
+        assert [job.name for job in sched.pop_due(now=31)] == ['fast', 'slow']
+        # rescheduled relative to when they fired
+        assert sched.jobs['fast'].next_run == 41
+        assert sched.jobs['slow'].next_run == 61
+        assert sched.jobs['now'].next_run == 60
+
+    def test_reload_unchanged(self):
+        sched = Scheduler()
+        config = {'job1': {'function': 'test.ping', 'seconds': 10}}
+        assert sched.load(config, now=0)
+        assert not sched.load(config, now=5)
+        assert sched.jobs['job1'].next_run == 10
+
+    def test_reload_keeps_unchanged_jobs(self):
+        sched = Scheduler()
+        config = {'job1': {'function': 'test.ping', 'seconds': 10}}
+        sched.load(config, now=0)
+        job1 = sched.jobs['job1']
+        config = {'job1': {'function': 'test.ping', 'seconds': 10},
+                  'job2': {'function': 'test.ping', 'seconds': 20}}
+        assert sched.load(config, now=5)
+        assert sched.jobs['job1'] is job1
+        assert sched.jobs['job1'].next_run == 10
+        assert sched.jobs['job2'].next_run == 25
+
+    def test_reload_changed_job(self):
+        sched = Scheduler()
+        sched.load({'job1': {'function': 'test.ping', 'seconds': 10}}, now=0)
+        sched.load({'job1': {'function': 'test.ping', 'seconds': 100}}, now=5)
+        assert sched.jobs['job1'].next_run == 105
+        assert sched.pop_due(now=20) == []
+
+    def test_removed_job(self):
+        sched = Scheduler()
+        sched.load({'job1': {'function': 'test.ping', 'seconds': 10}}, now=0)
+        sched.load({}, now=0)
+        assert sched.next_run() is None
+        assert sched.seconds_until_next(default=42) == 42
+        assert sched.pop_due(now=100) == []
+
+    def test_pop_early(self):
+        sched = Scheduler()
+        sched.load({'audit1': {'function': 'trubble.audit', 'seconds': 100},
+                    'audit2': {'function': 'trubble.audit', 'seconds': 130},
+                    'ping': {'function': 'test.ping', 'seconds': 120},
+                    'daily': {'function': 'trubble.audit', 'cron': '0 0 * * *', 'seconds': 1}},
+                   now=0)
+        assert [job.name for job in sched.pop_due(now=100)] == ['audit1']
+        early = sched.pop_early(60, lambda job: job.function == 'trubble.audit', now=100)
+        assert [job.name for job in early] == ['audit2']
+        # Rescheduled from its fire time, and the other jobs are untouched
+        assert sched.jobs['audit2'].next_run == 260
+        assert sched.jobs['ping'].next_run == 120
+        assert [job.name for job in sched.pop_due(now=120)] == ['ping']
+
+
+class TestWaker():
+
+    def test_timeout(self):
+        waker = Waker()
+        t1 = time.time()
+        assert waker.wait(0.2) is False
+        assert time.time() - t1 >= 0.15
+
+    def test_wake(self):
+        waker = Waker()
+        timer = threading.Timer(0.1, waker.wake)
+        timer.start()
+        t1 = time.time()
+        assert waker.wait(5) is True
+        assert time.time() - t1 < 2
+        timer.join()
+        # pending wakeups are drained
+        assert waker.wait(0) is False
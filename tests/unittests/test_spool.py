@@ -0,0 +1,126 @@
+import sys
+import os
+myPath = os.path.abspath(os.getcwd())
+sys.path.insert(0, myPath)
+import json
+import shutil
+import tempfile
+
+from trubblestack.spool import Spool, SpoolDrainer, SpoolRecordRejected, deliver_record
+
+
+class Deliverer(object):
+
+    def __init__(self, fail_after=None, reject=()):
+        self.delivered = []
+        self.fail_after = fail_after
+        self.reject = reject
+
+    def __call__(self, data):
+        if data in self.reject:
+            raise SpoolRecordRejected('bad record')
+        if self.fail_after is not None and len(self.delivered) >= self.fail_after:
+            return False
+        self.delivered.append(data)
+        return True
+
+
+class TestSpool():
+
+    def setup_method(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown_method(self):
+        shutil.rmtree(self.directory)
+
+    def _spool(self, **kwargs):
+        kwargs.setdefault('fsync_interval', 0)
+        return Spool(self.directory, **kwargs)
+
+    def test_append_and_read(self):
+        spool = self._spool()
+        for i in range(5):
+            spool.append('record {0}'.format(i))
+        records = spool.read(3)
+        assert [data for data, _ in records] == [b'record 0', b'record 1', b'record 2']
+        # Nothing is consumed until it is committed
+        assert len(spool.read()) == 5
+        spool.commit(records[-1][1])
+        assert [data for data, _ in spool.read()] == [b'record 3', b'record 4']
+
+    def test_resume_after_restart(self):
+        spool = self._spool(segment_bytes=30)
+        for i in range(10):
+            spool.append('record {0}'.format(i))
+        assert len(spool.segments()) > 1
+        records = spool.read(4)
+        spool.commit(records[-1][1])
+        spool.close()
+
+        spool = self._spool(segment_bytes=30)
+        assert [data for data, _ in spool.read()] == \
+            ['record {0}'.format(i).encode('utf-8') for i in range(4, 10)]
+
+    def test_delivered_segments_are_removed(self):
+        spool = self._spool(segment_bytes=30)
+        for i in range(10):
+            spool.append('record {0}'.format(i))
+        drainer = SpoolDrainer(spool, Deliverer())
+        assert drainer.drain()
+        assert spool.read() == []
+        assert len(spool.segments()) <= 1
+        assert spool.pending_bytes() == 0
+        assert spool.counters['delivered'] == 10
+
+    def test_size_cap(self):
+        spool = self._spool(segment_bytes=100, max_bytes=300)
+        for i in range(100):
+            spool.append('record {0:04d}'.format(i))
+        assert sum(os.path.getsize(spool._path(seg)) for seg in spool.segments()) <= 300
+        assert spool.counters['discarded_bytes'] > 0
+        records = [data for data, _ in spool.read(1000)]
+        # The newest records are kept, in order
+        assert records[-1] == b'record 0099'
+        assert records == sorted(records)
+
+    def test_transient_failure_keeps_position(self):
+        spool = self._spool()
+        for i in range(4):
+            spool.append('record {0}'.format(i))
+        deliverer = Deliverer(fail_after=2)
+        drainer = SpoolDrainer(spool, deliverer)
+        assert not drainer.drain()
+        deliverer.fail_after = None
+        assert drainer.drain()
+        assert deliverer.delivered == [b'record 0', b'record 1', b'record 2', b'record 3']
+
+    def test_rejected_records_are_skipped(self):
+        spool = self._spool()
+        for i in range(3):
+            spool.append('record {0}'.format(i))
+        deliverer = Deliverer(reject=(b'record 1',))
+        assert SpoolDrainer(spool, deliverer).drain()
+        assert deliverer.delivered == [b'record 0', b'record 2']
+        assert spool.counters['rejected'] == 1
+
+    def test_corrupt_record(self):
+        spool = self._spool()
+        spool.append('record 0')
+        spool.append('record 1')
+        spool.close()
+        path = spool._path(spool.segments()[-1])
+        with open(path, 'r+b') as fh_:
+            fh_.seek(-1, os.SEEK_END)
+            fh_.write(b'X')
+        assert [data for data, _ in spool.read()] == [b'record 0']
+        # Appends after the damage are still readable
+        spool.append('record 2')
+        assert [data for data, _ in spool.read()] == [b'record 0', b'record 2']
+
+    def test_unknown_record_kind_is_rejected(self):
+        try:
+            deliver_record(json.dumps({'kind': 'nope'}).encode('utf-8'))
+        except SpoolRecordRejected:
+            pass
+        else:
+            assert False, 'expected SpoolRecordRejected'
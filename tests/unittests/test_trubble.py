@@ -0,0 +1,415 @@
+import sys
+import os
+import json
+import shutil
+import tempfile
+import threading
+import time
+myPath = os.path.abspath(os.getcwd())
+sys.path.insert(0, myPath)
+
+from trubblestack import fsupdate
+from trubblestack.extmods.modules import trubble
+from trubblestack.extmods.modules.nova_loader import ProfileIndex
+
+
+class FakeNova(object):
+
+    def __init__(self, modules):
+        self.__data__ = {'/cis/centos-7.yaml': {'grep': 'centos'},
+                         '/cis/docker.yaml': {'grep': 'docker'},
+                         '/misc/docker.yaml': {'grep': 'misc'}}
+        self._dict = modules
+        self.profile_index = ProfileIndex(self.__data__)
+
+
+class TestRunAudits():
+
+    def setup_method(self):
+        self.calls = []
+        # One worker, so the modules run in a predictable order
+        config = {'trubblestack:nova:autoload': False, 'trubblestack:nova:workers': 1}
+        trubble.__salt__ = {'config.get': lambda key, default=None: config.get(key, default)}
+        trubble.__grains__ = {'osfinger': 'CentOS Linux-7'}
+
+    def _tagged(self, data_list, tags, labels, **kwargs):
+        self.calls.append(sorted(name for name, _ in data_list))
+        return {'Success': [{'tag': 'CIS-1', 'nova_profile': name}
+                            for name, _ in sorted(data_list)]}
+
+    def _two_tags(self, data_list, tags, labels, **kwargs):
+        self.calls.append(tags)
+        return {'Success': [{'tag': tag, 'nova_profile': name}
+                            for name, _ in sorted(data_list) for tag in ('CIS-1', 'CIS-2')]}
+
+    def _untagged(self, data_list, tags, labels, **kwargs):
+        self.calls.append(sorted(name for name, _ in data_list))
+        return {'Failure': [{'tag': 'CIS-2'} for _ in data_list]}
+
+    def test_single_pass(self):
+        trubble.__nova__ = FakeNova({'grep.audit': self._tagged})
+        ret = trubble._run_audits([['/cis/centos-7'], ['/cis'], ['/nothing']], '*', False, None)
+        # One run over the union of the profiles
+        assert self.calls == [['centos-7', 'docker']]
+        assert ret[0] == {'Success': [{'tag': 'CIS-1', 'nova_profile': 'centos-7'}]}
+        assert len(ret[1]['Success']) == 2
+        assert ret[0]['Success'][0] is not ret[1]['Success'][0]
+        assert ret[2] == {'Errors': [{'/nothing': {'error': 'No matching profiles '
+                                                            'found for /nothing'}}]}
+        assert trubble._run_audit(['/cis/centos-7'], '*', False, None) == ret[0]
+
+    def test_fallback_per_audit(self):
+        trubble.__nova__ = FakeNova({'grep.audit': self._untagged})
+        ret = trubble._run_audits([['/cis/centos-7'], ['/cis']], '*', False, None)
+        assert self.calls == [['centos-7', 'docker'], ['centos-7'], ['centos-7', 'docker']]
+        assert len(ret[0]['Failure']) == 1
+        assert len(ret[1]['Failure']) == 2
+
+    def test_ambiguous_profile_name(self):
+        # Both docker profiles have the same name, results can't be split
+        trubble.__nova__ = FakeNova({'grep.audit': self._tagged})
+        ret = trubble._run_audits([['/cis/docker'], ['/misc/docker']], '*', False, None)
+        assert self.calls == [['docker', 'docker'], ['docker'], ['docker']]
+        assert len(ret[0]['Success']) == 1
+        assert len(ret[1]['Success']) == 1
+
+    def test_tag_globs(self):
+        trubble.__nova__ = FakeNova({'grep.audit': self._two_tags})
+        ret = trubble._run_audits([['/cis/centos-7'], ['/cis/centos-7'], ['/cis']],
+                                  ['CIS-1', 'CIS-2', '*'], False, None)
+        # One run with all the tags
+        assert self.calls == ['*']
+        assert ret[0] == {'Success': [{'tag': 'CIS-1', 'nova_profile': 'centos-7'}]}
+        assert ret[1] == {'Success': [{'tag': 'CIS-2', 'nova_profile': 'centos-7'}]}
+        assert len(ret[2]['Success']) == 4
+
+    def test_top(self):
+        trubble.__nova__ = FakeNova({'grep.audit': self._two_tags})
+        get_top_data = trubble._get_top_data
+        trubble._get_top_data = lambda topfile: ['cis.docker', {'cis.centos-7': 'CIS-1'}]
+        try:
+            ret = trubble.top()
+        finally:
+            trubble._get_top_data = get_top_data
+        assert self.calls == ['*']
+        assert sorted(ret['Success']) == [{'CIS-1': None}, {'CIS-1': None}, {'CIS-2': None}]
+
+    def test_audit_batch(self):
+        trubble.__nova__ = FakeNova({'grep.audit': self._tagged})
+        ret = trubble.audit_batch([{'name': 'centos', 'args': ['cis.centos-7']},
+                                   {'name': 'cis', 'args': [], 'kwargs': {'configs': 'cis',
+                                                                          'show_success': False}}])
+        assert self.calls == [['centos-7', 'docker']]
+        assert ret['centos']['Success'] == [{'CIS-1': None}]
+        assert 'Success' not in ret['cis']
+        assert ret['cis']['Compliance'] == '100%'
+
+
+class TestRunModules():
+
+    def setup_method(self):
+        self.config = {'trubblestack:nova:autoload': False,
+                       'trubblestack:nova:module_timeout': 5,
+                       'trubblestack:nova:module_timeouts': {'hang': 0.2}}
+        trubble.__salt__ = {'config.get': lambda key, default=None: self.config.get(key, default)}
+        trubble.__grains__ = {'osfinger': 'CentOS Linux-7'}
+        self.release = threading.Event()
+
+    def teardown_method(self):
+        self.release.set()
+
+    def _success(self, data_list, tags, labels, **kwargs):
+        return {'Success': [{'tag': 'CIS-1', 'nova_profile': name}
+                            for name, _ in sorted(data_list)]}
+
+    def _hang(self, data_list, tags, labels, **kwargs):
+        self.release.wait(5)
+        return {'Success': [{'tag': 'CIS-3'}]}
+
+    def _bad(self, data_list, tags, labels, **kwargs):
+        return 'not a dict'
+
+    def test_concurrent(self):
+        barrier = []
+        both = threading.Event()
+
+        def _wait(data_list, tags, labels, **kwargs):
+            barrier.append(1)
+            if len(barrier) == 2:
+                both.set()
+            if not both.wait(2):
+                return {}
+            return {'Success': [{'tag': 'CIS-{0}'.format(len(barrier))}]}
+
+        trubble.__nova__ = FakeNova({'a.audit': _wait, 'b.audit': _wait})
+        ret = trubble._run_audit(['/cis/centos-7'], '*', False, None)
+        assert len(ret['Success']) == 2
+
+    def test_shared_pkg_inventory(self):
+        inventories = []
+
+        def _inventory(data_list, tags, labels, **kwargs):
+            inventories.append(kwargs['pkg_inventory'])
+            return {}
+
+        trubble.__nova__ = FakeNova({'a.audit': _inventory, 'b.audit': _inventory})
+        trubble._run_audit(['/cis/centos-7'], '*', False, None)
+        assert len(inventories) == 2
+        assert inventories[0] is inventories[1]
+
+    def test_hung_module(self):
+        trubble.__nova__ = FakeNova({'hang.audit': self._hang, 'grep.audit': self._success,
+                                     'bad.audit': self._bad})
+        ret = trubble._run_audit(['/cis/centos-7'], '*', False, None)
+        assert ret['Success'] == [{'tag': 'CIS-1', 'nova_profile': 'centos-7'}]
+        errors = dict(error.items()[0] for error in ret['Errors'])
+        assert errors['hang.audit']['error'] == 'timed out'
+        assert errors['bad.audit']['error'] == 'bad return type'
+        assert trubble.REGISTRY.get('trubble_nova_module_seconds',
+                                    {'module': 'hang.audit', 'status': 'timeout'})[1] == 1
+
+        # Not started again while the previous run is still going
+        ret = trubble._run_audit(['/cis/centos-7'], '*', False, None)
+        errors = dict(error.items()[0] for error in ret['Errors'])
+        assert errors['hang.audit']['error'] == 'still running since a previous audit'
+
+        self.release.set()
+        for _ in range(50):
+            if 'hang.audit' not in trubble._HUNG:
+                break
+            time.sleep(0.1)
+        assert 'hang.audit' not in trubble._HUNG
+
+
+class FakeModule(object):
+
+    def __init__(self, inputs):
+        self.inputs = inputs
+
+
+class TestResultCache():
+
+    def setup_method(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sshd_config')
+        with open(self.path, 'w') as fh_:
+            fh_.write('PermitRootLogin no\n')
+        self.config = {'trubblestack:nova:autoload': False, 'trubblestack:nova:workers': 1}
+        trubble.__salt__ = {'config.get': lambda key, default=None: self.config.get(key, default)}
+        trubble.__grains__ = {'osfinger': 'CentOS Linux-7'}
+        trubble.__opts__ = {'cachedir': self.tmpdir}
+        trubble._RESULTS.update({'path': None, 'entries': {}, 'dirty': False})
+        self.calls = []
+        self.inputs = [('file', self.path)]
+        trubble.__nova__ = FakeNova({'grep.audit': self._audit})
+        trubble.__nova__.modules = {'grep.audit': FakeModule(lambda *args, **kwargs: self.inputs)}
+
+    def teardown_method(self):
+        trubble._RESULTS.update({'path': None, 'entries': {}, 'dirty': False})
+        shutil.rmtree(self.tmpdir)
+
+    def _audit(self, data_list, tags, labels, **kwargs):
+        self.calls.append(tags)
+        return {'Success': [{'tag': 'CIS-1', 'nova_profile': name} for name, _ in data_list]}
+
+    def test_reuses_results(self):
+        ret = trubble._run_audit(['/cis/centos-7'], '*', False, None)
+        assert trubble._run_audit(['/cis/centos-7'], '*', False, None) == ret
+        assert len(self.calls) == 1
+        # Different arguments
+        trubble._run_audit(['/cis/centos-7'], 'CIS*', False, None)
+        assert len(self.calls) == 2
+
+        # Read back from the cachedir
+        assert os.path.isfile(os.path.join(self.tmpdir, trubble.RESULT_CACHE))
+        trubble._RESULTS.update({'path': None, 'entries': {}, 'dirty': False})
+        assert trubble._run_audit(['/cis/centos-7'], '*', False, None) == ret
+        assert len(self.calls) == 2
+
+        with open(self.path, 'a') as fh_:
+            fh_.write('Protocol 2\n')
+        trubble._run_audit(['/cis/centos-7'], '*', False, None)
+        assert len(self.calls) == 3
+
+        trubble._run_audit(['/cis/centos-7'], '*', False, None, force_full=True)
+        assert len(self.calls) == 4
+
+    def test_full_runs(self):
+        self.config['trubblestack:nova:full_audit_interval'] = 0
+        trubble._run_audit(['/cis/centos-7'], '*', False, None)
+        trubble._run_audit(['/cis/centos-7'], '*', False, None)
+        assert len(self.calls) == 2
+
+        # Modules which can't tell their inputs always run
+        self.config['trubblestack:nova:full_audit_interval'] = 3600
+        self.inputs = None
+        trubble._run_audit(['/cis/centos-7'], '*', False, None)
+        trubble._run_audit(['/cis/centos-7'], '*', False, None)
+        assert len(self.calls) == 4
+
+
+class TestSync():
+
+    def setup_method(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.fetched = []
+        self.remote = {'trubblestack_nova_profiles/cis/centos-7.yaml': 'aaa',
+                       'trubblestack_nova_profiles/cis/docker.yaml': 'bbb'}
+        config = {}
+        trubble.__opts__ = {'cachedir': self.cachedir, 'install_dir': self.cachedir}
+        trubble.__salt__ = {'config.get': lambda key, default=None: config.get(key, default),
+                            'cp.cache_file': self._cache_file}
+        self._publish(1)
+
+    def teardown_method(self):
+        shutil.rmtree(self.cachedir)
+
+    def _publish(self, generation):
+        with open(fsupdate.snapshot_path(self.cachedir), 'w') as fh_:
+            json.dump({'generation': generation, 'digest': str(generation),
+                       'published': time.time(),
+                       'files': {'base': dict(self.remote, **{'top.sls': 'ccc'})}}, fh_)
+
+    def _cache_file(self, path, saltenv='base'):
+        path = path.partition('salt://')[2]
+        self.fetched.append(path)
+        local = os.path.join(self.cachedir, 'files', saltenv, path)
+        if not os.path.isdir(os.path.dirname(local)):
+            os.makedirs(os.path.dirname(local))
+        with open(local, 'w') as fh_:
+            fh_.write(self.remote[path])
+        return local
+
+    def test_sync_changed_files(self):
+        ret = trubble.sync()
+        assert ret == ['/trubblestack_nova_profiles/cis/centos-7.yaml',
+                       '/trubblestack_nova_profiles/cis/docker.yaml']
+        assert sorted(self.fetched) == sorted(self.remote)
+
+        # Same snapshot, nothing is checked
+        self.fetched = []
+        assert trubble.sync() == ret
+        assert self.fetched == []
+
+        self.remote['trubblestack_nova_profiles/cis/centos-7.yaml'] = 'ddd'
+        del self.remote['trubblestack_nova_profiles/cis/docker.yaml']
+        self._publish(2)
+        ret = trubble.sync()
+        assert ret == ['/trubblestack_nova_profiles/cis/centos-7.yaml']
+        assert self.fetched == ['trubblestack_nova_profiles/cis/centos-7.yaml']
+        profiles = os.path.join(self.cachedir, 'files', 'base', 'trubblestack_nova_profiles')
+        assert os.listdir(os.path.join(profiles, 'cis')) == ['centos-7.yaml']
+
+    def test_sync_after_unpublished_update(self):
+        trubble.sync()
+        # A single function run updated the fileserver cache, without
+        # publishing a snapshot
+        self.remote['trubblestack_nova_profiles/cis/centos-7.yaml'] = 'ddd'
+        fsupdate.mark_updated(self.cachedir)
+        trubble.__salt__['cp.list_master'] = lambda saltenv='base', prefix='': \
+            sorted(path for path in self.remote if path.startswith(prefix))
+        trubble.__salt__['cp.hash_file'] = lambda path, saltenv='base': \
+            {'hsum': self.remote[path.partition('salt://')[2]]}
+        self.fetched = []
+        trubble.sync()
+        assert self.fetched == ['trubblestack_nova_profiles/cis/centos-7.yaml']
+
+
+class TestProfileIndex():
+
+    def test_resolve(self):
+        index = ProfileIndex(['/cis/centos-7.yaml', '/cis/docker.yaml', '/cis.yaml',
+                              '/misc/docker.yaml'])
+        assert index.resolve('/cis/centos-7') == set(['/cis/centos-7.yaml'])
+        assert index.resolve('/cis') == set(['/cis/centos-7.yaml', '/cis/docker.yaml',
+                                             '/cis.yaml'])
+        assert len(index.resolve('/')) == 4
+        assert not index.resolve('/cis/centos')
+        assert not index.resolve('/nothing/docker')
+
+
+class TestTopData():
+
+    def setup_method(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.matched = []
+        profiles = os.path.join(self.cachedir, 'files', 'base', 'trubblestack_nova_profiles')
+        os.makedirs(profiles)
+        with open(os.path.join(profiles, 'top.nova'), 'w') as fh_:
+            fh_.write("nova:\n  '*':\n    - cis.centos-7\n  'G@os:Windows':\n    - win\n")
+        trubble.__opts__ = {'cachedir': self.cachedir, 'install_dir': self.cachedir,
+                            'grains_generation': 1}
+        trubble.__salt__ = {'config.get': lambda key, default=None: default,
+                            'match.compound': self._match}
+        trubble._TOP_CACHE.clear()
+
+    def teardown_method(self):
+        shutil.rmtree(self.cachedir)
+
+    def _match(self, match):
+        self.matched.append(match)
+        return match == '*'
+
+    def test_cached_per_grains_generation(self):
+        assert trubble._get_top_data('top.nova') == ['cis.centos-7']
+        assert len(self.matched) == 2
+        assert trubble._get_top_data('top.nova') == ['cis.centos-7']
+        assert len(self.matched) == 2
+
+        trubble.__opts__['grains_generation'] = 2
+        assert trubble._get_top_data('top.nova') == ['cis.centos-7']
+        assert len(self.matched) == 4
+
+        # Not cached outside of the daemon
+        del trubble.__opts__['grains_generation']
+        trubble._get_top_data('top.nova')
+        trubble._get_top_data('top.nova')
+        assert len(self.matched) == 8
+
+
+class TestAuditPlan():
+
+    def setup_method(self):
+        self.data_list = [
+            ('centos-7', {'grep': {'whitelist': {'tmp': {'data': {'CentOS Linux-7': ['centos'],
+                                                                  '*': ['any']},
+                                                         'labels': ['critical']}}},
+                          'sysctl': {'forwarding': {'data': {'Ubuntu*, CentOS*': ['sysctl']}},
+                                     'other': {'data': {'Debian-9': ['debian']}}}}),
+            ('docker', {'grep': {'blacklist': {'docker': {'data': {'*': ['docker']}}}}})]
+
+    def test_section(self):
+        plan = trubble.AuditPlan(self.data_list, None, 'CentOS Linux-7')
+        grep = plan.section('grep', ('blacklist', 'whitelist'))['grep']
+        assert grep['whitelist'] == [{'tmp': {'data': {'*': ['centos']}, 'labels': ['critical'],
+                                              'nova_profile': 'centos-7'}}]
+        assert grep['blacklist'] == [{'docker': {'data': {'*': ['docker']},
+                                                 'nova_profile': 'docker'}}]
+        sysctl = dict(check.items()[0] for check in plan.section('sysctl')['sysctl'])
+        assert sysctl['forwarding']['data'] == {'*': ['sysctl']}
+        assert sysctl['other']['data'] == {}
+        assert plan.section('grep', ('blacklist', 'whitelist')) is \
+            plan.section('grep', ('blacklist', 'whitelist'))
+        # The profiles are left alone
+        assert 'nova_profile' not in self.data_list[0][1]['grep']['whitelist']['tmp']
+
+    def test_labels(self):
+        plan = trubble.AuditPlan(self.data_list, ['critical'], 'Ubuntu-16.04')
+        grep = plan.section('grep', ('blacklist', 'whitelist'))['grep']
+        assert grep == {'whitelist': [{'tmp': {'data': {'*': ['any']}, 'labels': ['critical'],
+                                               'nova_profile': 'centos-7'}}],
+                        'blacklist': []}
+        assert plan.section('sysctl') == {'sysctl': []}
+        assert len(plan.section('sysctl', labels=False)['sysctl']) == 2
+
+    def test_tag_filters(self):
+        self.data_list[1][1]['grep']['blacklist']['docker']['data']['*'] = [
+            {'/etc/docker': {'tag': 'CIS-1'}}, {'/etc/default/docker': 'CIS-2'}]
+        self.data_list[1][1]['misc'] = {'daemon': {'data': {'*': {'tag': 'CIS-3'}}}}
+        plan = trubble.AuditPlan(self.data_list, None, 'CentOS Linux-7',
+                                 {'docker': ['CIS-2', 'CIS-4']})
+        grep = plan.section('grep', ('blacklist', 'whitelist'))['grep']
+        assert grep['blacklist'][0]['docker']['data'] == {'*': [{'/etc/default/docker': 'CIS-2'}]}
+        # Other profiles are left alone
+        assert grep['whitelist'][0]['tmp']['data'] == {'*': ['centos']}
+        assert plan.section('misc') == {'misc': []}
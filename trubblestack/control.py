@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+'''
+UNIX domain control socket of the trubble daemon.
+
+Single function runs (``trubble <function>``) forward the function to a
+running daemon through this socket instead of starting cold, so they
+benefit from the daemon's loaded modules, grains, ``__context__`` and synced
+profiles.
+
+The socket is only accessible by its owner (mode 0600), and the daemon also
+checks the peer credentials of each connection where the platform provides
+them.
+
+Messages are framed by a 4-byte length. Requests are json, as the daemon
+must not unpickle what clients send. Replies are pickled, so the client gets
+the exact python objects the function returned; the client checks the owner
+of the socket before connecting.
+
+.. code-block:: yaml
+
+    control_socket: /var/cache/trubble/control.sock
+    control_max_clients: 8
+'''
+
+import json
+import logging
+import os
+import pickle
+import socket
+import struct
+import threading
+
+log = logging.getLogger(__name__)
+
+FRAME = struct.Struct('>I')
+MAX_REQUEST_BYTES = 1024 * 1024
+# Seconds between the daemon's "still running" replies
+HEARTBEAT_INTERVAL = 5
+
+
+class ControlUnavailable(Exception):
+    '''
+    No daemon is listening on the control socket, or it refused the request
+    '''
+
+
+def _recv_exact(conn, size):
+    chunks = []
+    while size:
+        chunk = conn.recv(min(size, 65536))
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def send_frame(conn, data):
+    conn.sendall(FRAME.pack(len(data)) + data)
+
+
+def recv_frame(conn, max_bytes=None):
+    size = FRAME.unpack(_recv_exact(conn, FRAME.size))[0]
+    if max_bytes is not None and size > max_bytes:
+        raise ValueError('frame of {0} bytes is too large'.format(size))
+    return _recv_exact(conn, size)
+
+
+def _peer_uid(conn):
+    '''
+    uid of the process at the other end of ``conn``, or None if the platform
+    can't tell
+    '''
+    so_peercred = getattr(socket, 'SO_PEERCRED', None)
+    if so_peercred is None:
+        return None
+    creds = conn.getsockopt(socket.SOL_SOCKET, so_peercred, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+class ControlServer(object):
+    '''
+    Accepts connections on ``path`` and calls ``handler(request, send)`` for
+    each request in its own thread. ``send(message)`` streams a reply to the
+    client.
+    '''
+
+    def __init__(self, path, handler, max_clients=8):
+        self.path = path
+        self.handler = handler
+        self.max_clients = max(1, int(max_clients))
+        self._clients = threading.BoundedSemaphore(self.max_clients)
+        self._sock = None
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            log.info('UNIX domain sockets are not available, not starting the '
+                     'control socket')
+            return False
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        if os.path.exists(self.path):
+            # Left over by a daemon which didn't shut down cleanly
+            os.remove(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.path, 0o600)
+        sock.listen(self.max_clients)
+        self._sock = sock
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._serve, name='trubble-control')
+        self._thread.daemon = True
+        self._thread.start()
+        log.info('Listening on control socket {0}'.format(self.path))
+        return True
+
+    def stop(self):
+        if self._sock is None or os.getpid() != self._pid:
+            # Forked workers inherit the socket, but don't own it
+            return
+        sock, self._sock = self._sock, None
+        try:
+            # Wakes up the accept() in the serving thread
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        sock.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _serve(self):
+        sock = self._sock
+        while self._sock is not None:
+            try:
+                conn, _ = sock.accept()
+            except socket.error:
+                if self._sock is None:
+                    break
+                log.exception('Error accepting a control connection')
+                continue
+            thread = threading.Thread(target=self._handle, args=(conn,),
+                                      name='trubble-control-client')
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, conn):
+        def send(message):
+            send_frame(conn, pickle.dumps(message, 2))
+
+        try:
+            uid = _peer_uid(conn)
+            if uid is not None and uid not in (0, os.getuid()):
+                log.warning('Refusing control connection from uid {0}'.format(uid))
+                send({'status': 'refused', 'error': 'permission denied'})
+                return
+            if not self._clients.acquire(False):
+                send({'status': 'refused', 'error': 'too many clients'})
+                return
+            try:
+                request = json.loads(recv_frame(conn, MAX_REQUEST_BYTES).decode('utf-8'))
+                if not isinstance(request, dict):
+                    raise ValueError('request must be a dict')
+                self.handler(request, send)
+            finally:
+                self._clients.release()
+        except (socket.error, EOFError) as exc:
+            log.info('Control client went away: {0}'.format(exc))
+        except Exception as exc:
+            log.exception('Error handling a control request')
+            try:
+                send({'status': 'error', 'error': str(exc)})
+            except (socket.error, EOFError):
+                pass
+        finally:
+            conn.close()
+
+
+def request(path, message, connect_timeout=5):
+    '''
+    Send ``message`` to the daemon listening on ``path`` and yield its
+    replies until the connection closes.
+
+    Raises :class:`ControlUnavailable` if there is no daemon to talk to, or
+    it refused the request.
+    '''
+    if not hasattr(socket, 'AF_UNIX'):
+        raise ControlUnavailable('UNIX domain sockets are not available')
+    try:
+        owner = os.stat(path).st_uid
+    except OSError:
+        raise ControlUnavailable('no control socket at {0}'.format(path))
+    if owner not in (0, os.geteuid()):
+        raise ControlUnavailable('control socket {0} is owned by uid {1}'
+                                 .format(path, owner))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(connect_timeout)
+        try:
+            sock.connect(path)
+            send_frame(sock, json.dumps(message).encode('utf-8'))
+        except socket.error as exc:
+            raise ControlUnavailable('could not connect to {0}: {1}'.format(path, exc))
+        # The daemon sends heartbeats while the function runs, so a silent
+        # connection means the daemon is stuck
+        sock.settimeout(HEARTBEAT_INTERVAL * 12)
+        first = True
+        while True:
+            try:
+                reply = pickle.loads(recv_frame(sock))
+            except EOFError:
+                if first:
+                    raise ControlUnavailable('daemon closed the connection')
+                raise
+            if first and reply.get('status') == 'refused':
+                raise ControlUnavailable('daemon refused the request: {0}'
+                                         .format(reply.get('error')))
+            first = False
+            yield reply
+            if reply.get('status') in ('done', 'error'):
+                return
+    finally:
+        sock.close()
+
+
+class PendingRun(object):
+    '''
+    Result of a control request running in the job pool
+    '''
+
+    def __init__(self):
+        self.result = None
+        self._done = threading.Event()
+
+    def finish(self, result):
+        self.result = result
+        self._done.set()
+
+    def wait(self, timeout=None):
+        '''
+        Wait for the result. Returns False if it is still running after
+        ``timeout`` seconds.
+        '''
+        self._done.wait(timeout)
+        return self._done.is_set()
@@ -7,17 +7,16 @@ from __future__ import print_function
 # import lockfile
 import argparse
 import copy
+import itertools
 import logging
 import time
 import pprint
 import os
-import random
 import signal
+import socket
 import sys
 import uuid
 import json
-import socket
-import math
 
 import salt.fileclient
 import salt.fileserver
@@ -27,23 +26,44 @@ import salt.utils.platform
 import salt.utils.jid
 import salt.utils.gitfs
 import salt.log.setup
+import trubblestack.grainloader
 import trubblestack.splunklogging
 from trubblestack import __version__
-from croniter import croniter
-from datetime import datetime
+from trubblestack import fsupdate, governor
 from trubblestack.hangtime import hangtime_wrapper
+from trubblestack.control import ControlServer, ControlUnavailable, HEARTBEAT_INTERVAL, PendingRun
+from trubblestack.control import request as control_request
+from trubblestack.dispatch import ReturnerDispatcher
+from trubblestack.jobpool import JobPool, JobRun
+from trubblestack.metrics import REGISTRY, MetricsHTTPServer, largest_keys, record_job, \
+    record_returner, rss_bytes
+from trubblestack.scheduler import Scheduler
+from trubblestack.spool import SpoolDrainer, deliver_record, returner_spool
 
 log = logging.getLogger(__name__)
 
 __opts__ = {}
 # This should work fine until we go to multiprocessing
 SESSION_UUID = str(uuid.uuid4())
+SCHEDULER = Scheduler()
+POOL = None
+DISPATCHER = None
+SPOOL_DRAINER = None
+CONTROL = None
+FS_UPDATER = None
+CONTROL_RUNS = itertools.count(1)
+LOADER_SIGNATURE = None
+# Largest __context__ keys as of the last memory report
+CONTEXT_REPORT = []
+# Startup phases of single function runs, reported with --timing
+STARTUP_TIMING = {'started': time.time(), 'phases': []}
 
 
 def run():
     '''
     Set up program, daemonize if needed
     '''
+    STARTUP_TIMING['started'] = time.time()
     # Don't put anything that needs config or logging above this line
     try:
         load_config()
@@ -81,9 +101,19 @@ def main():
     '''
     Run the main trubble loop
     '''
+    fileclient_started = time.time()
+    # Single function runs can use the fileserver cache as is if the daemon
+    # (or a previous run) updated it recently
+    skip_update = False
+    if __opts__['function'] and __opts__.get('fast_start', True):
+        max_age = __opts__.get('fast_start_fileserver_max_age',
+                               __opts__['fileserver_update_frequency'])
+        skip_update = _fileserver_age() < max_age
+
     # Initial fileclient setup
     # Clear old locks
-    if 'gitfs' in __opts__['fileserver_backend'] or 'git' in __opts__['fileserver_backend']:
+    if not skip_update and ('gitfs' in __opts__['fileserver_backend'] or
+                            'git' in __opts__['fileserver_backend']):
         git_objects = [
             salt.utils.gitfs.GitFS(
                 __opts__,
@@ -116,7 +146,11 @@ def main():
     while True:
         try:
             fc = salt.fileclient.get_file_client(__opts__)
-            fc.channel.fs.update()
+            if skip_update:
+                log.debug('Fileserver was updated recently, skipping the update')
+            else:
+                fc.channel.fs.update()
+                _mark_fileserver_update()
             last_fc_update = time.time()
             break
         except Exception as exc:
@@ -133,88 +167,97 @@ def main():
 
     # Check for single function run
     if __opts__['function']:
+        _startup_timing('fileclient', fileclient_started,
+                        'update skipped' if skip_update else None)
         run_function()
         sys.exit(0)
 
     last_grains_refresh = time.time() - __opts__['grains_refresh_frequency']
 
+    if __opts__.get('resource_cgroups', True):
+        # Before forking any worker, which would end up in the daemon's cgroup
+        governor.setup_cgroups()
+
+    global POOL
+    # Worker processes are forked by this thread only, slot threads which need
+    # one wake it up
+    POOL = JobPool(_run_job, lanes=__opts__.get('scheduler_lanes'),
+                   on_complete=_job_complete, registry=REGISTRY, wake=SCHEDULER.wake)
+    _get_dispatcher()
+    _start_spool_drainer()
+    _start_control_server()
+    _start_metrics()
+    last_metrics_write = 0
+    last_memory_report = time.time()
+    memory_report_interval = __opts__.get('memory_report_interval', 3600)
+
+    # The fileserver is updated in the background from now on
+    global FS_UPDATER
+    FS_UPDATER = fsupdate.FileserverUpdater(fc, __opts__['cachedir'],
+                                            __opts__['fileserver_update_frequency'],
+                                            retry_interval=__opts__.get('fileserver_retry_rate',
+                                                                        900),
+                                            registry=REGISTRY,
+                                            on_update=_mark_fileserver_update)
+    FS_UPDATER.start(next_update=last_fc_update + __opts__['fileserver_update_frequency'])
+
     log.info('Starting main loop')
     while True:
-        # Check if fileserver needs update
-        if time.time() - last_fc_update >= __opts__['fileserver_update_frequency']:
-            try:
-                fc.channel.fs.update()
-                last_fc_update = time.time()
-            except Exception as exc:
-                retry = __opts__.get('fileserver_retry_rate', 900)
-                last_fc_update += retry
-                log.exception('Exception thrown trying to update fileclient. '
-                              'Trying again in {0} seconds.'
-                              .format(retry))
-
         if time.time() - last_grains_refresh >= __opts__['grains_refresh_frequency']:
             log.info('Refreshing grains')
-            refresh_grains()
+            # Jobs in thread lanes (pulsar) use the globals being refreshed
+            with POOL.paused():
+                refresh_grains()
             last_grains_refresh = time.time()
+            # Worker processes were forked with the old grains and loaders
+            POOL.recycle()
+            log.info('Returner dispatch stats: {0}'.format(_get_dispatcher().stats()))
+            if SPOOL_DRAINER is not None:
+                log.info('Returner spool stats: {0}, {1} bytes pending'
+                         .format(SPOOL_DRAINER.spool.counters,
+                                 SPOOL_DRAINER.spool.pending_bytes()))
+        POOL.start()
+        POOL.serve_forks()
 
         try:
             log.debug('Executing schedule')
-            schedule()
+            sleep_time = schedule()
         except Exception as e:
             log.exception('Error executing schedule')
-        time.sleep(__opts__.get('scheduler_sleep_frequency', 0.5))
-
-def getsecondsbycronexpression(base, cron_exp):
-    '''
-    this function will return the seconds according to the cron
-    expression provided in the trubble config
-    '''
-    iter = croniter(cron_exp, base)
-    next_datetime  = iter.get_next(datetime)
-    epoch_base_datetime = time.mktime(base.timetuple())
-    epoch_datetime = time.mktime(next_datetime.timetuple())
-    seconds = int(epoch_datetime) - int(epoch_base_datetime)
-    return seconds
-
-def getlastrunbycron(base, seconds):
-    '''
-    this function will use the cron_exp provided in the trubble config to
-    execute the trubble processes as per the scheduled cron time
-    '''
-    epoch_base_datetime = time.mktime(base.timetuple())
-    epoch_datetime = epoch_base_datetime
-    current_time = time.time()
-    while (epoch_datetime + seconds) < current_time:
-        epoch_datetime = epoch_datetime + seconds
-    last_run = epoch_datetime
-    return last_run
-
-def getlastrunbybuckets(buckets, seconds):
-    '''
-    this function will use the host's ip to place the host in a bucket
-    where each bucket executes trubble processes at a different time
-    '''
-    buckets = int(buckets) if int(buckets)!=0 else 256
-    host_ip = socket.gethostbyname(socket.gethostname())
-    ips = host_ip.split('.')
-    sum = (int(ips[0])*256*256*256)+(int(ips[1])*256*256)+(int(ips[2])*256)+int(ips[3])
-    bucket = sum%buckets
-    log.debug('bucket number is {0} out of {1}'.format(bucket, buckets))
-    current_time = time.time()
-    base_time = seconds*(math.floor(current_time/seconds))
-    splay = seconds/buckets
-    seconds_between_buckets = splay
-    random_int = random.randint(0,splay-1) if splay !=0 else 0
-    bucket_execution_time = base_time+(seconds_between_buckets*bucket)+random_int
-    if bucket_execution_time < current_time:
-        last_run = bucket_execution_time
-    else:
-        last_run = bucket_execution_time - seconds
-    return last_run
+            sleep_time = __opts__.get('scheduler_sleep_frequency', 0.5)
+
+        if __opts__.get('metrics_textfile') and \
+                time.time() - last_metrics_write >= __opts__.get('metrics_interval', 15):
+            _write_metrics_textfile()
+            last_metrics_write = time.time()
+
+        if memory_report_interval and \
+                time.time() - last_memory_report >= memory_report_interval:
+            _memory_report()
+            last_memory_report = time.time()
+
+        # Sleep until the next job is due, but never past the next grains
+        # refresh or metrics write
+        next_maintenance = last_grains_refresh + __opts__['grains_refresh_frequency']
+        if __opts__.get('metrics_textfile'):
+            next_maintenance = min(next_maintenance,
+                                   last_metrics_write + __opts__.get('metrics_interval', 15))
+        if memory_report_interval:
+            next_maintenance = min(next_maintenance,
+                                   last_memory_report + memory_report_interval)
+        maintenance_sleep = max(0, next_maintenance - time.time())
+        if sleep_time is None or sleep_time > maintenance_sleep:
+            sleep_time = maintenance_sleep
+        SCHEDULER.wait(sleep_time)
 
 def schedule():
     '''
-    Rudimentary single-pass scheduler
+    Run any scheduled jobs which are due, and return the number of seconds
+    until the next job is due (None if nothing is scheduled).
+
+    Jobs are validated once when the schedule is loaded (or changes) and are
+    kept in a priority queue by :class:`trubblestack.scheduler.Scheduler`, so
+    calling this function when nothing is due is cheap.
 
     If we find we miss some of the salt scheduler features we could potentially
     pull in some of that code.
@@ -243,9 +286,9 @@ def schedule():
     function
         Function to run in the format ``<module>.<function>``. Technically any
         salt module can be run in this way, but we recommend sticking to trubble
-        functions. For simplicity, functions are run in the main daemon thread,
-        so overloading the scheduler can result in functions not being run in
-        a timely manner.
+        functions. Functions are run by the job pool (see
+        :mod:`trubblestack.jobpool`), not in the main daemon thread, so a long
+        running job does not delay other jobs in a different lane.
 
     seconds
         Frequency with which the job should be run, in seconds
@@ -269,122 +312,389 @@ def schedule():
     run_on_start
         Whether to run the scheduled job on daemon start. Defaults to False.
         Optional.
+
+    buckets
+        Spread the fleet over the ``seconds`` window. With a number, each host
+        is placed in one of that many buckets by a stable hash of its
+        ``trubble_uuid`` and runs at a random time within its bucket. With
+        ``spread``, each host runs at a fixed offset in the window derived from
+        that hash. For ``cron`` jobs, the window is the shortest interval
+        between two fire times, and the host's offset is added to each of
+        them. Optional.
+
+    fleet_size
+        Number of hosts running the job, for ``buckets: spread``. The window is
+        divided into one slot per host. Defaults to ``scheduler_fleet_size``.
+        Optional.
+
+    lane
+        Job pool lane to run the job in. Defaults to ``pulsar`` for pulsar
+        functions and ``default`` otherwise. Lanes are defined by
+        ``scheduler_lanes``. Optional.
+
+    max_concurrency
+        How many instances of the job may run at once. Defaults to 1.
+        Optional.
+
+    overlap
+        What to do when the job is due while ``max_concurrency`` instances are
+        still running: ``skip`` (default), ``queue`` or ``kill``. Optional.
+
+    nice, ionice, cpu_quota, memory_max_mb, max_loadavg, loadavg_pause, max_defer
+        Resource policy of the job: CPU and IO priority, cgroup v2 limits, and
+        deferring or pausing it while the load average is high. See
+        :mod:`trubblestack.governor`. Optional.
+
+    ``trubble.audit`` jobs of explicit configs which are due within
+    ``audit_coalesce_window`` seconds (default 60, 0 disables it) of each
+    other, and share a lane and resource policy, run as one audit pass; each
+    job's returners still get that job's results.
     '''
-    base = datetime(2018, 1, 1, 0, 0)
-    schedule_config = __opts__.get('schedule', {})
+    schedule_config = dict(__opts__.get('schedule', {}))
     if 'user_schedule' in __opts__ and isinstance(__opts__['user_schedule'], dict):
         schedule_config.update(__opts__['user_schedule'])
-    for jobname, jobdata in schedule_config.iteritems():
-        # Error handling galore
-        if not jobdata or not isinstance(jobdata, dict):
-            log.error('Scheduled job {0} does not have valid data'.format(jobname))
+    SCHEDULER.host_id = __opts__.get('trubble_uuid')
+    SCHEDULER.fleet_size = __opts__.get('scheduler_fleet_size')
+    if SCHEDULER.load(schedule_config):
+        log.info('Loaded {0} scheduled jobs'.format(len(SCHEDULER.jobs)))
+
+    due = []
+    for job in SCHEDULER.pop_due():
+        if job.function not in __salt__:
+            log.error('Scheduled job {0} has a function {1} which could not '
+                      'be found.'.format(job.name, job.function))
             continue
-        if 'function' not in jobdata or 'seconds' not in jobdata:
-            log.error('Scheduled job {0} is missing a ``function`` or '
-                      '``seconds`` argument'.format(jobname))
+        due.append(job)
+
+    window = __opts__.get('audit_coalesce_window', 60)
+    if window and any(_coalescible(job) for job in due):
+        due.extend(SCHEDULER.pop_early(window, lambda job: job not in due and _coalescible(job)))
+    for run in _coalesce(due):
+        log.debug('Executing scheduled function {0}'.format(run.function))
+        POOL.submit(run)
+
+    return SCHEDULER.seconds_until_next()
+
+
+def _coalescible(job):
+    '''
+    Whether ``job`` is an audit of explicit configs which can be merged with
+    other audits into a single pass
+    '''
+    if job.function != 'trubble.audit' or 'trubble.audit_batch' not in __salt__:
+        return False
+    if not job.args and not job.kwargs.get('configs'):
+        return False
+    return POOL.active(job.name) == 0
+
+
+def _coalesce(jobs):
+    '''
+    Turn due jobs into job runs. Coalescible audits running in the same lane
+    with the same resource policy are merged into one ``trubble.audit_batch``
+    run, so the checks they share run once. Its results are split back per
+    job for their returners.
+    '''
+    runs = []
+    groups = {}
+    for job in jobs:
+        run = JobRun.from_job(job)
+        if not _coalescible(job):
+            runs.append(run)
             continue
-        func = jobdata['function']
-        if func not in __salt__:
-            log.error('Scheduled job {0} has a function {1} which could not '
-                      'be found.'.format(jobname, func))
+        policy = dict((key, job.data.get(key)) for key in governor.POLICY_KEYS)
+        key = json.dumps([POOL.lane_for(run).name, policy], sort_keys=True)
+        if key not in groups:
+            groups[key] = []
+            runs.append(groups[key])
+        groups[key].append(run)
+
+    ret = []
+    for run in runs:
+        if not isinstance(run, list):
+            ret.append(run)
+        elif len(run) == 1:
+            ret.append(run[0])
+        else:
+            batch = run[0]
+            log.info('Coalescing audits {0} into one pass'
+                     .format(', '.join(member.name for member in run)))
+            jobs = [{'name': member.name, 'args': member.args, 'kwargs': member.kwargs}
+                    for member in run]
+            batch.name = '+'.join(member.name for member in run)
+            batch.function = 'trubble.audit_batch'
+            batch.args = [jobs]
+            batch.kwargs = {}
+            batch.context = [member.context for member in run]
+            ret.append(batch)
+    return ret
+
+
+def _run_job(func, args, kwargs):
+    '''
+    Run a scheduled function. This is the job pool's runner, so it may be
+    called in a worker process forked from the daemon.
+    '''
+    return __salt__[func](*args, **kwargs)
+
+
+def _job_complete(run, result):
+    '''
+    Handle the result of a scheduled job run by the job pool: log it and hand
+    it to the job's returners.
+    '''
+    job = run.context
+    if isinstance(job, PendingRun):
+        # Run on behalf of a control socket client, which gets the result
+        job.finish(result)
+        return
+    record_job(REGISTRY, run, result)
+    if not result.ok:
+        log.error('Scheduled job {0} ({1}) failed: {2}'.format(run.name,
+                                                              run.function,
+                                                              result.error))
+        return
+    ret = result.ret
+    log.debug('Scheduled job {0} finished in {1:.3f}s'.format(run.name, result.wall_time))
+    if __opts__['log_level'] == 'debug':
+        log.debug('Job returned:\n{0}'.format(ret))
+    if isinstance(job, list):
+        # Coalesced audits, each job returns its own part
+        for member in job:
+            _dispatch_returns(member, 'trubble.audit', member.args, member.kwargs,
+                              ret.get(member.name))
+        return
+    _dispatch_returns(job, run.function, run.args, run.kwargs, ret)
+
+
+def _dispatch_returns(job, function, args, kwargs, ret):
+    '''
+    Hand the return of a scheduled job to its returners
+    '''
+    for returner in job.returners:
+        returner = '{0}.returner'.format(returner)
+        if returner not in __returners__:
+            log.error('Could not find {0} returner.'.format(returner))
             continue
-        try:
-            if 'cron' in jobdata:
-                seconds = getsecondsbycronexpression(base, jobdata['cron'])
-            else:
-                seconds = int(jobdata['seconds'])
-            splay = int(jobdata.get('splay', 0))
-        except ValueError:
-            log.error('Scheduled job {0} has an invalid value for seconds or '
-                      'splay.'.format(jobname))
-        args = jobdata.get('args', [])
-        if not isinstance(args, list):
-            log.error('Scheduled job {0} has args not formed as a list: {1}'
-                      .format(jobname, args))
-        kwargs = jobdata.get('kwargs', {})
-        if not isinstance(kwargs, dict):
-            log.error('Scheduled job {0} has kwargs not formed as a dict: {1}'
-                      .format(jobname, kwargs))
-        returners = jobdata.get('returner', [])
-        if not isinstance(returners, list):
-            returners = [returners]
-        returner_retry = jobdata.get('returner_retry', False)
-
-        # Actually process the job
-        run = False
-        if 'last_run' not in jobdata:
-            if jobdata.get('run_on_start', False):
-                if splay:
-                    # Run `splay` seconds in the future, by telling the scheduler we last ran it
-                    # `seconds - splay` seconds ago.
-                    jobdata['last_run'] = time.time() - (seconds - random.randint(0, splay))
-                else:
-                    # Run now
-                    run = True
-                    jobdata['last_run'] = time.time()
-            else:
-                if splay:
-                    # Run `seconds + splay` seconds in the future by telling the scheduler we last
-                    # ran it at now + `splay` seconds.
-                    jobdata['last_run'] = time.time() + random.randint(0, splay)
-                elif 'buckets' in jobdata:
-                    # Place the host in a bucket and fix the execution time.
-                    jobdata['last_run'] = getlastrunbybuckets(jobdata['buckets'], seconds)
-                    log.debug('last_run according to bucket is {0}'.format(jobdata['last_run']))
-                elif 'cron' in jobdata:
-                    # execute the trubble process based on cron expression
-                    jobdata['last_run'] = getlastrunbycron(base, seconds)
-                else:
-                    # Run in `seconds` seconds.
-                    jobdata['last_run'] = time.time()
-
-        if jobdata['last_run'] < time.time() - seconds:
-            run = True
-
-        if run:
-            log.debug('Executing scheduled function {0}'.format(func))
-            jobdata['last_run'] = time.time()
-            ret = __salt__[func](*args, **kwargs)
-            if __opts__['log_level'] == 'debug':
-                log.debug('Job returned:\n{0}'.format(ret))
-            for returner in returners:
-                returner = '{0}.returner'.format(returner)
-                if returner not in __returners__:
-                    log.error('Could not find {0} returner.'.format(returner))
-                    continue
-                log.debug('Returning job data to {0}'.format(returner))
-                returner_ret = {'id': __grains__['id'],
-                                'jid': salt.utils.jid.gen_jid(__opts__),
-                                'fun': func,
-                                'fun_args': args + ([kwargs] if kwargs else []),
-                                'return': ret,
-                                'retry': returner_retry}
-                __returners__[returner](returner_ret)
+        log.debug('Returning job data to {0}'.format(returner))
+        _get_dispatcher().submit(returner, _returner_payload(function, args, kwargs,
+                                                             ret, job.returner_retry))
 
 
-def run_function():
+def _returner_payload(function, args, kwargs, ret, retry):
+    return {'id': __grains__['id'],
+            'jid': salt.utils.jid.gen_jid(__opts__),
+            'fun': function,
+            'fun_args': args + ([kwargs] if kwargs else []),
+            'return': ret,
+            'retry': retry}
+
+
+def _send_return(returner, returner_ret):
     '''
-    Run a single function requested by the user
+    Invoke a returner. Called from the returner dispatcher's sender threads.
+    '''
+    if returner not in __returners__:
+        raise KeyError('Could not find {0} returner.'.format(returner))
+    started = time.time()
+    ok = False
+    try:
+        __returners__[returner](returner_ret)
+        ok = True
+    finally:
+        record_returner(REGISTRY, returner, returner_ret.get('fun'), time.time() - started, ok)
+
+
+def _get_dispatcher():
+    '''
+    Return the returner dispatcher, starting it on first use
+    '''
+    global DISPATCHER
+    if DISPATCHER is None:
+        DISPATCHER = ReturnerDispatcher(
+            _send_return,
+            maxsize=__opts__.get('returner_queue_size', 1000),
+            workers=__opts__.get('returner_workers', 2),
+            backpressure=__opts__.get('returner_backpressure', 'block'),
+            spill_dir=os.path.join(__opts__['cachedir'], 'returner_spill'))
+        DISPATCHER.start()
+    return DISPATCHER
+
+
+def _start_metrics():
+    '''
+    Register the daemon's own metrics and start the HTTP endpoint, if enabled
+    '''
+    REGISTRY.add_collector(_daemon_metrics)
+    port = __opts__.get('metrics_http_port')
+    if not port:
+        return
+    try:
+        MetricsHTTPServer(REGISTRY, port, host=__opts__.get('metrics_http_host', '127.0.0.1')).start()
+    except (IOError, OSError, socket.error) as exc:
+        log.error('Could not start the metrics http endpoint on port {0}: {1}'.format(port, exc))
+
+
+def _daemon_metrics():
+    ret = [('trubble_rss_bytes', 'gauge', 'Resident set size of the daemon', None, rss_bytes())]
+    if DISPATCHER is not None:
+        stats = DISPATCHER.stats()
+        ret.extend([
+            ('trubble_returner_queue_depth', 'gauge', 'Returns waiting to be sent', None,
+             stats['queue_depth']),
+            ('trubble_returner_spill_depth', 'gauge', 'Returns spilled to disk', None,
+             stats['spill_depth']),
+            ('trubble_returner_dropped_total', 'counter', 'Returns dropped by backpressure', None,
+             stats['dropped']),
+        ])
+    if SPOOL_DRAINER is not None:
+        ret.append(('trubble_returner_spool_pending_bytes', 'gauge',
+                    'Returner spool data not delivered yet', None,
+                    SPOOL_DRAINER.spool.pending_bytes()))
+    for key, size in CONTEXT_REPORT:
+        ret.append(('trubble_context_key_bytes', 'gauge',
+                    'Approximate size of the largest __context__ keys of the daemon',
+                    {'key': key}, size))
+    return ret
+
+
+def _memory_report():
+    '''
+    Log the daemon's RSS and the largest keys of its ``__context__``, which
+    grows with what pulsar and the thread lanes cache there
+    '''
+    global CONTEXT_REPORT
+    started = time.time()
+    CONTEXT_REPORT = [(str(key), size) for key, size in
+                      largest_keys(__context__, __opts__.get('memory_report_top', 10))]
+    log.info('Memory report: RSS {0}, {1} __context__ keys, largest: {2} ({3:.2f}s)'
+             .format(_format_bytes(rss_bytes()), len(__context__),
+                     ', '.join('{0}={1}'.format(key, _format_bytes(size))
+                               for key, size in CONTEXT_REPORT) or 'none',
+                     time.time() - started))
+
+
+def _write_metrics_textfile():
+    try:
+        REGISTRY.write_textfile(__opts__['metrics_textfile'])
+    except (IOError, OSError) as exc:
+        log.error('Could not write the metrics textfile {0}: {1}'
+                  .format(__opts__['metrics_textfile'], exc))
+
+
+def _mark_fileserver_update():
+    '''
+    Record that the fileserver cache was just updated
+    '''
+    fsupdate.mark_updated(__opts__['cachedir'])
+
+
+def _fileserver_age():
+    '''
+    Seconds since the fileserver cache was last updated (by any process)
+    '''
+    updated = fsupdate.last_updated(__opts__['cachedir'])
+    if updated is None:
+        return float('inf')
+    return time.time() - updated
+
+
+def _startup_timing(phase, started, note=None):
+    STARTUP_TIMING['phases'].append((phase, time.time() - started, note))
+
+
+def _print_startup_timing():
+    '''
+    Print where the time of a single function run went, to stderr so it
+    doesn't mix with the function output
+    '''
+    lines = ['Startup timing:']
+    for phase, elapsed, note in STARTUP_TIMING['phases']:
+        lines.append('  {0:<12} {1:8.3f}s{2}'.format(phase, elapsed,
+                                                      ' ({0})'.format(note) if note else ''))
+    lines.append('  {0:<12} {1:8.3f}s'.format('total', time.time() - STARTUP_TIMING['started']))
+    sys.stderr.write('\n'.join(lines) + '\n')
+
+
+def _start_spool_drainer():
+    '''
+    Start delivering spooled returner payloads in the background, if the
+    returner spool is enabled
+    '''
+    global SPOOL_DRAINER
+    spool = returner_spool(__opts__)
+    if spool is None or SPOOL_DRAINER is not None:
+        return
+    SPOOL_DRAINER = SpoolDrainer(spool, deliver_record)
+    SPOOL_DRAINER.start()
+
+
+def _drain_spool(timeout):
+    '''
+    Deliver what is in the returner spool, for at most ``timeout`` seconds
+    (plus the time of the delivery in progress). Does nothing if another
+    process is already delivering from the spool: a running daemon holds the
+    spool for as long as it runs, so single function runs only drain it
+    themselves when no daemon does.
+    '''
+    spool = returner_spool(__opts__)
+    if spool is None:
+        return
+    spool.sync()
+    with spool.reader(blocking=False) as acquired:
+        if not acquired:
+            log.debug('Returner spool is being drained by another process')
+            return
+        drainer = SpoolDrainer(spool, deliver_record)
+        if not drainer.drain(deadline=time.time() + timeout):
+            log.warning('Could not deliver all spooled returner payloads, {0} bytes '
+                        'left in the spool'.format(spool.pending_bytes()))
+
+
+def _parse_function_args(raw_args):
+    '''
+    Split the command line arguments of a single function run into args
+    and kwargs
     '''
-    # Parse the args
     args = []
     kwargs = {}
-    for arg in __opts__['args']:
+    for arg in raw_args:
         if '=' in arg:
             kwarg, _, value = arg.partition('=')
             kwargs[kwarg] = value
         else:
             args.append(arg)
+    return args, kwargs
+
+
+def _print_ret(ret):
+    # TODO instantiate the salt outputter system?
+    if(__opts__['json_print']):
+        print(json.dumps(ret))
+    else:
+        if(__opts__['no_pprint']):
+            pprint.pprint(ret)
+        else:
+            print(ret)
+
+
+def run_function():
+    '''
+    Run a single function requested by the user
+    '''
+    args, kwargs = _parse_function_args(__opts__['args'])
 
     log.debug('Parsed args: {0} | Parsed kwargs: {1}'.format(args, kwargs))
     log.info('Executing user-requested function {0}'.format(__opts__['function']))
 
+    started = time.time()
     try:
         ret = __salt__[__opts__['function']](*args, **kwargs)
     except KeyError:
         log.error('Function {0} is not available, or not valid.'
                   .format(__opts__['function']))
         sys.exit(1)
+    _startup_timing('function', started)
 
     if __opts__['return']:
         returner = '{0}.returner'.format(__opts__['return'])
@@ -392,24 +702,107 @@ def run_function():
             log.error('Could not find {0} returner.'.format(returner))
         else:
             log.info('Returning job data to {0}'.format(returner))
-            returner_ret = {'id': __grains__['id'],
-                            'jid': salt.utils.jid.gen_jid(__opts__),
-                            'fun': __opts__['function'],
-                            'fun_args': args + ([kwargs] if kwargs else []),
-                            'return': ret,
-                            'retry': False}
-            if __opts__.get('returner_retry', False):
-                returner_ret['retry'] = True
-            __returners__[returner](returner_ret)
+            returner_ret = _returner_payload(__opts__['function'], args, kwargs, ret,
+                                             bool(__opts__.get('returner_retry', False)))
+            _get_dispatcher().submit(returner, returner_ret)
 
-    # TODO instantiate the salt outputter system?
-    if(__opts__['json_print']):
-        print(json.dumps(ret))
-    else:
-        if(__opts__['no_pprint']):
-            pprint.pprint(ret)
+    _print_ret(ret)
+
+    if DISPATCHER is not None:
+        # Wait for the returner to finish before exiting
+        DISPATCHER.stop()
+    _drain_spool(__opts__.get('returner_spool_cli_drain_seconds', 5))
+
+    if __opts__['timing']:
+        _print_startup_timing()
+
+
+def _control_path():
+    return __opts__.get('control_socket') or os.path.join(__opts__['cachedir'], 'control.sock')
+
+
+def _start_control_server():
+    '''
+    Listen for single function runs forwarded by the trubble CLI
+    '''
+    global CONTROL
+    if __opts__.get('control_socket', True) is False or CONTROL is not None:
+        return
+    server = ControlServer(_control_path(), _control_run,
+                           max_clients=__opts__.get('control_max_clients', 8))
+    try:
+        if server.start():
+            CONTROL = server
+    except (IOError, OSError, socket.error) as exc:
+        log.error('Could not start the control socket {0}: {1}'.format(_control_path(), exc))
+
+
+def _control_run(request, send):
+    '''
+    Run a function for a control socket client in the job pool, streaming
+    heartbeats and then the result back to it
+    '''
+    function = request.get('function')
+    args = request.get('args') or []
+    kwargs = request.get('kwargs') or {}
+    if function not in __salt__:
+        send({'status': 'error',
+              'error': 'Function {0} is not available, or not valid.'.format(function)})
+        return
+    log.info('Executing function {0} for a control socket client'.format(function))
+    pending = PendingRun()
+    run = JobRun('control.{0}'.format(next(CONTROL_RUNS)), function, args=args, kwargs=kwargs,
+                 lane=__opts__.get('control_lane'), context=pending)
+    POOL.submit(run)
+    send({'status': 'accepted'})
+    while not pending.wait(HEARTBEAT_INTERVAL):
+        send({'status': 'running'})
+    result = pending.result
+    if not result.ok:
+        send({'status': 'error', 'error': result.error})
+        return
+    if request.get('return'):
+        returner = '{0}.returner'.format(request['return'])
+        if returner not in __returners__:
+            log.error('Could not find {0} returner.'.format(returner))
         else:
-            print(ret)
+            _get_dispatcher().submit(returner, _returner_payload(
+                function, args, kwargs, result.ret, bool(request.get('returner_retry'))))
+    send({'status': 'done', 'ret': result.ret, 'wall_time': result.wall_time})
+
+
+def _run_in_daemon():
+    '''
+    Forward the requested single function run to a running daemon. Returns
+    False if there is no daemon to forward to.
+    '''
+    if __opts__['local'] or __opts__.get('control_socket', True) is False:
+        return False
+    args, kwargs = _parse_function_args(__opts__['args'])
+    started = time.time()
+    message = {'function': __opts__['function'],
+               'args': args,
+               'kwargs': kwargs,
+               'return': __opts__['return'],
+               'returner_retry': bool(__opts__.get('returner_retry', False))}
+    try:
+        for reply in control_request(_control_path(), message):
+            if reply['status'] == 'error':
+                log.error(reply['error'])
+                sys.exit(1)
+            if reply['status'] == 'done':
+                _startup_timing('daemon', started)
+                _print_ret(reply['ret'])
+                if __opts__['timing']:
+                    _print_startup_timing()
+                return True
+    except ControlUnavailable as exc:
+        log.debug('Running the function locally: {0}'.format(exc))
+        return False
+    except (EOFError, socket.error) as exc:
+        log.error('Lost the connection to the daemon: {0}'.format(exc))
+        sys.exit(1)
+    return False
 
 
 def load_config():
@@ -447,7 +840,7 @@ def load_config():
     salt.config.DEFAULT_MINION_OPTS['file_client'] = 'local'
     salt.config.DEFAULT_MINION_OPTS['fileserver_update_frequency'] = 43200  # 12 hours
     salt.config.DEFAULT_MINION_OPTS['grains_refresh_frequency'] = 3600  # 1 hour
-    salt.config.DEFAULT_MINION_OPTS['scheduler_sleep_frequency'] = 0.5
+    salt.config.DEFAULT_MINION_OPTS['scheduler_sleep_frequency'] = 0.5  # retry delay after schedule errors
     salt.config.DEFAULT_MINION_OPTS['default_include'] = 'trubble.d/*.conf'
     salt.config.DEFAULT_MINION_OPTS['logfile_maxbytes'] = 100000000 # 100MB
     salt.config.DEFAULT_MINION_OPTS['logfile_backups'] = 1 # maximum rotated logs
@@ -560,7 +953,14 @@ def load_config():
     os.chmod(__opts__['log_file'], 384)
     os.chmod(parsed_args.get('configfile'), 384)
 
-    refresh_grains(initial=True)
+    _startup_timing('config', STARTUP_TIMING['started'])
+
+    # A running daemon can run single functions with everything loaded
+    if __opts__['function'] and _run_in_daemon():
+        sys.exit(0)
+
+    refresh_grains(initial=True,
+                   fast_start=bool(__opts__['function']) and __opts__.get('fast_start', True))
 
     # splunk logs below warning, above info by default
     logging.SPLUNK = int(__opts__.get('splunk_log_level', 25))
@@ -597,9 +997,18 @@ def load_config():
 # tag='trubble:rg' will appear in the logs to differentiate this from other
 # hangtime_wrapper timers (if any)
 @hangtime_wrapper(timeout=600, repeats=True, tag='trubble:rg')
-def refresh_grains(initial=False):
+def refresh_grains(initial=False, fast_start=False):
     '''
     Refresh the grains, pillar, utils, modules, and returners
+
+    Unless ``grains_refresh_mode`` is ``full``, later refreshes only
+    recompute the grains and patch them into the existing loaders; the
+    loaders are only rebuilt if their module files changed.
+
+    With ``fast_start`` (single function runs), the grains come from the
+    snapshot of the last refresh if it is recent enough, and only the
+    requested returner is loaded. Execution modules are imported lazily by
+    the salt loader, on their first use.
     '''
     global __opts__
     global __grains__
@@ -608,11 +1017,17 @@ def refresh_grains(initial=False):
     global __pillar__
     global __returners__
     global __context__
+    global LOADER_SIGNATURE
+
+    started = time.time()
+    rss_before = rss_bytes()
+    incremental = not initial and __opts__.get('grains_refresh_mode', 'incremental') != 'full'
 
     persist = {}
     old_grains = {}
     if not initial:
-        old_grains = copy.deepcopy(__grains__)
+        if not incremental:
+            old_grains = copy.deepcopy(__grains__)
         for grain in __opts__.get('grains_persist', []):
             if grain in __grains__:
                 persist[grain] = __grains__[grain]
@@ -623,11 +1038,28 @@ def refresh_grains(initial=False):
         __opts__.pop('grains')
     if 'pillar' in __opts__:
         __opts__.pop('pillar')
-    __grains__ = salt.loader.grains(__opts__)
-    __grains__.update(persist)
-    __grains__['session_uuid'] = SESSION_UUID
-    old_grains.update(__grains__)
-    __grains__ = old_grains
+    new_grains = None
+    if fast_start:
+        new_grains = trubblestack.grainloader.load_snapshot(
+            __opts__, __opts__.get('fast_start_grains_max_age', 3600))
+    if new_grains is not None:
+        _startup_timing('grains', started, 'snapshot')
+    else:
+        if __opts__.get('grains_parallel', True):
+            new_grains = trubblestack.grainloader.collect(__opts__)
+        else:
+            new_grains = salt.loader.grains(__opts__)
+        trubblestack.grainloader.save_snapshot(__opts__, new_grains)
+        if initial:
+            _startup_timing('grains', started)
+    new_grains.update(persist)
+    new_grains['session_uuid'] = SESSION_UUID
+    if incremental:
+        # Patch the grains dict the loaded modules already reference
+        __grains__.update(new_grains)
+    else:
+        old_grains.update(new_grains)
+        __grains__ = old_grains
 
     # Check for default gateway and fall back if necessary
     if __grains__.get('ip_gw', None) is False and 'fallback_fileserver_backend' in __opts__:
@@ -635,12 +1067,34 @@ def refresh_grains(initial=False):
         __opts__['fileserver_backend'] = __opts__['fallback_fileserver_backend']
 
     __opts__['trubble_uuid'] = __grains__.get('trubble_uuid', None)
-    __pillar__ = {}
+    if not incremental:
+        __pillar__ = {}
     __opts__['grains'] = __grains__
     __opts__['pillar'] = __pillar__
-    __utils__ = salt.loader.utils(__opts__)
-    __salt__ = salt.loader.minion_mods(__opts__, utils=__utils__, context=__context__)
-    __returners__ = salt.loader.returners(__opts__, __salt__)
+    # Lets modules tell whether they can keep what they derived from the grains
+    __opts__['grains_generation'] = __opts__.get('grains_generation', 0) + 1
+
+    loaders_started = time.time()
+    signature = None if fast_start else _loader_signature()
+    if incremental and signature == LOADER_SIGNATURE:
+        # Each loader hands its modules a copy of __opts__
+        for loader in (__utils__, __salt__, __returners__):
+            loader.opts.update((key, val) for key, val in __opts__.items() if key != 'logger')
+        rebuilt = False
+    else:
+        __utils__ = salt.loader.utils(__opts__)
+        __salt__ = salt.loader.minion_mods(__opts__, utils=__utils__, context=__context__)
+        if fast_start and not __opts__['return']:
+            __returners__ = {}
+        elif fast_start:
+            __returners__ = salt.loader.returners(__opts__, __salt__,
+                                                  whitelist=[__opts__['return']])
+        else:
+            __returners__ = salt.loader.returners(__opts__, __salt__)
+        LOADER_SIGNATURE = signature
+        rebuilt = True
+    if initial:
+        _startup_timing('loaders', loaders_started)
 
     # the only things that turn up in here (and that get preserved)
     # are pulsar.queue, pulsar.notifier and cp.fileclient_###########
@@ -660,6 +1114,39 @@ def refresh_grains(initial=False):
         handler = trubblestack.splunklogging.SplunkHandler()
         handler.emit(MockRecord(__grains__, 'INFO', time.asctime(), 'trubblestack.grains_report'))
 
+    rss_after = rss_bytes()
+    log.info('Refreshed grains in {0:.2f}s ({1}), RSS {2} -> {3}'
+             .format(time.time() - started,
+                     'loaders rebuilt' if rebuilt else 'loaders patched',
+                     _format_bytes(rss_before), _format_bytes(rss_after)))
+
+
+def _loader_signature():
+    '''
+    (path, mtime, size) of every file in the module directories of the
+    utils, execution module and returner loaders
+    '''
+    dirs = (salt.loader._module_dirs(__opts__, 'utils', ext_type_dirs='utils_dirs') +
+            salt.loader._module_dirs(__opts__, 'modules', 'module') +
+            salt.loader._module_dirs(__opts__, 'returners', 'returner'))
+    ret = []
+    for module_dir in dirs:
+        for root, _, files in os.walk(module_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                ret.append((path, stat.st_mtime, stat.st_size))
+    return sorted(ret)
+
+
+def _format_bytes(value):
+    if value is None:
+        return 'unknown'
+    return '{0:.1f}MB'.format(value / 1024.0 / 1024.0)
+
 
 def parse_args():
     '''
@@ -689,6 +1176,12 @@ def parse_args():
     parser.add_argument('--buildinfo',
                         action='store_true',
                         help='Show build information')
+    parser.add_argument('--local',
+                        action='store_true',
+                        help='Run a single function in this process, even if a daemon is running')
+    parser.add_argument('--timing',
+                        action='store_true',
+                        help='Show startup timing information for single-function runs')
     parser.add_argument('function',
                         nargs='?',
                         default=None,
@@ -761,6 +1254,17 @@ def clean_up_process(signal, frame):
     '''
     Clean up pidfile and anything else that needs to be cleaned up
     '''
+    if CONTROL is not None:
+        CONTROL.stop()
+    if FS_UPDATER is not None:
+        FS_UPDATER.stop()
+    if POOL is not None:
+        # Don't leave audits running in the workers behind
+        POOL.stop()
+    if DISPATCHER is not None:
+        # Queued returns which can't be sent in time are spilled to disk and
+        # sent after the restart
+        DISPATCHER.stop(__opts__.get('returner_shutdown_timeout', 10))
     if not __opts__.get('ignore_running', False):
         if __opts__['daemonize']:
             if os.path.isfile(__opts__['pidfile']):
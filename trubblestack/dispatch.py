@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+'''
+Asynchronous returner dispatch.
+
+Job results are handed to returners through a bounded in-memory queue which
+is drained by background sender threads, so a slow or unreachable returner
+endpoint (for instance a splunk indexer while the returner is sleeping
+between retries) never stalls the daemon.
+
+When the queue is full, one of the following backpressure policies applies
+(``returner_backpressure`` in the trubble config):
+
+block
+    Wait for room in the queue (default)
+
+drop_oldest
+    Discard the oldest queued return to make room
+
+spill
+    Write the return to ``<cachedir>/returner_spill`` and re-queue it once the
+    queue has drained. The file is only removed once the return was sent, so
+    spilled returns also survive a daemon restart.
+
+Whatever the policy, returns which are still queued when the dispatcher is
+stopped and its timeout runs out are written to the spill directory, and sent
+once a dispatcher is started again.
+'''
+
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+log = logging.getLogger(__name__)
+
+BACKPRESSURE_POLICIES = ('block', 'drop_oldest', 'spill')
+
+
+class ReturnerDispatcher(object):
+    '''
+    Bounded queue of ``(returner, payload)`` items drained by sender threads.
+
+    send
+        Callable ``send(returner, payload)`` which actually invokes the
+        returner. Exceptions are logged and counted as failures.
+    '''
+
+    def __init__(self, send, maxsize=1000, workers=2, backpressure='block',
+                 spill_dir=None):
+        if backpressure not in BACKPRESSURE_POLICIES:
+            log.error('Invalid returner_backpressure {0}, using block'.format(backpressure))
+            backpressure = 'block'
+        if backpressure == 'spill' and not spill_dir:
+            log.error('returner_backpressure spill needs a spill directory, using block')
+            backpressure = 'block'
+        self.send = send
+        self.maxsize = max(1, int(maxsize))
+        self.backpressure = backpressure
+        self.spill_dir = spill_dir
+        self.queue = queue.Queue(self.maxsize)
+        self.workers = max(1, int(workers))
+        self._threads = []
+        self._stopping = False
+        # Bumped when stop() gives up on the sender threads
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._spill_counter = itertools.count()
+        # Spill files whose return is back in the queue or being sent
+        self._unspilled = set()
+        self._counters = {
+            'submitted': 0,
+            'sent': 0,
+            'failed': 0,
+            'dropped': 0,
+            'spilled': 0,
+            'send_seconds_total': 0.0,
+            'send_seconds_max': 0.0,
+            'queue_seconds_total': 0.0,
+        }
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopping = False
+        if self.spill_dir:
+            self._unspill()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, args=(self._generation,),
+                                      name='trubble-returner-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        '''
+        Wait for queued returns to be sent (at most ``timeout`` seconds in
+        total), then stop the sender threads. Returns which were not sent in
+        time are spilled to disk.
+        '''
+        end = None if timeout is None else time.time() + timeout
+        # Senders still busy when we give up must not re-queue spilled returns
+        self._stopping = True
+        for _ in self._threads:
+            if self.backpressure == 'spill' and self.queue.full():
+                # Don't block shutdown on a full queue, the spill dir keeps it
+                self._spill_queued()
+            try:
+                self.queue.put(None, timeout=_remaining(end))
+            except queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(_remaining(end))
+        alive = [thread for thread in self._threads if thread.is_alive()]
+        if alive or not self.queue.empty():
+            self._spill_queued()
+            # Let the senders still busy with a return exit once it's done
+            self._generation += 1
+            for _ in alive:
+                try:
+                    self.queue.put_nowait(None)
+                except queue.Full:
+                    break
+        self._threads = []
+
+    def _spill_queued(self):
+        '''
+        Move the queued returns to the spill directory. Stop markers for the
+        sender threads are kept in the queue.
+        '''
+        stops = 0
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                stops += 1
+            elif item[3] is not None:
+                # Its spill file is still there
+                self._done_unspilled(item[3], remove=False)
+            elif not self.spill_dir:
+                self._count('dropped')
+                log.error('Dropped a return for {0} which was not sent in time'.format(item[0]))
+            else:
+                self._spill(item)
+        for _ in range(stops):
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                break
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._counters[key] += value
+
+    def stats(self):
+        '''
+        Snapshot of the dispatch counters, plus the current queue depth and
+        number of spilled returns waiting on disk.
+        '''
+        with self._lock:
+            ret = dict(self._counters)
+        ret['queue_depth'] = self.queue.qsize()
+        ret['queue_size'] = self.maxsize
+        with self._spill_lock:
+            ret['spill_depth'] = len([name for name in self._spill_files()
+                                      if name not in self._unspilled])
+        return ret
+
+    def submit(self, returner, payload):
+        '''
+        Queue ``payload`` for ``returner``. Returns False if the return was
+        dropped.
+        '''
+        self._count('submitted')
+        item = (returner, payload, time.time(), None)
+        if self.backpressure == 'block':
+            self.queue.put(item)
+            return True
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        if self.backpressure == 'spill':
+            return self._spill(item)
+        while True:
+            try:
+                dropped = self.queue.get_nowait()
+            except queue.Empty:
+                dropped = None
+            if dropped is not None:
+                if dropped[3] is not None:
+                    self._done_unspilled(dropped[3])
+                self._count('dropped')
+                log.warning('Returner queue is full, dropped a return for {0}'
+                            .format(dropped[0]))
+            try:
+                self.queue.put_nowait(item)
+                return True
+            except queue.Full:
+                continue
+
+    def _loop(self, generation):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            returner, payload, queued, spilled = item
+            started = time.time()
+            try:
+                self.send(returner, payload)
+            except Exception:
+                self._count('failed')
+                log.exception('Error sending job data to {0}'.format(returner))
+            else:
+                self._count('sent')
+            if spilled is not None:
+                self._done_unspilled(spilled)
+            elapsed = time.time() - started
+            with self._lock:
+                self._counters['send_seconds_total'] += elapsed
+                self._counters['queue_seconds_total'] += started - queued
+                if elapsed > self._counters['send_seconds_max']:
+                    self._counters['send_seconds_max'] = elapsed
+            if generation != self._generation:
+                # stop() gave up on us and spilled the rest of the queue
+                break
+            if self.spill_dir and not self._stopping and \
+                    self.queue.qsize() < self.maxsize // 2:
+                self._unspill()
+
+    def _spill_files(self):
+        if not self.spill_dir or not os.path.isdir(self.spill_dir):
+            return []
+        return sorted(name for name in os.listdir(self.spill_dir)
+                      if name.endswith('.json'))
+
+    def _spill(self, item):
+        returner, payload, queued, _ = item
+        name = '{0:.6f}-{1:06d}.json'.format(queued, next(self._spill_counter))
+        path = os.path.join(self.spill_dir, name)
+        try:
+            if not os.path.isdir(self.spill_dir):
+                os.makedirs(self.spill_dir, 0o700)
+            with open(path + '.tmp', 'w') as fh_:
+                json.dump({'returner': returner, 'payload': payload}, fh_)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError, TypeError, ValueError) as exc:
+            self._count('dropped')
+            log.error('Could not spill return for {0} to disk, dropped it: {1}'
+                      .format(returner, exc))
+            return False
+        self._count('spilled')
+        return True
+
+    def _unspill(self):
+        '''
+        Move spilled returns back into the queue, oldest first, while there is
+        room. Their files are removed once they are sent.
+        '''
+        if not self._spill_lock.acquire(False):
+            return
+        try:
+            for name in self._spill_files():
+                if self.queue.full():
+                    break
+                if name in self._unspilled:
+                    continue
+                path = os.path.join(self.spill_dir, name)
+                try:
+                    with open(path) as fh_:
+                        data = json.load(fh_)
+                    item = (data['returner'], data['payload'], time.time(), name)
+                except (IOError, OSError, ValueError, KeyError) as exc:
+                    log.error('Discarding unreadable spilled return {0}: {1}'.format(path, exc))
+                    self._remove(path)
+                    continue
+                self._unspilled.add(name)
+                try:
+                    self.queue.put_nowait(item)
+                except queue.Full:
+                    self._unspilled.discard(name)
+                    break
+        finally:
+            self._spill_lock.release()
+
+    def _done_unspilled(self, name, remove=True):
+        '''
+        Forget the spill file ``name`` of a return which left the queue, and
+        remove it unless the return still needs to be sent
+        '''
+        with self._spill_lock:
+            self._unspilled.discard(name)
+            if remove:
+                self._remove(os.path.join(self.spill_dir, name))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _remaining(end):
+    '''
+    Seconds left until ``end``, None if there is no end
+    '''
+    return None if end is None else max(0, end - time.time())
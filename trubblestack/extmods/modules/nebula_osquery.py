@@ -36,6 +36,7 @@ import salt.utils
 import salt.utils.platform
 from salt.exceptions import CommandExecutionError
 from trubblestack import __version__
+import trubblestack.pkginventory
 import trubblestack.splunklogging
 
 log = logging.getLogger(__name__)
@@ -125,9 +126,10 @@ def queries(query_group,
                  }}
             )
             if 'pkg.list_pkgs' in __salt__:
+                pkgs = trubblestack.pkginventory.PackageInventory(__salt__, __grains__).list_pkgs()
                 ret.append(
                     {'fallback_pkgs': {
-                     'data': [{'name': k, 'version': v} for k, v in __salt__['pkg.list_pkgs']().iteritems()],
+                     'data': [{'name': k, 'version': v} for k, v in pkgs.iteritems()],
                      'result': True
                      }}
                 )
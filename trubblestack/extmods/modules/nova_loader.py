@@ -10,9 +10,12 @@ from __future__ import absolute_import
 import os
 import imp
 import sys
+import copy
 import salt
 import time
 import yaml
+import pickle
+import hashlib
 import logging
 import inspect
 import tempfile
@@ -87,6 +90,9 @@ LIBCLOUD_FUNCS_NOT_SUPPORTED = (
 # Will be set to pyximport module at runtime if cython is enabled in config.
 pyximport = None
 
+# Parsed nova profiles by the sha1 of their content, in the cachedir
+PROFILE_CACHE = 'nova_profiles.p'
+
 
 # BEGIN salt.utils.lazy
 def verify_fun(lazy_obj, fun):
@@ -1816,6 +1822,38 @@ def global_injector_decorator(inject_globals):
     return inner_decorator
 
 
+class ProfileIndex(object):
+    '''
+    Prefix tree of the nova profile keys (paths relative to the profile
+    directory), by path component. Each node holds the keys of its whole
+    subtree, so a config resolves to its profiles in one walk down the tree.
+    '''
+
+    def __init__(self, keys):
+        self.root = ({}, set())
+        for key in keys:
+            node = self.root
+            node[1].add(key)
+            for part in key.split('.yaml')[0].split(os.path.sep):
+                node = node[0].setdefault(part, ({}, set()))
+                node[1].add(key)
+
+    def resolve(self, config):
+        '''
+        Keys of the profiles matching ``config``, a path with a leading
+        slash which names a profile (without ``.yaml``) or a directory. The
+        returned set must not be modified.
+        '''
+        if config == os.path.sep:
+            return self.root[1]
+        node = self.root
+        for part in config.split(os.path.sep):
+            node = node[0].get(part)
+            if node is None:
+                return frozenset()
+        return node[1]
+
+
 class NovaLazyLoader(LazyLoader):
     '''
     Leverage the SaltStack LazyLoader so we don't have to reimplement
@@ -1832,10 +1870,92 @@ class NovaLazyLoader(LazyLoader):
         self.__opts__ = opts
         self.__data__ = {}
         self.__missing_data__ = {}
+        # (mtime, size, inode) of the loaded files, the module objects and the
+        # content hashes of the profiles, to reload only what changed
+        self.file_stats = {}
+        self.modules = {}
+        self.profile_hashes = {}
+        self.profile_cache_path = None
+        if opts.get('cachedir'):
+            self.profile_cache_path = os.path.join(opts['cachedir'], PROFILE_CACHE)
+        self.profile_cache = _load_profile_cache(self.profile_cache_path)
+        self.profile_cache_dirty = False
+        self._profile_index = None
         super(NovaLazyLoader, self).__init__(trubble_dir,
                                              opts=opts,
                                              tag='nova')
         self._load_all()
+        self._save_profile_cache()
+
+    def refresh(self, grains, pillar, salt):
+        '''
+        Bring the loader up to date with the nova directories. Only the files
+        which were added, changed or removed since they were loaded are
+        (un)loaded, and modules which failed to load are tried again. The
+        loaded modules get the new ``grains``, ``pillar`` and ``salt``.
+        '''
+        self.__grains__ = grains
+        self.__pillar__ = pillar
+        self.__salt__ = salt
+        old_mapping = self.file_mapping
+        self.refresh_file_mapping()
+        for name in set(old_mapping) | set(self.file_mapping):
+            if name in self.missing_modules or name in self.__missing_data__ \
+                    or old_mapping.get(name) != self.file_mapping.get(name) \
+                    or _file_stat(self.file_mapping[name][0]) != self.file_stats.get(name):
+                self._forget(name)
+        for mod in self.modules.values():
+            mod.__grains__ = grains
+            mod.__pillar__ = pillar
+            mod.__salt__ = salt
+        self._load_all()
+        self._save_profile_cache()
+
+    @property
+    def profile_index(self):
+        '''
+        :class:`ProfileIndex` of the loaded profiles, built when first used
+        after they changed
+        '''
+        if self._profile_index is None:
+            self._profile_index = ProfileIndex(self.__data__)
+        return self._profile_index
+
+    def _forget(self, name):
+        '''
+        Drop everything loaded from ``name``
+        '''
+        if name in self.__data__:
+            self._profile_index = None
+        self.loaded_files.discard(name)
+        for loaded in (self._dict, self.loaded_modules, self.missing_modules,
+                       self.__data__, self.__missing_data__, self.file_stats,
+                       self.modules, self.profile_hashes):
+            loaded.pop(name, None)
+
+    def _save_profile_cache(self):
+        '''
+        Write the parsed profiles to the cachedir, keeping only the ones
+        which are currently loaded
+        '''
+        used = set(self.profile_hashes.values())
+        if set(self.profile_cache) != used:
+            self.profile_cache = dict((digest, data) for digest, data
+                                      in self.profile_cache.items() if digest in used)
+            self.profile_cache_dirty = True
+        if not self.profile_cache_dirty or self.profile_cache_path is None:
+            return
+        path = self.profile_cache_path
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path + '.tmp', 'wb') as fh_:
+                os.chmod(path + '.tmp', 0o600)
+                pickle.dump(self.profile_cache, fh_, pickle.HIGHEST_PROTOCOL)
+            os.rename(path + '.tmp', path)
+            self.profile_cache_dirty = False
+        except (IOError, OSError, pickle.PicklingError) as exc:
+            log.error('Could not write the nova profile cache {0}: {1}'.format(path, exc))
 
     def refresh_file_mapping(self):
         '''
@@ -1906,16 +2026,28 @@ class NovaLazyLoader(LazyLoader):
         mod = None
         fpath, suffix = self.file_mapping[name]
         self.loaded_files.add(name)
+        self.file_stats[name] = _file_stat(fpath)
         if suffix == '.yaml':
             try:
-                with open(fpath) as fh_:
-                    data = yaml.safe_load(fh_)
+                with open(fpath, 'rb') as fh_:
+                    raw = fh_.read()
+                digest = hashlib.sha1(raw).hexdigest()
+                if digest in self.profile_cache:
+                    data = self.profile_cache[digest]
+                else:
+                    data = yaml.safe_load(raw)
+                    self.profile_cache[digest] = data
+                    self.profile_cache_dirty = True
             except Exception as exc:
                 self.__missing_data__[name] = str(exc)
-                log.exception('Error loading yaml {0}'.format(fh_))
+                log.exception('Error loading yaml {0}'.format(fpath))
                 return False
 
-            self.__data__[name] = data
+            # Each file gets its own copy, profiles with the same content must
+            # not share data which the nova modules may change
+            self.__data__[name] = copy.deepcopy(data)
+            self.profile_hashes[name] = digest
+            self._profile_index = None
             return True
         try:
             sys.path.append(os.path.dirname(fpath))
@@ -1967,6 +2099,7 @@ class NovaLazyLoader(LazyLoader):
         mod.__pillar__ = self.__pillar__
         mod.__opts__ = self.__opts__
         mod.__salt__ = self.__salt__
+        self.modules[name] = mod
 
         # pack whatever other globals we were asked to
         for p_name, p_value in six.iteritems(self.pack):
@@ -2046,3 +2179,29 @@ class NovaLazyLoader(LazyLoader):
 
         self.loaded_modules[name] = mod_dict
         return True
+
+
+def _file_stat(path):
+    '''
+    What identifies a version of the file at ``path``, None if it's gone
+    '''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size, stat.st_ino
+
+
+def _load_profile_cache(path):
+    if path is None:
+        return {}
+    try:
+        with open(path, 'rb') as fh_:
+            cache = pickle.load(fh_)
+    except (IOError, OSError):
+        return {}
+    except Exception:
+        # Truncated, or written by another python version
+        log.debug('Ignoring unreadable nova profile cache {0}'.format(path), exc_info=True)
+        return {}
+    return cache if isinstance(cache, dict) else {}
@@ -762,6 +762,9 @@ def process(configfile='salt://trubblestack_pulsar/trubblestack_pulsar_config.ya
                         'name': basename, # goes to file_name in splunk
                         'pulsar_config': pulsar_config}
 
+                if event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+                    # Otherwise the checksums of short-lived files pile up
+                    __context__.get('pulsar_checksums', {}).pop(pathname, None)
                 if config.get('checksum', False) and os.path.isfile(pathname):
                     if 'pulsar_checksums' not in __context__:
                         __context__['pulsar_checksums'] = {}
@@ -10,28 +10,68 @@ Configuration:
     - trubblestack:nova:saltenv
     - trubblestack:nova:autoload
     - trubblestack:nova:autosync
+    - trubblestack:nova:sync_mode
+    - trubblestack:nova:workers
+    - trubblestack:nova:module_timeout
+    - trubblestack:nova:module_timeouts
+    - trubblestack:nova:result_cache
+    - trubblestack:nova:full_audit_interval
 '''
 from __future__ import absolute_import
 import logging
 
 log = logging.getLogger(__name__)
 
+import copy
+import fnmatch
+import hashlib
 import imp
+import json
 import os
+import pickle
 import sys
 import six
 import inspect
+import threading
+import time
 import yaml
 import traceback
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
 import salt
 import salt.utils
 from salt.exceptions import CommandExecutionError
-from trubblestack import __version__
+from trubblestack import __version__, fsupdate, pkginventory
+from trubblestack.metrics import REGISTRY
 from trubblestack.extmods.modules.nova_loader import NovaLazyLoader
 
 __nova__ = {}
 
+# Hashes of the synced profiles as of the last sync, in the cachedir
+SYNC_MANIFEST = 'nova_sync_manifest.json'
+
+# Number of runs of each nova module which missed their deadline and are
+# still running. Such modules are reported as errors instead of being started
+# again until they finish.
+_HUNG = {}
+_HUNG_LOCK = threading.Lock()
+_LOAD_LOCK = threading.Lock()
+
+# Results of nova module runs, by what the module ran with, along with the
+# state of the inputs it declared and when it was last run in full. Persisted
+# in the cachedir.
+RESULT_CACHE = 'nova_results.p'
+_RESULTS = {'path': None, 'entries': {}, 'dirty': False}
+_RESULTS_LOCK = threading.Lock()
+
+# Matching entries of the topfiles, by path, with the topfile stat and grains
+# generation they were computed for
+_TOP_CACHE = {}
+
 
 def audit(configs=None,
           tags='*',
@@ -42,6 +82,7 @@ def audit(configs=None,
           called_from_top=None,
           debug=None,
           labels=None,
+          force_full=False,
           **kwargs):
     '''
     Primary entry point for audit calls.
@@ -95,29 +136,68 @@ def audit(configs=None,
         Tests with matching labels are executed. If multiple labels are passed,
         then tests which have all those labels are executed.
 
+    force_full
+        Run every nova module, rather than reusing the results of the modules
+        whose inputs didn't change since their last run. See
+        ``trubblestack:nova:result_cache``. Defaults to False.
+
     **kwargs
         Any parameters & values that are not explicitly defined will be passed
         directly through to the Nova module(s).
 
+    Nova modules may define ``inputs(data_list, tags, labels, **kwargs)``,
+    returning the list of ``(kind, name)`` inputs their results depend on:
+
+    - ``('file', <path>)``: the inode, mtime, size and ctime of the file
+    - ``('pkgdb', None)``: the package databases
+    - ``('sysctl', <key>)``: the value of the kernel parameter
+    - ``('period', <seconds>)``: the current period of that many seconds
+
+    or None if they can't tell for this run. When a module ran before with
+    the same arguments and profiles and none of its inputs changed, its
+    previous results are returned instead of running it again. Every module
+    runs in full at least every ``trubblestack:nova:full_audit_interval``
+    seconds (default 86400). Set ``trubblestack:nova:result_cache`` to False
+    to always run the modules.
+
     CLI Examples::
 
         salt '*' trubble.audit foo
         salt '*' trubble.audit foo,bar tags='CIS*'
         salt '*' trubble.audit foo,bar.baz verbose=True
+        salt '*' trubble.audit foo force_full=True
     '''
     if configs is None:
         return top(verbose=verbose,
                    show_success=show_success,
                    show_compliance=show_compliance,
-                   labels=labels)
-    if labels:
-        if not isinstance(labels, list):
-            labels=labels.split(',')
+                   labels=labels,
+                   force_full=force_full)
     if not called_from_top and __salt__['config.get']('trubblestack:nova:autoload', True):
         load()
     if not __nova__:
         return False, 'No nova modules/data have been loaded.'
 
+    options = _audit_options(configs, tags, verbose, show_success, show_compliance,
+                             show_profile, debug, labels, kwargs)
+    log.debug('nova_kwargs: ' + str(options['nova_kwargs']))
+
+    ret = _run_audit(options['configs'], tags, options['debug'], options['labels'],
+                     force_full=force_full, **options['nova_kwargs'])
+    return _format_audit(ret, options['verbose'], options['show_success'],
+                         options['show_compliance'], called_from_top)
+
+
+def _audit_options(configs, tags, verbose, show_success, show_compliance,
+                   show_profile, debug, labels, kwargs):
+    '''
+    Apply the config defaults to the arguments of ``audit``. Returns a dict
+    of the arguments, with ``configs`` as a list of paths and the nova
+    module parameters in ``nova_kwargs``.
+    '''
+    if labels:
+        if not isinstance(labels, list):
+            labels = labels.split(',')
     if verbose is None:
         verbose = __salt__['config.get']('trubblestack:nova:verbose', False)
     if show_success is None:
@@ -149,10 +229,20 @@ def audit(configs=None,
     if kwargs is not None:
         nova_kwargs.update(kwargs)
 
-    log.debug('nova_kwargs: ' + str(nova_kwargs))
+    return {'configs': configs,
+            'tags': tags,
+            'verbose': verbose,
+            'show_success': show_success,
+            'show_compliance': show_compliance,
+            'debug': debug,
+            'labels': labels,
+            'nova_kwargs': nova_kwargs}
 
-    ret = _run_audit(configs, tags, debug, labels, **nova_kwargs)
 
+def _format_audit(ret, verbose, show_success, show_compliance, called_from_top):
+    '''
+    Build the return of ``audit`` from the results of ``_run_audit``
+    '''
     terse_results = {}
     verbose_results = {}
 
@@ -244,70 +334,656 @@ def audit(configs=None,
     return results
 
 
-def _run_audit(configs, tags, debug, labels, **kwargs):
+def audit_batch(jobs):
+    '''
+    Run several audits in a single pass. The daemon merges ``trubble.audit``
+    jobs which are due at the same time into one call of this function.
 
-    results = {}
+    jobs
+        List of ``{'name': <name>, 'args': [...], 'kwargs': {...}}`` dicts,
+        each holding the arguments of a ``trubble.audit`` call
 
-    # Compile a list of audit data sets which we need to run
+    The nova modules are loaded once, and audits with the same ``tags``,
+    ``labels`` and nova module parameters run every nova module once over
+    the union of their profiles. Returns a dict of the return each audit
+    would have had on its own, by job name.
+    '''
+    ret = {}
+    options = {}
+    for job in jobs:
+        try:
+            callargs = inspect.getcallargs(audit, *job.get('args', []), **job.get('kwargs', {}))
+        except TypeError as exc:
+            ret[job['name']] = (False, str(exc))
+            continue
+        if callargs['configs'] is None:
+            # Runs the topfile
+            ret[job['name']] = audit(*job.get('args', []), **job.get('kwargs', {}))
+            continue
+        options[job['name']] = callargs
+
+    if not options:
+        return ret
+    if __salt__['config.get']('trubblestack:nova:autoload', True):
+        load()
+    if not __nova__:
+        for name in options:
+            ret[name] = False, 'No nova modules/data have been loaded.'
+        return ret
+
+    groups = {}
+    for name, callargs in options.items():
+        opts = _audit_options(callargs['configs'], callargs['tags'], callargs['verbose'],
+                              callargs['show_success'], callargs['show_compliance'],
+                              callargs['show_profile'], callargs['debug'],
+                              callargs['labels'], callargs['kwargs'])
+        opts['called_from_top'] = callargs['called_from_top']
+        options[name] = opts
+        opts['force_full'] = callargs['force_full']
+        key = repr((opts['tags'], sorted(opts['labels'] or []), opts['debug'],
+                    bool(opts['force_full']), sorted(opts['nova_kwargs'].items())))
+        groups.setdefault(key, []).append(name)
+
+    for names in groups.values():
+        first = options[names[0]]
+        log.debug('Running audits {0} in one pass'.format(', '.join(names)))
+        results = _run_audits([options[name]['configs'] for name in names], first['tags'],
+                              first['debug'], first['labels'], force_full=first['force_full'],
+                              **first['nova_kwargs'])
+        for name, result in zip(names, results):
+            opts = options[name]
+            ret[name] = _format_audit(result, opts['verbose'], opts['show_success'],
+                                      opts['show_compliance'], opts['called_from_top'])
+    return ret
+
+
+def _select_profiles(configs):
+    '''
+    Keys of the loaded audit data matching ``configs``, and the errors for
+    configs which matched nothing
+    '''
     to_run = set()
+    errors = []
+    index = __nova__.profile_index
     for config in configs:
-        found_for_config = False
-        for key in __nova__.__data__:
-            key_path_split = key.split('.yaml')[0].split(os.path.sep)
-            matches = True
-            if config != os.path.sep:
-                for i, path in enumerate(config.split(os.path.sep)):
-                    if i >= len(key_path_split) or path != key_path_split[i]:
-                        matches = False
-            if matches:
-                # Found a match, add the audit data to the set
-                found_for_config = True
-                to_run.add(key)
-        if not found_for_config:
+        found = index.resolve(config)
+        if found:
+            to_run.update(found)
+        else:
             # No matches were found for this entry, add an error
-            if 'Errors' not in results:
-                results['Errors'] = []
-            results['Errors'].append({config: {'error': 'No matching profiles found for {0}'
-                                                        .format(config)}})
+            errors.append({config: {'error': 'No matching profiles found for {0}'
+                                             .format(config)}})
+    return to_run, errors
+
+
+def _data_list(keys):
+    '''
+    List of tuples with profile name and profile data
+    '''
+    return [(key.split('.yaml')[0].split(os.path.sep)[-1],
+             __nova__.__data__[key]) for key in keys]
+
+
+def _run_module(key, func, data_list, tags, labels, **kwargs):
+    '''
+    Run nova module ``func`` over ``data_list``. Returns its results, or an
+    error for the ``Errors`` list.
+    '''
+    try:
+        ret = func(data_list, tags, labels, **kwargs)
+    except Exception as exc:
+        log.error('Exception occurred in nova module:')
+        log.error(traceback.format_exc())
+        return None, {key: {'error': 'exception occurred',
+                            'data': traceback.format_exc().splitlines()[-1]}}
+    if not isinstance(ret, dict):
+        return None, {key: {'error': 'bad return type',
+                            'data': ret}}
+    return ret, None
+
+
+def _module_setting(mapping, key, default):
+    '''
+    Per-module setting for ``module.function``, falling back to ``module``
+    '''
+    if not isinstance(mapping, dict):
+        return default
+    if key in mapping:
+        return mapping[key]
+    return mapping.get(key.split('.', 1)[0], default)
+
+
+def _run_module_thread(run_id, func, data_list, tags, labels, kwargs, state, results):
+    key = run_id[0]
+    started = time.time()
+    ret = _run_module(key, func, data_list, tags, labels, **kwargs)
+    with _HUNG_LOCK:
+        if state['timed_out']:
+            _HUNG[key] -= 1
+            if not _HUNG[key]:
+                del _HUNG[key]
+            log.warning('Nova module {0} finished {1:.2f}s after it was started, '
+                        'past its deadline'.format(key, time.time() - started))
+    results.put((run_id, ret, time.time() - started))
+
+
+def _run_modules(runs, labels, force_full=False, tag_filters=None, pkg_inventory=None,
+                 **kwargs):
+    '''
+    Run nova modules concurrently. ``runs`` is a list of ``(run_id, func,
+    data_list, tags)`` tuples, where ``run_id[0]`` is the module key. Returns
+    a dict of the ``(results, error)`` of ``_run_module`` by run id.
+
+    Up to ``trubblestack:nova:workers`` modules run at once, each in its own
+    thread and with its own deadline (``trubblestack:nova:module_timeout``,
+    overridden per module or ``module.function`` by
+    ``trubblestack:nova:module_timeouts``). A module which misses its
+    deadline is reported as an error and left to finish in the background.
+
+    Modules get an ``AuditPlan`` of their data list in ``audit_plan``, with
+    the checks of each profile named in ``tag_filters`` narrowed to its tag
+    globs. They also get the ``pkg_inventory`` of the audit, a
+    ``pkginventory.PackageInventory``.
+
+    The results of modules declaring their inputs are reused while their
+    inputs don't change, unless ``force_full`` is set (see ``audit``).
+    '''
+    workers = max(1, int(__salt__['config.get']('trubblestack:nova:workers', 4)))
+    default_timeout = float(__salt__['config.get']('trubblestack:nova:module_timeout', 300))
+    timeouts = __salt__['config.get']('trubblestack:nova:module_timeouts', {})
+    use_cache = not force_full and __salt__['config.get']('trubblestack:nova:result_cache', True)
+    full_interval = float(__salt__['config.get']('trubblestack:nova:full_audit_interval', 86400))
+
+    ret = {}
+    results = queue.Queue()
+    deadlines = {}
+    states = {}
+    # One plan for each data list, shared by the modules running over it
+    plans = {}
+    digests = {}
+    pending = list(runs)
+    while pending or deadlines:
+        while pending and len(deadlines) < workers:
+            run_id, func, data_list, tags = pending.pop(0)
+            if id(data_list) not in plans:
+                plans[id(data_list)] = AuditPlan(data_list, labels, __grains__.get('osfinger'),
+                                                 tag_filters)
+            key = run_id[0]
+            with _HUNG_LOCK:
+                hung = _HUNG.get(key, 0)
+            if hung:
+                log.error('Nova module {0} is still running past its deadline, '
+                          'skipping it'.format(key))
+                ret[run_id] = None, {key: {'error': 'still running since a previous audit'}}
+                continue
+            module_kwargs = dict(kwargs, audit_plan=plans[id(data_list)],
+                                 pkg_inventory=pkg_inventory)
+            cache_key = inputs = None
+            if use_cache and callable(getattr(getattr(__nova__, 'modules', {}).get(key),
+                                              'inputs', None)):
+                if id(data_list) not in digests:
+                    digests[id(data_list)] = _data_digest((data_list, tag_filters))
+                cache_key = _result_key(key, digests[id(data_list)], tags, labels, kwargs)
+                inputs = _inputs_digest(key, data_list, tags, labels, module_kwargs)
+                cached = _cached_result(cache_key, inputs, full_interval)
+                REGISTRY.inc('trubble_nova_result_cache_total',
+                             labels={'module': key, 'result': 'miss' if cached is None else 'hit'},
+                             help_text='Lookups of nova module results in the result cache')
+                if cached is not None:
+                    log.debug('Inputs of nova module {0} are unchanged, reusing its '
+                              'results'.format(key))
+                    ret[run_id] = cached, None
+                    continue
+            states[run_id] = {'timed_out': False, 'started': time.time(),
+                              'cache': (cache_key, inputs)}
+            thread = threading.Thread(target=_run_module_thread,
+                                      args=(run_id, func, data_list, tags, labels,
+                                            module_kwargs, states[run_id], results),
+                                      name='trubble-nova-{0}'.format(key))
+            thread.daemon = True
+            timeout = float(_module_setting(timeouts, key, default_timeout))
+            deadlines[run_id] = states[run_id]['started'] + timeout
+            thread.start()
+        if not deadlines:
+            continue
+        try:
+            run_id, result, elapsed = results.get(
+                timeout=max(0, min(deadlines.values()) - time.time()))
+        except queue.Empty:
+            now = time.time()
+            for run_id in [run_id for run_id, deadline in deadlines.items() if deadline <= now]:
+                key = run_id[0]
+                del deadlines[run_id]
+                elapsed = now - states[run_id]['started']
+                with _HUNG_LOCK:
+                    states[run_id]['timed_out'] = True
+                    _HUNG[key] = _HUNG.get(key, 0) + 1
+                log.error('Nova module {0} missed its deadline after {1:.2f}s'
+                          .format(key, elapsed))
+                ret[run_id] = None, {key: {'error': 'timed out',
+                                           'data': 'No results after {0:.0f}s'.format(elapsed)}}
+                _record_module_time(key, elapsed, 'timeout')
+            continue
+        if run_id not in deadlines:
+            # Finished after its deadline, already reported
+            continue
+        del deadlines[run_id]
+        ret[run_id] = result
+        log.debug('Nova module {0} ran in {1:.2f}s'.format(run_id[0], elapsed))
+        _record_module_time(run_id[0], elapsed, 'ok' if result[1] is None else 'error')
+        cache_key, inputs = states[run_id]['cache']
+        if inputs is not None and result[1] is None:
+            _store_result(cache_key, inputs, result[0], states[run_id]['started'])
+    _save_results(full_interval)
+    return ret
+
+
+def _data_digest(data):
+    '''
+    Hash of the profiles of a nova module run, None if they can't be hashed
+    '''
+    try:
+        return hashlib.sha1(json.dumps(data, sort_keys=True, default=repr)).hexdigest()
+    except (TypeError, ValueError, RuntimeError):
+        return None
+
+
+def _result_key(key, data_digest, tags, labels, kwargs):
+    '''
+    Key of the result cache for a run of nova module ``key``: what it runs
+    with, besides its inputs
+    '''
+    if data_digest is None:
+        return None
+    return hashlib.sha1(repr((key, __version__,
+                              getattr(__nova__, 'file_stats', {}).get(key),
+                              data_digest, tags, sorted(labels or []),
+                              __grains__.get('osfinger'),
+                              sorted(kwargs.items())))).hexdigest()
+
+
+def _inputs_digest(key, data_list, tags, labels, kwargs):
+    '''
+    Hash of the current state of the inputs nova module ``key`` declares for
+    this run, None if it declares none or they can't be checked
+    '''
+    try:
+        inputs = __nova__.modules[key].inputs(data_list, tags, labels, **kwargs)
+        if inputs is None:
+            return None
+        states = [(kind, name, _input_state(kind, name))
+                  for kind, name in sorted(set(tuple(item) for item in inputs))]
+    except Exception:
+        log.debug('Could not check the inputs of nova module {0}'.format(key), exc_info=True)
+        return None
+    return hashlib.sha1(repr(states)).hexdigest()
+
+
+def _input_state(kind, name):
+    '''
+    Current state of an input of a nova module, raises an exception if it
+    can't be checked
+    '''
+    if kind == 'file':
+        try:
+            stat = os.stat(name)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime, stat.st_size, stat.st_ctime
+    if kind == 'pkgdb':
+        return pkginventory.db_state()
+    if kind == 'sysctl':
+        with open(os.path.join('/proc/sys', *name.split('.'))) as fh_:
+            return fh_.read()
+    if kind == 'period':
+        return int(time.time() // name)
+    raise ValueError('Unknown nova module input {0}'.format(kind))
+
+
+def _result_cache():
+    '''
+    Entries of the result cache, read from the cachedir when first used
+    '''
+    path = None
+    if __opts__.get('cachedir'):
+        path = os.path.join(__opts__['cachedir'], RESULT_CACHE)
+    if _RESULTS['path'] != path:
+        entries = {}
+        if path is not None and os.path.isfile(path):
+            try:
+                with open(path, 'rb') as fh_:
+                    entries = pickle.load(fh_)
+            except Exception:
+                log.debug('Ignoring unreadable nova result cache {0}'.format(path),
+                          exc_info=True)
+            if not isinstance(entries, dict):
+                entries = {}
+        _RESULTS.update({'path': path, 'entries': entries, 'dirty': False})
+    return _RESULTS['entries']
+
+
+def _cached_result(cache_key, inputs, full_interval):
+    '''
+    Copy of the results of the last run with ``cache_key``, if its inputs
+    were the same and it was run in full less than ``full_interval``
+    seconds ago
+    '''
+    if cache_key is None or inputs is None:
+        return None
+    with _RESULTS_LOCK:
+        entry = _result_cache().get(cache_key)
+        if entry is None or entry['inputs'] != inputs \
+                or time.time() - entry['time'] >= full_interval:
+            return None
+        return copy.deepcopy(entry['result'])
+
+
+def _store_result(cache_key, inputs, result, started):
+    if cache_key is None:
+        return
+    with _RESULTS_LOCK:
+        _result_cache()[cache_key] = {'inputs': inputs,
+                                      'result': copy.deepcopy(result),
+                                      'time': started}
+        _RESULTS['dirty'] = True
+
+
+def _save_results(full_interval):
+    '''
+    Write the result cache to the cachedir if it changed, without the
+    entries which are due for a full run
+    '''
+    with _RESULTS_LOCK:
+        if not _RESULTS['dirty']:
+            return
+        now = time.time()
+        entries = _RESULTS['entries']
+        for cache_key in [cache_key for cache_key, entry in entries.items()
+                          if now - entry['time'] >= full_interval]:
+            del entries[cache_key]
+        path = _RESULTS['path']
+        _RESULTS['dirty'] = False
+        if path is None:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path + '.tmp', 'wb') as fh_:
+                os.chmod(path + '.tmp', 0o600)
+                pickle.dump(entries, fh_, pickle.HIGHEST_PROTOCOL)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError, pickle.PicklingError) as exc:
+            log.error('Could not write the nova result cache {0}: {1}'.format(path, exc))
+
+
+class AuditPlan(object):
+    '''
+    The profiles of a nova module run, compiled once and shared by all the
+    nova modules of the run.
+
+    ``section`` returns the checks of one module in the shape its
+    ``_merge_yaml`` builds, already filtered by labels, with each check
+    tagged with its ``nova_profile`` and its ``data`` resolved for this
+    host's osfinger (as ``{'*': <checks>}``). The sections must not be
+    modified.
+
+    ``tag_filters`` maps profile names to lists of tag globs. The checks of
+    those profiles only keep the entries whose tag matches one of the globs.
+    '''
+
+    def __init__(self, data_list, labels, osfinger, tag_filters=None):
+        self.data_list = data_list
+        self.labels = set(labels or [])
+        self.osfinger = osfinger
+        self.tag_filters = tag_filters or {}
+        self._sections = {}
+        self._matches = {}
+        self._lock = threading.Lock()
+
+    def section(self, key, lists=None, labels=True):
+        '''
+        Checks under ``key`` in the profiles
+
+        lists
+            Names of the lists of checks under ``key`` (e.g. ``('blacklist',
+            'whitelist')``), or None if the checks are directly under ``key``
+
+        labels
+            Whether to drop the checks which don't have all the labels of the
+            audit
+        '''
+        cache_key = (key, tuple(lists or ()), labels)
+        with self._lock:
+            if cache_key not in self._sections:
+                self._sections[cache_key] = self._compile(key, lists, labels)
+            return self._sections[cache_key]
+
+    def _compile(self, key, lists, labels):
+        ret = {} if lists else []
+        for profile, data in self.data_list:
+            section = data.get(key) or {}
+            if not lists:
+                self._add_checks(ret, section, profile, labels)
+                continue
+            for toplist in lists:
+                if toplist in section:
+                    self._add_checks(ret.setdefault(toplist, []), section[toplist],
+                                     profile, labels)
+        return {key: ret}
+
+    def _add_checks(self, ret, checks, profile, labels):
+        for check_id, check in checks.iteritems():
+            if isinstance(check, dict):
+                if labels and self.labels and \
+                        not self.labels.issubset(set(check.get('labels', []))):
+                    continue
+                check = dict(check, nova_profile=profile)
+                if 'data' in check:
+                    tags = self._resolve(check['data'])
+                    if tags and profile in self.tag_filters:
+                        tags = _filter_tags(tags, self.tag_filters[profile])
+                        if not tags:
+                            continue
+                    check['data'] = {'*': tags} if tags is not None else {}
+            ret.append({check_id: check})
+
+    def _resolve(self, tags_dict):
+        '''
+        Checks of ``tags_dict`` for this host: the first osfinger glob
+        matching it, else ``*``, else None
+        '''
+        for osfinger in tags_dict:
+            if osfinger == '*':
+                continue
+            for osfinger_glob in osfinger.split(','):
+                osfinger_glob = osfinger_glob.strip()
+                if osfinger_glob not in self._matches:
+                    self._matches[osfinger_glob] = fnmatch.fnmatch(self.osfinger, osfinger_glob)
+                if self._matches[osfinger_glob]:
+                    tags = tags_dict.get(osfinger)
+                    if tags is not None:
+                        return tags
+                    break
+        return tags_dict.get('*')
+
+
+def _filter_tags(tags, globs):
+    '''
+    Entries of the resolved data of a check (a list of ``{name: tag data}``,
+    or the tag data itself) whose tag matches one of ``globs``. Entries
+    without a tag are kept.
+    '''
+    if isinstance(tags, dict):
+        tag = tags.get('tag')
+        if isinstance(tag, basestring) and not _match_any(tag, globs):
+            return None
+        return tags
+    if not isinstance(tags, list):
+        return tags
+    ret = []
+    for item in tags:
+        tag = None
+        if isinstance(item, dict) and len(item) == 1:
+            tag = item.values()[0]
+            if isinstance(tag, dict):
+                tag = tag.get('tag')
+        if not isinstance(tag, basestring) or _match_any(tag, globs):
+            ret.append(item)
+    return ret
+
+
+def _match_any(tag, globs):
+    return any(fnmatch.fnmatch(tag, tag_glob) for tag_glob in globs)
+
+
+def _record_module_time(key, elapsed, status):
+    REGISTRY.observe('trubble_nova_module_seconds', elapsed,
+                     labels={'module': key, 'status': status},
+                     help_text='Wall time of nova module runs')
+
+
+def _split_results(ret, owners, tag_list=None):
+    '''
+    Split the results of a nova module run over the profiles of several
+    audits. ``owners`` maps profile names to the set of indexes of the audits
+    which include them. If the audits have different tag globs, ``tag_list``
+    holds the glob of each audit, and results only go to the audits whose
+    glob their tag matches. Returns a dict of results by audit index, or None
+    if some result can't be attributed to its profile.
+    '''
+    split = {}
+    for status, entries in ret.iteritems():
+        if not isinstance(entries, list):
+            return None
+        for entry in entries:
+            profile = entry.get('nova_profile') if isinstance(entry, dict) else None
+            if profile not in owners or owners[profile] is None:
+                return None
+            if tag_list is not None and not isinstance(entry.get('tag'), basestring):
+                return None
+            for index in owners[profile]:
+                if tag_list is not None and not fnmatch.fnmatch(entry['tag'], tag_list[index]):
+                    continue
+                split.setdefault(index, {}).setdefault(status, []).append(copy.deepcopy(entry))
+    return split
+
+
+def _run_audit(configs, tags, debug, labels, force_full=False, **kwargs):
+    return _run_audits([configs], tags, debug, labels, force_full=force_full, **kwargs)[0]
+
+
+def _run_audits(config_lists, tags, debug, labels, force_full=False, **kwargs):
+    '''
+    Run the audits of several lists of configs in one pass over the nova
+    modules, and return their results in the same order. ``tags`` is the tag
+    glob of all the audits, or a list of the glob of each audit.
+
+    Each module runs once over the union of the profiles. Its results are
+    split back by their ``nova_profile`` (and ``tag``, if the audits have
+    different tag globs); if a module doesn't tag all its results with their
+    profile, it runs again for each audit instead.
+    '''
+    tag_list = tags if isinstance(tags, list) else [tags] * len(config_lists)
+    mixed_tags = len(set(tag_list)) > 1
+    tags = '*' if mixed_tags else tag_list[0]
+    selected = [_select_profiles(configs) for configs in config_lists]
+    all_results = []
+    for _, errors in selected:
+        all_results.append({'Errors': list(errors)} if errors else {})
+    union = set()
+    for to_run, _ in selected:
+        union.update(to_run)
+
+    # Which audits each profile name belongs to. Names shared by profiles of
+    # different audits can't be attributed.
+    owners = {}
+    for key in union:
+        name = key.split('.yaml')[0].split(os.path.sep)[-1]
+        indexes = frozenset(index for index, (to_run, _) in enumerate(selected)
+                            if key in to_run)
+        if owners.get(name, indexes) != indexes:
+            indexes = None
+        owners[name] = indexes
+
+    # With different tag globs, modules run with all the tags, over the
+    # checks matching the globs of the audits of each profile
+    tag_filters = None
+    if mixed_tags:
+        tag_filters = {}
+        for name, indexes in owners.items():
+            globs = set(tag_list[index] for index in indexes or ())
+            if indexes is not None and '*' not in globs:
+                tag_filters[name] = sorted(globs)
 
     # compile list of tuples with profile name and profile data
-    data_list = [(key.split('.yaml')[0].split(os.path.sep)[-1],
-                  __nova__.__data__[key]) for key in to_run]
+    data_list = _data_list(union)
     if debug:
         log.debug('trubble.py configs:')
-        log.debug(configs)
+        log.debug(config_lists)
         log.debug('trubble.py data_list:')
         log.debug(data_list)
     # Run the audits
-    # This is currently pretty brute-force -- we just run all the modules we
-    # have available with the data list, so data will be processed multiple
-    # times. However, for the scale we're working at this should be fine.
-    # We can revisit if this ever becomes a big bottleneck
-    for key, func in __nova__._dict.iteritems():
-        try:
-            ret = func(data_list, tags, labels, **kwargs)
-        except Exception as exc:
-            log.error('Exception occurred in nova module:')
-            log.error(traceback.format_exc())
-            if 'Errors' not in results:
-                results['Errors'] = []
-            results['Errors'].append({key: {'error': 'exception occurred',
-                                            'data': traceback.format_exc().splitlines()[-1]}})
+    # Every module runs with the whole data list, and picks the data it
+    # handles out of it
+    modules = list(__nova__._dict.iteritems())
+    # The installed packages, read at most once for all the modules
+    inventory = pkginventory.PackageInventory(__salt__, __grains__)
+    outcomes = _run_modules([((key, None), func, data_list, tags) for key, func in modules],
+                            labels, force_full=force_full, tag_filters=tag_filters,
+                            pkg_inventory=inventory, **kwargs)
+    splits = {}
+    rerun = []
+    subsets = [_data_list(to_run) for to_run, _ in selected] if len(config_lists) > 1 else []
+    for key, func in modules:
+        ret, error = outcomes[(key, None)]
+        if len(config_lists) == 1:
             continue
+        if error is None:
+            splits[key] = _split_results(ret, owners, tag_list if mixed_tags else None)
         else:
-            if not isinstance(ret, dict):
-                if 'Errors' not in results:
-                    results['Errors'] = []
-                results['Errors'].append({key: {'error': 'bad return type',
-                                                'data': ret}})
-                continue
+            splits[key] = None
+        if splits[key] is None:
+            if error is None:
+                log.debug('Results of nova module {0} are not tagged with their '
+                          'profile, running it for each audit'.format(key))
+            rerun.extend(((key, index), func, subsets[index], tag_list[index])
+                         for index in range(len(selected)))
+    if rerun:
+        outcomes.update(_run_modules(rerun, labels, force_full=force_full,
+                                     pkg_inventory=inventory, **kwargs))
+
+    for key, _ in modules:
+        ret, error = outcomes[(key, None)]
+        if len(config_lists) == 1:
+            rets = {0: ret} if error is None else {}
+            errors = {0: error} if error is not None else {}
+        else:
+            rets = splits[key]
+            errors = {}
+            if rets is None:
+                rets = {}
+                for index in range(len(selected)):
+                    rets[index], errors[index] = outcomes[(key, index)]
 
         # Merge in the results
-        for key, val in ret.iteritems():
-            if key not in results:
-                results[key] = []
-            results[key].extend(val)
+        for index, results in enumerate(all_results):
+            if errors.get(index) is not None:
+                results.setdefault('Errors', []).append(errors[index])
+            for status, val in (rets.get(index) or {}).iteritems():
+                if status not in results:
+                    results[status] = []
+                results[status].extend(val)
 
+    for index, (to_run, _) in enumerate(selected):
+        _apply_controls(all_results[index], _data_list(to_run), debug)
+    return all_results
+
+
+def _apply_controls(results, data_list, debug):
+    '''
+    Move the failures which have a compensating control in the audit data
+    to ``Controlled``, and drop empty result lists
+    '''
     processed_controls = {}
     # Inspect the data for compensating control data
     for _, audit_data in data_list:
@@ -357,7 +1033,8 @@ def top(topfile='top.nova',
         show_compliance=None,
         show_profile=None,
         debug=None,
-        labels=None):
+        labels=None,
+        force_full=False):
     '''
     Compile and run all yaml data from the specified nova topfile.
 
@@ -388,6 +1065,9 @@ def top(topfile='top.nova',
     after the yaml file (turning it into a dictionary). See the last two lines
     in the yaml above for examples.
 
+    All the entries are audited in a single pass: each nova module runs once,
+    over the checks of every profile matching its tag filter.
+
 
     Arguments:
 
@@ -419,6 +1099,10 @@ def top(topfile='top.nova',
         False. Configurable via `trubblestack:nova:debug` in minion
         config/pillar.
 
+    force_full
+        Run every nova module, rather than reusing the results of the modules
+        whose inputs didn't change since their last run. Defaults to False.
+
     CLI Examples:
 
     .. code-block:: bash
@@ -477,15 +1161,14 @@ def top(topfile='top.nova',
     if not data_by_tag:
         return results
 
-    # Run the audits
-    for tag, data in data_by_tag.iteritems():
-        ret = audit(configs=data,
-                    tags=tag,
-                    verbose=verbose,
-                    show_success=True,
-                    show_compliance=False,
-                    called_from_top=True,
-                    labels=labels)
+    # Run the audits of all the tag filters in one pass over the nova modules
+    groups = [_audit_options(data, tag, verbose, True, False, None, debug, labels, None)
+              for tag, data in data_by_tag.iteritems()]
+    rets = _run_audits([group['configs'] for group in groups],
+                       [group['tags'] for group in groups], debug, groups[0]['labels'],
+                       force_full=force_full, **groups[0]['nova_kwargs'])
+    for ret in rets:
+        ret = _format_audit(ret, verbose, True, False, True)
 
         # Merge in the results
         for key, val in ret.iteritems():
@@ -527,11 +1210,18 @@ def sync(clean=False):
 
     Modules and profiles will be cached in the normal minion cachedir
 
-    Returns a boolean representing success
+    Returns the list of synced profiles
+
+    By default (``trubblestack:nova:sync_mode: manifest``) the profiles are
+    synced from a manifest of their hashes: only new and changed files are
+    fetched, and files which were removed from the fileserver are deleted.
+    When the daemon's fileserver snapshot hasn't changed since the last sync,
+    nothing is checked at all. With ``sync_mode: cache_dir`` the whole
+    directory is fetched with cp.cache_dir, which doesn't clean out old
+    files.
 
-    NOTE: This function will optionally clean out existing files at the cached
-    location, as cp.cache_dir doesn't clean out old files. Pass ``clean=True``
-    to enable this behavior
+    Pass ``clean=True`` to remove the synced profiles and sync them all
+    again.
 
     CLI Examples:
 
@@ -558,6 +1248,9 @@ def sync(clean=False):
     else:
         path = 'salt://{0}'.format(nova_profile_dir)
 
+    if __salt__['config.get']('trubblestack:nova:sync_mode', 'manifest') == 'manifest':
+        return _sync_manifest(nova_profile_dir, cached_profile_dir, saltenv, clean)
+
     # Sync the files
     cached = __salt__['cp.cache_dir'](path, saltenv=saltenv)
 
@@ -578,6 +1271,104 @@ def sync(clean=False):
     return synced
 
 
+def _sync_manifest(nova_profile_dir, cached_profile_dir, saltenv, clean):
+    '''
+    Bring the synced profiles in line with the fileserver, using the manifest
+    of the last sync (path -> hash) to transfer only what changed
+    '''
+    manifest_path = os.path.join(__opts__['cachedir'], SYNC_MANIFEST)
+    source = [saltenv, nova_profile_dir]
+    previous = {} if clean else _load_json(manifest_path)
+    if previous.get('source') != source or not os.path.isdir(cached_profile_dir):
+        previous = {}
+    previous_files = previous.get('files', {})
+    trim = os.path.dirname(cached_profile_dir)
+
+    def _synced(files):
+        return sorted(_local_path(saltenv, path).partition(trim)[2] for path in files)
+
+    # A snapshot older than the last fileserver update (made by a single
+    # function run, which doesn't publish one) no longer matches the cache
+    snapshot = fsupdate.current_snapshot(__opts__['cachedir'])
+    if snapshot is not None and previous.get('digest') == snapshot.get('digest'):
+        log.debug('Fileserver unchanged since the last nova sync')
+        return _synced(previous_files)
+
+    prefix = nova_profile_dir.strip('/') + '/'
+    if snapshot is not None:
+        remote = dict((path, hsum) for path, hsum in snapshot['files'].get(saltenv, {}).items()
+                      if path.startswith(prefix))
+    else:
+        remote = {}
+        for path in __salt__['cp.list_master'](saltenv=saltenv, prefix=prefix) or []:
+            ret = __salt__['cp.hash_file']('salt://{0}'.format(path), saltenv=saltenv)
+            remote[path] = ret.get('hsum', '') if isinstance(ret, dict) else ''
+
+    files = {}
+    failed = []
+    fetched = 0
+    for path, hsum in remote.items():
+        if previous_files.get(path) == hsum and hsum and \
+                os.path.isfile(_local_path(saltenv, path)):
+            files[path] = hsum
+            continue
+        cached = __salt__['cp.cache_file']('salt://{0}'.format(path), saltenv=saltenv)
+        if cached:
+            files[path] = hsum
+            fetched += 1
+        else:
+            failed.append(path)
+    # Remove what is no longer on the fileserver, including files left over
+    # by cp.cache_dir syncs
+    removed = 0
+    for dirname, _, filenames in os.walk(cached_profile_dir, topdown=False):
+        for filename in filenames:
+            local = os.path.join(dirname, filename)
+            path = prefix + os.path.relpath(local, cached_profile_dir).replace(os.path.sep, '/')
+            if path in remote:
+                continue
+            try:
+                os.remove(local)
+                removed += 1
+            except OSError as exc:
+                log.error('Could not remove {0}: {1}'.format(local, exc))
+        if dirname != cached_profile_dir and not os.listdir(dirname):
+            os.rmdir(dirname)
+    log.debug('Synced nova profiles: {0} fetched, {1} removed, {2} failed'
+              .format(fetched, removed, len(failed)))
+
+    manifest = {'source': source, 'files': files}
+    if snapshot is not None and not failed:
+        manifest['digest'] = snapshot.get('digest')
+    _save_json(manifest_path, manifest)
+    if failed:
+        raise CommandExecutionError('An error occurred while syncing: {0}'
+                                    .format(', '.join(sorted(failed))))
+    return _synced(files)
+
+
+def _local_path(saltenv, path):
+    return os.path.join(__opts__['cachedir'], 'files', saltenv, path)
+
+
+def _load_json(path):
+    try:
+        with open(path) as fh_:
+            data = json.load(fh_)
+    except (IOError, OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _save_json(path, data):
+    try:
+        with open(path + '.tmp', 'w') as fh_:
+            json.dump(data, fh_)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError) as exc:
+        log.error('Could not write {0}: {1}'.format(path, exc))
+
+
 def load():
     '''
     Load the synced audit modules.
@@ -589,10 +1380,17 @@ def load():
         if not os.path.isdir(nova_dir):
             return False, 'No synced nova modules/profiles found'
 
-    log.debug('loading nova modules')
-
     global __nova__
-    __nova__ = NovaLazyLoader(_trubble_dir(), __opts__, __grains__, __pillar__, __salt__)
+    with _LOAD_LOCK:
+        # The loader is kept between calls, and only reloads the files which
+        # changed since
+        if isinstance(__nova__, NovaLazyLoader) and __nova__.trubble_dir == _trubble_dir():
+            log.debug('refreshing nova modules')
+            __nova__.refresh(__grains__, __pillar__, __salt__)
+        else:
+            log.debug('loading nova modules')
+            __nova__ = NovaLazyLoader(_trubble_dir(), __opts__, __grains__, __pillar__,
+                                      __salt__)
 
     ret = {'loaded': __nova__._dict.keys(),
            'missing': __nova__.missing_modules,
@@ -651,8 +1449,21 @@ def _calculate_compliance(results):
 def _get_top_data(topfile):
     '''
     Helper method to retrieve and parse the nova topfile
+
+    The matching entries are cached until the topfile changes or the daemon
+    refreshes the grains (``grains_generation`` in the opts).
     '''
     topfile = os.path.join(_trubble_dir()[1], topfile)
+    generation = __opts__.get('grains_generation')
+    try:
+        stat = os.stat(topfile)
+        signature = (stat.st_mtime, stat.st_size, stat.st_ino, generation)
+    except OSError:
+        signature = None
+    cached = _TOP_CACHE.get(topfile)
+    if generation is not None and signature is not None and cached \
+            and cached[0] == signature:
+        return list(cached[1])
 
     try:
         with open(topfile) as handle:
@@ -672,4 +1483,6 @@ def _get_top_data(topfile):
         if __salt__['match.compound'](match):
             ret.extend(data)
 
+    if generation is not None and signature is not None:
+        _TOP_CACHE[topfile] = (signature, list(ret))
     return ret
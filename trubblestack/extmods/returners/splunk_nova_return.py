@@ -49,6 +49,8 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 import logging
 
+from trubblestack.spool import returner_spool, spool_splunk_hec
+
 _max_content_bytes = 100000
 http_event_collector_debug = False
 RETRY = False
@@ -458,6 +460,16 @@ class http_event_collector:
         # Method to flush the batch list of events
 
         if len(self.batchEvents) > 0:
+            spool = returner_spool(__opts__)
+            if spool is not None:
+                # The daemon's spool drainer delivers (and retries) the batch
+                spool_splunk_hec(spool, [x[0] for x in self.server_uri if x[1] is not False],
+                                 self.token, ' '.join(self.batchEvents),
+                                 ssl_verify=self.http_event_collector_ssl_verify,
+                                 proxy=self.proxy, timeout=self.timeout)
+                self.batchEvents = []
+                self.currentByteLength = 0
+                return
             headers = {'Authorization': 'Splunk ' + self.token}
             self.server_uri = [x for x in self.server_uri if x[1] is not False]
             success = False
@@ -66,6 +66,7 @@ command:
 from __future__ import absolute_import
 import logging
 
+import copy
 import fnmatch
 import re
 import salt.utils
@@ -174,6 +175,7 @@ def _merge_yaml(ret, data, profile=None):
         ret['command'] = []
     if 'command' in data:
         for key, val in data['command'].iteritems():
+            val = copy.deepcopy(val)
             if profile and isinstance(val, dict):
                 val['nova_profile'] = profile
             ret['command'].append({key: val})
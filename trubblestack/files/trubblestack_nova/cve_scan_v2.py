@@ -5,7 +5,12 @@ TrubbleStack Nova plugin for auditing installed packages.
 This module checks all of a system's local packages and reports if the package
 is vulnerable to a known cve. The cve vunlerablities are gathered via the url in
 the yaml profile, and that data cached at the path
-/var/cache/salt/minion/cve_scan_cache/<os_name>_<version>.json
+/var/cache/salt/minion/cve_scan_cache/<url_hash>.json
+
+The cve data is ingested once per ttl into an sqlite store next to it,
+/var/cache/salt/minion/cve_scan_cache/<url_hash>.sqlite, indexed by package
+name and os version. A scan only reads the advisories of the installed
+packages from the store, rather than loading the whole cve data.
 
 This audit module requires yaml data to execute. It will search the local
 directory for any .yaml files, and if it finds a top-level 'cve_scan_v2' key, it
@@ -87,6 +92,12 @@ import json
 import os
 import requests
 
+try:
+    import sqlite3
+    HAS_SQLITE = True
+except ImportError:
+    HAS_SQLITE = False
+
 from distutils.version import LooseVersion
 from time import time as current_time
 from zipfile import ZipFile
@@ -97,6 +108,18 @@ import salt.utils.platform
 
 log = logging.getLogger(__name__)
 
+# Bump when the layout of the advisory store changes, older stores are rebuilt
+STORE_VERSION = 1
+STORE_SCHEMA = '''
+CREATE TABLE advisory (id INTEGER PRIMARY KEY, title TEXT, score REAL,
+                       reporter TEXT, href TEXT, cvelist TEXT);
+CREATE TABLE affected (advisory INTEGER, os TEXT, os_version TEXT, pkg TEXT,
+                       version TEXT, operator TEXT);
+'''
+STORE_INDEX = 'CREATE INDEX affected_pkg ON affected (pkg, os_version)'
+# Packages looked up per query, sqlite limits the number of query parameters
+QUERY_CHUNK = 500
+
 
 def __virtual__():
     return not salt.utils.platform.is_windows()
@@ -143,83 +166,48 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
             cached_zip = os.path.join(__opts__['cachedir'],
                                       'cve_scan_cache',
                                       '%s.zip' % urlhash)
+            cached_db = os.path.join(__opts__['cachedir'],
+                                     'cve_scan_cache',
+                                     '%s.sqlite' % urlhash)
             # Make cache directory and all parent directories if it doesn't exist.
             if not os.path.exists(os.path.dirname(cached_json)):
                 os.makedirs(os.path.dirname(cached_json))
-            cache = _get_cache(ttl, cached_json)
-            log.debug("valid cache: %s, for url: %s", cache != [], url)
-            endpoints.append((url, cache, cached_json, cached_zip, min_score, profile))
+            endpoints.append((url, ttl, cached_json, cached_zip, cached_db, min_score, profile))
 
     # If we don't find our module in the yaml
     if not endpoints:
         return {}
 
     ret = {'Success': [], 'Failure': [], 'Controlled': []}
-    # Dictionary of {pkg_name: list(pkg_versions)}
-    local_pkgs = __salt__['pkg.list_pkgs'](versions_as_list=True)
+    # Dictionary of {pkg_name: list(pkg_versions)}, from the package snapshot
+    # shared by the nova modules of the audit if trubble passed one
+    pkg_inventory = kwargs.get('pkg_inventory')
+    if pkg_inventory is not None:
+        local_pkgs = pkg_inventory.list_pkgs(versions_as_list=True)
+    else:
+        local_pkgs = __salt__['pkg.list_pkgs'](versions_as_list=True)
 
-    for url, cache, cached_json, cached_zip, min_score, profile in endpoints:
+    for url, ttl, cached_json, cached_zip, cached_db, min_score, profile in endpoints:
         log.debug("url: %s, min_score: %s", url, min_score)
-        if cache:  # Valid cached file
-            master_json = cache
-        else:  # Query the url for cve's
-            if url.startswith('http://') or url.startswith('https://'):
-                if 'vulners.com' in url:
-                    # Vulners api can only handles http:// requests from request.get
-                    if url.startswith('https'):
-                        url.replace('https', 'http', 1)
-                    # Format the url for the request based on operating system.
-                    if url.endswith('/'):
-                        url = url[:-1]
-                    url_final = '%s/api/v3/archive/distributive/?os=%s&version=%s' \
-                                % (url, os_name, os_version)
-                    log.debug('requesting: %s', url_final)
-                    cve_query = requests.get(url_final)
-                    # Confirm that the request was valid.
-                    if cve_query.status_code != 200:
-                        raise Exception('Vulners requests was not successful. Check the url.')
-                    # Save vulners zip attachment in cache location and extract json
-                    try:
-                        with open(cached_zip, 'w') as zip_attachment:
-                            zip_attachment.write(cve_query.content)
-                        zip_file = ZipFile(cached_zip)
-                        zip_file.extractall(os.path.dirname(cached_zip))
-                        os.remove(cached_zip)
-                        extracted_json = os.path.join(__opts__['cachedir'],
-                                                      'cve_scan_cache',
-                                                      '%s_%s.json' % (os_name, str(os_version).replace('.', '')))
-                        log.debug('attempting to open %s', extracted_json)
-                        with open(extracted_json, 'r') as json_file:
-                            master_json = json.load(json_file)
-                        os.remove(extracted_json)
-                    except IOError as ioe:
-                        log.error('The json zip attachment was not able to be extracted from vulners.')
-                        raise ioe
-                else:  # Not a vulners request, external source for cve's
-                    log.debug('requesting: %s', url)
-                    cve_query = requests.get(url)
-                    if cve_query.status_code != 200:
-                        log.error('URL request was not successful.')
-                        raise Exception('The url given is invalid.')
-                    master_json = json.loads(cve_query.text)
-                # Cache results.
-                try:
-                    with open(cached_json, 'w') as cache_file:
-                        json.dump(master_json, cache_file)
-                except IOError:
-                    log.error('The cve results weren\'t able to be cached')
-            elif url.startswith('salt://'):
-                # Cache the file
-                log.debug('getting file from %s', url)
-                cache_file = __salt__['cp.get_file'](url, cached_json)
-                if cache_file:
-                    master_json = json.load(open(cache_file))
-                else:
-                    raise IOError('The file was not able to be retrieved from the salt file server.')
-            else:
-                raise Exception('The url is invalid. It does not begin with http(s):// or salt://')
-
-        affected_pkgs = _get_cve_vulnerabilities(master_json, os_version)
+        store = _open_store(ttl, cached_db) if HAS_SQLITE else None
+        log.debug("valid store: %s, for url: %s", store is not None, url)
+        if store is None:
+            master_json = _get_cache(ttl, cached_json)
+            log.debug("valid cache: %s, for url: %s", master_json != [], url)
+            if not master_json:  # Query the url for cve's
+                master_json = _query_cve_data(url, cached_json, cached_zip, os_name, os_version)
+            if HAS_SQLITE:
+                store = _build_store(master_json, cached_db)
+        if store is not None:
+            # Only the advisories of the installed packages are read from the store
+            try:
+                affected_pkgs = _get_store_vulnerabilities(
+                    store, [pkg for pkg in local_pkgs if pkg not in whitelist])
+            finally:
+                store.close()
+        else:
+            affected_pkgs = _get_cve_vulnerabilities(master_json, os_version)
+        master_json = None
 
         # Check all local packages against cve vulnerablities in affected_pkgs
         for local_pkg in local_pkgs:
@@ -273,6 +261,174 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
     return ret
 
 
+def _query_cve_data(url, cached_json, cached_zip, os_name, os_version):
+    '''
+    Queries the url for cve's, caches and returns the cve data.
+    '''
+    if url.startswith('http://') or url.startswith('https://'):
+        if 'vulners.com' in url:
+            # Vulners api can only handles http:// requests from request.get
+            if url.startswith('https'):
+                url.replace('https', 'http', 1)
+            # Format the url for the request based on operating system.
+            if url.endswith('/'):
+                url = url[:-1]
+            url_final = '%s/api/v3/archive/distributive/?os=%s&version=%s' \
+                        % (url, os_name, os_version)
+            log.debug('requesting: %s', url_final)
+            cve_query = requests.get(url_final)
+            # Confirm that the request was valid.
+            if cve_query.status_code != 200:
+                raise Exception('Vulners requests was not successful. Check the url.')
+            # Save vulners zip attachment in cache location and extract json
+            try:
+                with open(cached_zip, 'w') as zip_attachment:
+                    zip_attachment.write(cve_query.content)
+                zip_file = ZipFile(cached_zip)
+                zip_file.extractall(os.path.dirname(cached_zip))
+                os.remove(cached_zip)
+                extracted_json = os.path.join(os.path.dirname(cached_zip),
+                                              '%s_%s.json' % (os_name, str(os_version).replace('.', '')))
+                log.debug('attempting to open %s', extracted_json)
+                with open(extracted_json, 'r') as json_file:
+                    master_json = json.load(json_file)
+                os.remove(extracted_json)
+            except IOError as ioe:
+                log.error('The json zip attachment was not able to be extracted from vulners.')
+                raise ioe
+        else:  # Not a vulners request, external source for cve's
+            log.debug('requesting: %s', url)
+            cve_query = requests.get(url)
+            if cve_query.status_code != 200:
+                log.error('URL request was not successful.')
+                raise Exception('The url given is invalid.')
+            master_json = json.loads(cve_query.text)
+        # Cache results.
+        try:
+            with open(cached_json, 'w') as cache_file:
+                json.dump(master_json, cache_file)
+        except IOError:
+            log.error('The cve results weren\'t able to be cached')
+        return master_json
+    elif url.startswith('salt://'):
+        # Cache the file
+        log.debug('getting file from %s', url)
+        cache_file = __salt__['cp.get_file'](url, cached_json)
+        if cache_file:
+            with open(cache_file) as json_file:
+                return json.load(json_file)
+        raise IOError('The file was not able to be retrieved from the salt file server.')
+    raise Exception('The url is invalid. It does not begin with http(s):// or salt://')
+
+
+def _os_versions():
+    '''
+    OSVersion values of the cve data that match the current operating system.
+    '''
+    return ['any', str(__grains__.get('osmajorrelease', None)), str(__grains__.get('osrelease', None))]
+
+
+def _open_store(ttl, store_path):
+    '''
+    Returns a connection to the advisory store if it was built less than ttl
+    seconds ago, else None.
+    '''
+    try:
+        built_time = os.path.getmtime(store_path)
+    except OSError:
+        return None
+    if current_time() - built_time >= ttl:
+        log.debug('%s was older than ttl', store_path)
+        return None
+    try:
+        conn = sqlite3.connect(store_path)
+        if conn.execute('PRAGMA user_version').fetchone()[0] == STORE_VERSION:
+            return conn
+        conn.close()
+    except sqlite3.Error as exc:
+        log.warning('%s could not be read: %s', store_path, exc)
+    return None
+
+
+def _build_store(query_results, store_path):
+    '''
+    Ingests the cve data into the advisory store at store_path and returns a
+    connection to it, or None if the store could not be written.
+
+    The store is built aside and renamed in place, so that concurrent scans
+    read either the previous store or the new one.
+    '''
+    os_versions = _os_versions()
+    tmp_path = '%s.%s.tmp' % (store_path, os.getpid())
+    try:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.execute('PRAGMA journal_mode = OFF')
+            conn.execute('PRAGMA synchronous = OFF')
+            conn.executescript(STORE_SCHEMA)
+            for advisory_id, report in enumerate(query_results):
+                try:
+                    source = report['_source']
+                    conn.execute('INSERT INTO advisory VALUES (?, ?, ?, ?, ?, ?)',
+                                 (advisory_id,
+                                  source.get('title', 'No Title Given'),
+                                  source['cvss'].get('score', 0),
+                                  source.get('reporter', ''),
+                                  source.get('href', ''),
+                                  json.dumps(source.get('cvelist', []))))
+                    rows = []
+                    for pkg in source['affectedPackage']:
+                        try:
+                            rows.append((advisory_id, pkg.get('OS'), pkg['OSVersion'],
+                                         pkg['packageName'], pkg['packageVersion'],
+                                         pkg['operator']))
+                        except KeyError:
+                            # Entries of other operating systems were never used
+                            if pkg.get('OSVersion') in os_versions:
+                                raise
+                    conn.executemany('INSERT INTO affected VALUES (?, ?, ?, ?, ?, ?)', rows)
+                except (KeyError, AttributeError, TypeError):
+                    log.error('Format error at: %s', report)
+                    raise KeyError('The cve data was not formatted correctly')
+            conn.execute(STORE_INDEX)
+            conn.execute('PRAGMA user_version = %d' % STORE_VERSION)
+            conn.commit()
+        finally:
+            conn.close()
+        os.rename(tmp_path, store_path)
+        return sqlite3.connect(store_path)
+    except (sqlite3.Error, OSError, IOError) as exc:
+        log.error('The cve data could not be stored in %s: %s', store_path, exc)
+        return None
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _get_store_vulnerabilities(store, pkg_names):
+    '''
+    Returns dictionary of vulnerablities of the given packages, mapped as
+    pkg_name:pkgObj, read from the advisory store.
+    '''
+    vulnerable_pkgs = {}
+    os_versions = _os_versions()
+    for start in range(0, len(pkg_names), QUERY_CHUNK):
+        chunk = pkg_names[start:start + QUERY_CHUNK]
+        query = ('SELECT affected.pkg, affected.version, affected.operator, advisory.title, '
+                 'advisory.score, advisory.reporter, advisory.href, advisory.cvelist '
+                 'FROM affected JOIN advisory ON advisory.id = affected.advisory '
+                 'WHERE affected.pkg IN (%s) AND affected.os_version IN (?, ?, ?) '
+                 'ORDER BY affected.rowid' % ', '.join('?' * len(chunk)))
+        for pkg, version, operator, title, score, reporter, href, cve_list in \
+                store.execute(query, list(chunk) + os_versions):
+            pkg_obj = VulnerablePkg(title, pkg, version, score, operator, reporter, href,
+                                    json.loads(cve_list))
+            vulnerable_pkgs.setdefault(pkg, []).append(pkg_obj)
+    return vulnerable_pkgs
+
+
 def _get_cve_vulnerabilities(query_results, os_version):
     '''
     Returns dictionary of vulnerablities, mapped as pkg_name:pkgObj.
@@ -290,7 +446,7 @@ def _get_cve_vulnerabilities(query_results, os_version):
 
             for pkg in report['_source']['affectedPackage']:
                 # _source:affectedPackages
-                if pkg['OSVersion'] in ['any', str(__grains__.get('osmajorrelease', None)), str(__grains__.get('osrelease', None))]:  # Only use matching os
+                if pkg['OSVersion'] in _os_versions():  # Only use matching os
                     pkg_obj = VulnerablePkg(title, pkg['packageName'], pkg['packageVersion'],
                                             score, pkg['operator'], reporter, href, cve_list)
                     if pkg_obj.pkg not in vulnerable_pkgs:
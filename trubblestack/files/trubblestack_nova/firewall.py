@@ -194,6 +194,7 @@ def _merge_yaml(ret, data, profile=None):
             if topkey not in ret['firewall']:
                 ret['firewall'][topkey] = []
             for key, val in data['firewall'][topkey].iteritems():
+                val = copy.deepcopy(val)
                 if profile and isinstance(val, dict):
                     val['nova_profile'] = profile
                 ret['firewall'][topkey].append({key: val})
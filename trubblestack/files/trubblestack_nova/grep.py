@@ -50,6 +50,14 @@ the file is missing, then it will be considered a match (success for whitelist,
 failure for blacklist). If it's set to False and the file is missing, then it
 will be considered a non-match (success for blacklist, failure for whitelist).
 If the file exists, this setting is ignored.
+
+The checks are evaluated in process rather than by running grep for each of
+them: each file is read once per audit, and the patterns are translated to
+python regular expressions. The common grep options (-E, -F, -G, -i, -v, -c,
+-w, -x, -n, -q, -s, -A, -B, -C) are supported; checks using other options,
+or patterns which can't be translated reliably, run the grep command as
+before. Set ``trubblestack:nova:grep_in_process`` to False to always run
+the grep command.
 '''
 from __future__ import absolute_import
 import logging
@@ -60,11 +68,15 @@ import copy
 import salt.utils
 import salt.utils.platform
 import re
+import shlex
 
 from distutils.version import LooseVersion
 
 log = logging.getLogger(__name__)
 
+# Larger files are left to the grep command
+MAX_FILE_SIZE = 16 * 1024 * 1024
+
 
 def __virtual__():
     if salt.utils.platform.is_windows():
@@ -96,10 +108,7 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
     '''
     Run the grep audits contained in the YAML files processed by __virtual__
     '''
-    __data__ = {}
-    for profile, data in data_list:
-        _merge_yaml(__data__, data, profile)
-    __data__ = apply_labels(__data__, labels)
+    __data__ = _get_data(data_list, labels, kwargs)
     __tags__ = _get_tags(__data__)
 
     if debug:
@@ -108,6 +117,10 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
         log.debug('grep audit __tags__:')
         log.debug(__tags__)
 
+    grep = _grep
+    if __tags__ and __salt__['config.get']('trubblestack:nova:grep_in_process', True):
+        grep = GrepEngine().grep
+
     ret = {'Success': [], 'Failure': [], 'Controlled': []}
     for tag in __tags__:
         if fnmatch.fnmatch(tag, tags):
@@ -132,9 +145,9 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
                 if isinstance(grep_args, str):
                     grep_args = [grep_args]
 
-                grep_ret = _grep(name,
-                                 tag_data['pattern'],
-                                 *grep_args).get('stdout')
+                grep_ret = grep(name,
+                                tag_data['pattern'],
+                                *grep_args).get('stdout')
 
                 found = False
                 failure_reason = ''
@@ -199,6 +212,46 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
     return ret
 
 
+def inputs(data_list, tags, labels, **kwargs):
+    '''
+    Files the grep audits read, for trubble to reuse their results while the
+    files don't change. None if some check reads other files too, or uses
+    options only the grep command supports.
+    '''
+    __tags__ = _get_tags(_get_data(data_list, labels, kwargs))
+    ret = []
+    for tag in __tags__:
+        if fnmatch.fnmatch(tag, tags):
+            for tag_data in __tags__[tag]:
+                if 'control' in tag_data or 'pattern' not in tag_data:
+                    continue
+                grep_args = tag_data.get('grep_args', [])
+                if isinstance(grep_args, str):
+                    grep_args = [grep_args]
+                try:
+                    _, positional = _parse_grep_cmd(tag_data['name'], tag_data['pattern'],
+                                                    grep_args)
+                except UnsupportedGrep:
+                    return None
+                ret.append(('file', tag_data['name']))
+                ret.append(('file', positional[1]))
+    return ret
+
+
+def _get_data(data_list, labels, kwargs):
+    '''
+    The grep checks of the profiles, filtered by labels
+    '''
+    audit_plan = kwargs.get('audit_plan')
+    if audit_plan is not None:
+        # Merged, filtered by labels and resolved for this osfinger by trubble
+        return audit_plan.section('grep', ('blacklist', 'whitelist'))
+    __data__ = {}
+    for profile, data in data_list:
+        _merge_yaml(__data__, data, profile)
+    return apply_labels(__data__, labels)
+
+
 def _merge_yaml(ret, data, profile=None):
     '''
     Merge two yaml dicts together at the grep:blacklist and grep:whitelist level
@@ -210,6 +263,7 @@ def _merge_yaml(ret, data, profile=None):
             if topkey not in ret['grep']:
                 ret['grep'][topkey] = []
             for key, val in data['grep'][topkey].iteritems():
+                val = copy.deepcopy(val)
                 if profile and isinstance(val, dict):
                     val['nova_profile'] = profile
                 ret['grep'][topkey].append({key: val})
@@ -271,6 +325,299 @@ def _get_tags(data):
     return ret
 
 
+class UnsupportedGrep(Exception):
+    '''
+    The grep invocation can't be evaluated in process
+    '''
+
+
+_POSIX_CLASSES = {'alpha': 'a-zA-Z',
+                  'digit': '0-9',
+                  'alnum': 'a-zA-Z0-9',
+                  'upper': 'A-Z',
+                  'lower': 'a-z',
+                  'xdigit': '0-9A-Fa-f',
+                  'space': ' \\t\\n\\r\\f\\v',
+                  'blank': ' \\t',
+                  'punct': re.escape('!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~')}
+
+# Escapes which mean the same to grep and to python (word classes and
+# boundaries, back references and escaped punctuation)
+_SAME_ESCAPES = set('wWsSbB123456789.\\/*+?[]{}()|^$-_ ,:;=#@%&~!"\'`')
+
+
+class GrepEngine(object):
+    '''
+    Evaluates grep invocations in process, with the result ``_grep`` would
+    return. Each file is read once, and each pattern compiled once, for the
+    lifetime of the engine (one audit).
+    '''
+
+    def __init__(self):
+        self.files = {}
+        self.regexes = {}
+
+    def grep(self, path, pattern, *args):
+        '''
+        Same as ``_grep``, which it falls back to for the invocations it
+        doesn't support
+        '''
+        try:
+            return self._grep(path, pattern, args)
+        except UnsupportedGrep as exc:
+            log.debug('Running grep for {0} {1}: {2}'.format(path, pattern, exc))
+            return _grep(path, pattern, *args)
+
+    def _grep(self, path, pattern, args):
+        opts, positional = _parse_grep_cmd(path, pattern, args)
+        pattern, path = positional
+        regex = self._regex(pattern, opts)
+        lines = self._lines(path)
+        if isinstance(lines, EnvironmentError):
+            return {'stdout': '',
+                    'stderr': 'grep: {0}: {1}'.format(path, lines.strerror),
+                    'retcode': 2}
+
+        matches = [bool(regex.search(line)) != opts['v'] for line in lines]
+        retcode = 0 if any(matches) else 1
+        if opts['q']:
+            out = []
+        elif opts['c']:
+            out = [str(sum(matches))]
+        else:
+            out = _output_lines(lines, matches, opts)
+        return {'stdout': '\n'.join(out).rstrip(), 'stderr': '', 'retcode': retcode}
+
+    def _lines(self, path):
+        '''
+        Lines of ``path``, or the error reading it
+        '''
+        if path not in self.files:
+            try:
+                with open(path, 'rb') as fh_:
+                    if os.fstat(fh_.fileno()).st_size > MAX_FILE_SIZE:
+                        raise UnsupportedGrep('file too large')
+                    content = fh_.read()
+            except EnvironmentError as exc:
+                self.files[path] = exc
+            else:
+                if '\0' in content:
+                    # grep only reports whether binary files match
+                    raise UnsupportedGrep('binary file')
+                lines = content.split('\n')
+                if lines[-1] == '':
+                    lines.pop()
+                self.files[path] = lines
+        return self.files[path]
+
+    def _regex(self, pattern, opts):
+        key = (pattern, opts['mode'], opts['i'], opts['w'], opts['x'])
+        if key not in self.regexes:
+            if '\n' in pattern:
+                raise UnsupportedGrep('several patterns')
+            if opts['mode'] == 'F':
+                regex = re.escape(pattern)
+            else:
+                regex = _translate_pattern(pattern, opts['mode'] == 'E')
+            if opts['x']:
+                regex = '^(?:{0})$'.format(regex)
+            elif opts['w']:
+                regex = r'(?<!\w)(?:{0})(?!\w)'.format(regex)
+            try:
+                self.regexes[key] = re.compile(regex, re.IGNORECASE if opts['i'] else 0)
+            except (re.error, OverflowError) as exc:
+                raise UnsupportedGrep('pattern {0}: {1}'.format(pattern, exc))
+        return self.regexes[key]
+
+
+def _parse_grep_cmd(path, pattern, args):
+    '''
+    Options, pattern and file of the grep command ``_grep`` runs
+    '''
+    path = os.path.expanduser(path)
+    # Split the command line the way cmd.run_all does without a shell
+    cmd = r'''grep  {options} {pattern} {path}'''.format(options=' '.join(args),
+                                                         pattern=pattern,
+                                                         path=path)
+    try:
+        cmd.encode('ascii')
+        argv = shlex.split(cmd)[1:]
+    except (UnicodeError, ValueError) as exc:
+        raise UnsupportedGrep(str(exc))
+    opts, positional = _parse_grep_args(argv)
+    if len(positional) != 2:
+        raise UnsupportedGrep('needs exactly one pattern and one file')
+    return opts, positional
+
+
+def _parse_grep_args(argv):
+    '''
+    Options and positional arguments of a grep command line, parsed like
+    GNU grep does (options may follow the pattern)
+    '''
+    opts = {'mode': 'G', 'A': 0, 'B': 0}
+    opts.update((flag, False) for flag in 'icvwxnqs')
+    positional = []
+    argv = list(argv)
+    while argv:
+        arg = argv.pop(0)
+        if arg == '--':
+            positional.extend(argv)
+            break
+        if not arg.startswith('-') or arg == '-':
+            positional.append(arg)
+            continue
+        if arg.startswith('--'):
+            raise UnsupportedGrep('option {0}'.format(arg))
+        index = 1
+        while index < len(arg):
+            flag = arg[index]
+            index += 1
+            if flag in 'ABC':
+                value = arg[index:]
+                index = len(arg)
+                if not value:
+                    if not argv:
+                        raise UnsupportedGrep('option -{0} without a value'.format(flag))
+                    value = argv.pop(0)
+                try:
+                    value = int(value)
+                except ValueError:
+                    raise UnsupportedGrep('option -{0} {1}'.format(flag, value))
+                if value < 0:
+                    raise UnsupportedGrep('option -{0} {1}'.format(flag, value))
+                if flag in 'AC':
+                    opts['A'] = value
+                if flag in 'BC':
+                    opts['B'] = value
+            elif flag in 'EFG':
+                opts['mode'] = flag
+            elif flag in 'icvwxnqs':
+                opts[flag] = True
+            else:
+                raise UnsupportedGrep('option -{0}'.format(flag))
+    return opts, positional
+
+
+def _translate_pattern(pattern, extended):
+    '''
+    Python regular expression for a grep basic (or ``extended``) regular
+    expression. Raises UnsupportedGrep for what it can't translate reliably.
+    '''
+    ret = []
+    index = 0
+    # Whether the next character starts an expression, where a BRE treats
+    # ``*`` as a literal and ``^`` as an anchor
+    start = True
+    while index < len(pattern):
+        char = pattern[index]
+        index += 1
+        at_start = start
+        start = False
+        if char == '\\':
+            if index >= len(pattern):
+                raise UnsupportedGrep('trailing backslash')
+            char = pattern[index]
+            index += 1
+            if char in '<>':
+                ret.append(r'\b')
+            elif not extended and char in '(){}|+?':
+                # Operators in a BRE
+                ret.append(char)
+                start = char in '(|'
+            elif char in _SAME_ESCAPES:
+                ret.append('\\' + char)
+            else:
+                raise UnsupportedGrep('escape \\{0}'.format(char))
+        elif char == '[':
+            index = _translate_bracket(pattern, index, ret)
+        elif extended:
+            ret.append(char)
+            start = char in '(|'
+        elif char in '(){}|+?':
+            ret.append('\\' + char)
+        elif char == '*' and at_start:
+            ret.append(r'\*')
+        elif char == '^':
+            ret.append('^' if at_start else r'\^')
+            start = at_start
+        elif char == '$':
+            end = index == len(pattern) or pattern[index:index + 2] in ('\\)', '\\|')
+            ret.append('$' if end else r'\$')
+        else:
+            ret.append(char)
+    return ''.join(ret)
+
+
+def _translate_bracket(pattern, index, ret):
+    '''
+    Translate the bracket expression starting after ``pattern[index - 1]``
+    into ``ret``, and return the index after it. In a bracket expression
+    backslashes are literals, and ``[:class:]`` names a character class.
+    '''
+    out = ['[']
+    if pattern[index:index + 1] == '^':
+        out.append('^')
+        index += 1
+    first = True
+    while True:
+        if index >= len(pattern):
+            raise UnsupportedGrep('unterminated bracket expression')
+        char = pattern[index]
+        index += 1
+        if char == ']' and not first:
+            break
+        first = False
+        if char == '[' and pattern[index:index + 1] in (':', '=', '.'):
+            kind = pattern[index]
+            end = pattern.find(kind + ']', index + 1)
+            if kind != ':' or end == -1 or pattern[index + 1:end] not in _POSIX_CLASSES:
+                raise UnsupportedGrep('bracket expression {0}'.format(pattern))
+            out.append(_POSIX_CLASSES[pattern[index + 1:end]])
+            index = end + 2
+        elif char.isalnum() or char == '-':
+            out.append(char)
+        else:
+            out.append('\\' + char)
+    out.append(']')
+    ret.append(''.join(out))
+    return index
+
+
+def _output_lines(lines, matches, opts):
+    '''
+    The lines grep prints: the selected lines, with ``-A``/``-B`` lines of
+    context and ``--`` between the groups of lines when there is context
+    '''
+    context = opts['A'] or opts['B']
+    out = []
+    last = None
+    after = 0
+    for number, line in enumerate(lines):
+        if matches[number]:
+            first = max(0, number - opts['B'])
+            if last is not None:
+                first = max(first, last + 1)
+            if context and out and first > last + 1:
+                out.append('--')
+            for before in range(first, number):
+                out.append(_output_line(lines[before], before, '-', opts))
+            out.append(_output_line(line, number, ':', opts))
+            last = number
+            after = opts['A']
+        elif after:
+            out.append(_output_line(line, number, '-', opts))
+            last = number
+            after -= 1
+    return out
+
+
+def _output_line(line, number, separator, opts):
+    if opts['n']:
+        return '{0}{1}{2}'.format(number + 1, separator, line)
+    return line
+
+
 def _grep(path,
           pattern,
           *args):
@@ -41,6 +41,7 @@ misc:
 from __future__ import absolute_import
 import logging
 
+import copy
 import fnmatch
 import os
 import re
@@ -76,10 +77,15 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
     '''
     Run the misc audits contained in the data_list
     '''
-    __data__ = {}
-    for profile, data in data_list:
-        _merge_yaml(__data__, data, profile)
-    __data__ = apply_labels(__data__, labels)
+    audit_plan = kwargs.get('audit_plan')
+    if audit_plan is not None:
+        # Merged, filtered by labels and resolved for this osfinger by trubble
+        __data__ = audit_plan.section('misc')
+    else:
+        __data__ = {}
+        for profile, data in data_list:
+            _merge_yaml(__data__, data, profile)
+        __data__ = apply_labels(__data__, labels)
     __tags__ = _get_tags(__data__)
 
     if debug:
@@ -136,6 +142,7 @@ def _merge_yaml(ret, data, profile=None):
         ret['misc'] = []
     if 'misc' in data:
         for key, val in data['misc'].iteritems():
+            val = copy.deepcopy(val)
             if profile and isinstance(val, dict):
                 val['nova_profile'] = profile
             ret['misc'].append({key: val})
@@ -171,10 +171,31 @@ def audit(data_list, tags, labels, debug=True, **kwargs):
     return ret
 
 
+def inputs(data_list, tags, labels, **kwargs):
+    '''
+    Certificate files the openssl audits read, for trubble to reuse their
+    results while the files don't change. The days left are counted from the
+    current time, so results are only reused within the hour. None if some
+    check downloads the certificate of an endpoint.
+    '''
+    ret = [('period', 3600)]
+    for _, data in data_list:
+        for check in (data.get('openssl') or {}).values():
+            if not isinstance(check, dict):
+                continue
+            tag_data = check.get('data', {})
+            if tag_data.get('endpoint'):
+                return None
+            if tag_data.get('file'):
+                ret.append(('file', tag_data['file']))
+    return ret
+
+
 def _merge_yaml(ret, data, profile=None):
     if 'openssl' not in ret:
         ret['openssl'] = []
     for key, val in data.get('openssl', {}).iteritems():
+        val = copy.deepcopy(val)
         if profile and isinstance(val, dict):
             val['nova_profile'] = profile
         ret['openssl'].append({key: val})
@@ -99,10 +99,15 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
     '''
     Run the pkg audits contained in the YAML files processed by __virtual__
     '''
-    __data__ = {}
-    for profile, data in data_list:
-        _merge_yaml(__data__, data, profile)
-    __data__ = apply_labels(__data__, labels)
+    audit_plan = kwargs.get('audit_plan')
+    if audit_plan is not None:
+        # Merged, filtered by labels and resolved for this osfinger by trubble
+        __data__ = audit_plan.section('pkg', ('blacklist', 'whitelist'))
+    else:
+        __data__ = {}
+        for profile, data in data_list:
+            _merge_yaml(__data__, data, profile)
+        __data__ = apply_labels(__data__, labels)
     __tags__ = _get_tags(__data__)
 
     if debug:
@@ -111,6 +116,10 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
         log.debug('pkg audit __tags__:')
         log.debug(__tags__)
 
+    # The package snapshot shared by the nova modules of the audit, if trubble
+    # passed one
+    pkg_inventory = kwargs.get('pkg_inventory')
+
     ret = {'Success': [], 'Failure': [], 'Controlled': []}
     for tag in __tags__:
         if fnmatch.fnmatch(tag, tags):
@@ -120,10 +129,14 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
                     continue
                 name = tag_data['name']
                 audittype = tag_data['type']
+                if pkg_inventory is not None:
+                    installed = pkg_inventory.version(name)
+                else:
+                    installed = __salt__['pkg.version'](name)
 
                 # Blacklisted packages (must not be installed)
                 if audittype == 'blacklist':
-                    if __salt__['pkg.version'](name):
+                    if installed:
                         tag_data['failure_reason'] = "Found blacklisted package '{0}'" \
                                                      " installed on the system" \
                                                      .format(name)
@@ -140,8 +153,7 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
                             mod = ''
 
                         if mod == '<':
-                            if (LooseVersion(__salt__['pkg.version'](name)) <=
-                                    LooseVersion(version)):
+                            if LooseVersion(installed) <= LooseVersion(version):
                                 ret['Success'].append(tag_data)
                             else:
                                 tag_data['failure_reason'] = "Could not find requisite package '{0}' with" \
@@ -151,8 +163,7 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
                                 ret['Failure'].append(tag_data)
 
                         elif mod == '>':
-                            if (LooseVersion(__salt__['pkg.version'](name)) >=
-                                    LooseVersion(version)):
+                            if LooseVersion(installed) >= LooseVersion(version):
                                 ret['Success'].append(tag_data)
                             else:
                                 tag_data['failure_reason'] = "Could not find requisite package '{0}' " \
@@ -163,7 +174,7 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
 
                         elif not mod:
                             # Just peg to the version, no > or <
-                            if __salt__['pkg.version'](name) == version:
+                            if installed == version:
                                 ret['Success'].append(tag_data)
                             else:
                                 tag_data['failure_reason'] = "Could not find the version '{0}' of requisite" \
@@ -184,7 +195,7 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
                             ret['Failure'].append(tag_data)
 
                     else:  # No version checking
-                        if __salt__['pkg.version'](name):
+                        if installed:
                             ret['Success'].append(tag_data)
                         else:
                             tag_data['failure_reason'] = "Could not find requisite package '{0}' installed" \
@@ -194,6 +205,14 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
     return ret
 
 
+def inputs(data_list, tags, labels, **kwargs):
+    '''
+    The pkg audits only depend on the installed packages, trubble reuses
+    their results until the package databases change
+    '''
+    return [('pkgdb', None)]
+
+
 def _merge_yaml(ret, data, profile=None):
     '''
     Merge two yaml dicts together at the pkg:blacklist and pkg:whitelist level
@@ -205,6 +224,7 @@ def _merge_yaml(ret, data, profile=None):
             if topkey not in ret['pkg']:
                 ret['pkg'][topkey] = []
             for key, val in data['pkg'][topkey].iteritems():
+                val = copy.deepcopy(val)
                 if profile and isinstance(val, dict):
                     val['nova_profile'] = profile
                 ret['pkg'][topkey].append({key: val})
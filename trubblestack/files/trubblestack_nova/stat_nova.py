@@ -86,10 +86,7 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
     '''
     Run the stat audits contained in the YAML files processed by __virtual__
     '''
-    __data__ = {}
-    for profile, data in data_list:
-        _merge_yaml(__data__, data, profile)
-    __data__ = apply_labels(__data__, labels)
+    __data__ = _get_data(data_list, labels, kwargs)
     __tags__ = _get_tags(__data__)
 
     if debug:
@@ -184,6 +181,36 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
     return ret
 
 
+def inputs(data_list, tags, labels, **kwargs):
+    '''
+    Files the stat audits check, for trubble to reuse their results while the
+    files don't change. The user and group databases map the owners to names.
+    '''
+    __tags__ = _get_tags(_get_data(data_list, labels, kwargs))
+    ret = [('file', '/etc/passwd'), ('file', '/etc/group')]
+    for tag in __tags__:
+        if fnmatch.fnmatch(tag, tags):
+            for tag_data in __tags__[tag]:
+                if 'control' not in tag_data:
+                    ret.append(('file', tag_data['name']))
+                    ret.append(('file', os.path.expanduser(tag_data['name'])))
+    return ret
+
+
+def _get_data(data_list, labels, kwargs):
+    '''
+    The stat checks of the profiles, filtered by labels
+    '''
+    audit_plan = kwargs.get('audit_plan')
+    if audit_plan is not None:
+        # Merged, filtered by labels and resolved for this osfinger by trubble
+        return audit_plan.section('stat')
+    __data__ = {}
+    for profile, data in data_list:
+        _merge_yaml(__data__, data, profile)
+    return apply_labels(__data__, labels)
+
+
 def _merge_yaml(ret, data, profile=None):
     '''
     Merge two yaml dicts together
@@ -191,6 +218,7 @@ def _merge_yaml(ret, data, profile=None):
     if 'stat' not in ret:
         ret['stat'] = []
     for key, val in data.get('stat', {}).iteritems():
+        val = copy.deepcopy(val)
         if profile and isinstance(val, dict):
             val['nova_profile'] = profile
         ret['stat'].append({key: val})
@@ -66,10 +66,7 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
     '''
     Run the sysctl audits contained in the YAML files processed by __virtual__
     '''
-    __data__ = {}
-    for profile, data in data_list:
-        _merge_yaml(__data__, data, profile)
-    __data__ = apply_labels(__data__, labels)
+    __data__ = _get_data(data_list, labels, kwargs)
     __tags__ = _get_tags(__data__)
 
     if debug:
@@ -113,6 +110,35 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
     return ret
 
 
+def inputs(data_list, tags, labels, **kwargs):
+    '''
+    Kernel parameters the sysctl audits check, for trubble to reuse their
+    results while the parameters don't change
+    '''
+    __tags__ = _get_tags(_get_data(data_list, labels, kwargs))
+    ret = []
+    for tag in __tags__:
+        if fnmatch.fnmatch(tag, tags):
+            for tag_data in __tags__[tag]:
+                if 'control' not in tag_data:
+                    ret.append(('sysctl', tag_data['name']))
+    return ret
+
+
+def _get_data(data_list, labels, kwargs):
+    '''
+    The sysctl checks of the profiles, filtered by labels
+    '''
+    audit_plan = kwargs.get('audit_plan')
+    if audit_plan is not None:
+        # Merged, filtered by labels and resolved for this osfinger by trubble
+        return audit_plan.section('sysctl')
+    __data__ = {}
+    for profile, data in data_list:
+        _merge_yaml(__data__, data, profile)
+    return apply_labels(__data__, labels)
+
+
 def _merge_yaml(ret, data, profile=None):
     '''
     Merge two yaml dicts together
@@ -120,6 +146,7 @@ def _merge_yaml(ret, data, profile=None):
     if 'sysctl' not in ret:
         ret['sysctl'] = []
     for key, val in data.get('sysctl', {}).iteritems():
+        val = copy.deepcopy(val)
         if profile and isinstance(val, dict):
             val['nova_profile'] = profile
         ret['sysctl'].append({key: val})
@@ -67,10 +67,15 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
     '''
     Run the systemctl audits contained in the YAML files processed by __virtual__
     '''
-    __data__ = {}
-    for profile, data in data_list:
-        _merge_yaml(__data__, data, profile)
-    __data__ = apply_labels(__data__, labels)
+    audit_plan = kwargs.get('audit_plan')
+    if audit_plan is not None:
+        # Merged, filtered by labels and resolved for this osfinger by trubble
+        __data__ = audit_plan.section('systemctl', ('blacklist', 'whitelist'))
+    else:
+        __data__ = {}
+        for profile, data in data_list:
+            _merge_yaml(__data__, data, profile)
+        __data__ = apply_labels(__data__, labels)
     __tags__ = _get_tags(__data__)
 
     if debug:
@@ -123,6 +128,7 @@ def _merge_yaml(ret, data, profile=None):
             if topkey not in ret['systemctl']:
                 ret['systemctl'][topkey] = []
             for key, val in data['systemctl'][topkey].iteritems():
+                val = copy.deepcopy(val)
                 if profile and isinstance(val, dict):
                     val['nova_profile'] = profile
                 ret['systemctl'][topkey].append({key: val})
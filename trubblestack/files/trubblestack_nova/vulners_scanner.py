@@ -42,7 +42,7 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
     for profile, data in data_list:
         if 'vulners_scanner' in data:
 
-            local_packages = _get_local_packages()
+            local_packages = _get_local_packages(kwargs.get('pkg_inventory'))
             vulners_data = _vulners_query(local_packages, os=os_name, version=os_version)
             if vulners_data['result'] == 'ERROR':
                 log.error(vulners_data['data']['error'])
@@ -58,14 +58,18 @@ def audit(data_list, tags, labels, debug=False, **kwargs):
     return ret
 
 
-def _get_local_packages():
+def _get_local_packages(pkg_inventory=None):
     '''
     Get the packages installed on the system.
 
+    :param pkg_inventory: The package snapshot shared by the nova modules of the audit, if any
     :return: A nice list of packages.
     '''
 
-    local_packages = __salt__['pkg.list_pkgs']()
+    if pkg_inventory is not None:
+        local_packages = pkg_inventory.list_pkgs()
+    else:
+        local_packages = __salt__['pkg.list_pkgs']()
     return ['{0}-{1}'.format(pkg, local_packages[pkg]) for pkg in local_packages]
 
 
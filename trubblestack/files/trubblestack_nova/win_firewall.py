@@ -122,6 +122,7 @@ def _merge_yaml(ret, data, profile=None):
             if topkey not in ret[__virtualname__]:
                 ret[__virtualname__][topkey] = []
             for key, val in data[__virtualname__][topkey].iteritems():
+                val = copy.deepcopy(val)
                 if profile and isinstance(val, dict):
                     val['nova_profile'] = profile
                 ret[__virtualname__][topkey].append({key: val})
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+'''
+Background fileserver updates.
+
+Updating gitfs or s3fs backends can take minutes, so the daemon runs
+``fs.update()`` in a background thread instead of its main loop, and
+scheduled jobs keep running while it happens.
+
+Once an update has finished, the updater publishes a snapshot of the
+fileserver: the hash of every file of every saltenv, a digest of them and a
+generation number which only changes when the content does. The snapshot is
+written atomically to ``<cachedir>/fileserver_snapshot.json``, so consumers
+(including job pool workers) always read a complete manifest, and can tell
+cheaply whether anything changed since they last looked.
+
+The snapshot is only a manifest: files are still served from the backends'
+own caches, which ``fs.update()`` changes in place. A job fetching files
+while an update runs may get some of them from the new content, and the
+published snapshot doesn't describe them until the update has finished.
+
+Every update of the fileserver cache, including the ones made by single
+function runs which don't publish snapshots, is recorded in
+``<cachedir>/fileserver_update.stamp``. A snapshot published before the last
+update is stale, and :func:`current_snapshot` ignores it.
+
+.. code-block:: yaml
+
+    fileserver_update_frequency: 43200
+    # Seconds before retrying a failed update
+    fileserver_retry_rate: 900
+'''
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = 'fileserver_snapshot.json'
+STAMP_FILE = 'fileserver_update.stamp'
+
+
+def snapshot_path(cachedir):
+    return os.path.join(cachedir, SNAPSHOT_FILE)
+
+
+def mark_updated(cachedir):
+    '''
+    Record that the fileserver cache was just updated
+    '''
+    try:
+        with open(os.path.join(cachedir, STAMP_FILE), 'w') as fh_:
+            fh_.write(repr(time.time()))
+    except (IOError, OSError) as exc:
+        log.debug('Could not write the fileserver update stamp: {0}'.format(exc))
+
+
+def last_updated(cachedir):
+    '''
+    When the fileserver cache was last updated (by any process), or None if
+    that is not known
+    '''
+    path = os.path.join(cachedir, STAMP_FILE)
+    try:
+        with open(path) as fh_:
+            return float(fh_.read())
+    except ValueError:
+        # The modification time is less precise than the content
+        return os.path.getmtime(path)
+    except (IOError, OSError):
+        return None
+
+
+def load_snapshot(cachedir):
+    '''
+    Last snapshot published in ``cachedir``, or None if there is none
+    '''
+    try:
+        with open(snapshot_path(cachedir)) as fh_:
+            snapshot = json.load(fh_)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(snapshot, dict) or 'generation' not in snapshot:
+        return None
+    return snapshot
+
+
+def current_snapshot(cachedir):
+    '''
+    Last snapshot published in ``cachedir``, or None if there is none or if
+    the fileserver cache was updated after it was published
+    '''
+    snapshot = load_snapshot(cachedir)
+    if snapshot is None:
+        return None
+    updated = last_updated(cachedir)
+    if updated is not None and snapshot.get('published', 0) < updated:
+        log.debug('The fileserver snapshot predates the last fileserver update')
+        return None
+    return snapshot
+
+
+def build_snapshot(fs):
+    '''
+    ``{saltenv: {path: hash}}`` of all the files served by ``fs``, a
+    ``salt.fileserver.Fileserver``
+    '''
+    files = {}
+    for saltenv in sorted(fs.envs()):
+        hashes = {}
+        for path in fs.file_list({'saltenv': saltenv}):
+            ret = fs.file_hash({'path': path, 'saltenv': saltenv})
+            hashes[path] = ret.get('hsum', '') if isinstance(ret, dict) else ''
+        files[saltenv] = hashes
+    return files
+
+
+def _digest(files):
+    return hashlib.sha256(json.dumps(files, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class FileserverUpdater(object):
+    '''
+    Updates the fileserver backends of ``fileclient`` every ``interval``
+    seconds in a background thread, and publishes a snapshot after each
+    update. The backends are updated in place; running jobs are not isolated
+    from an update in progress.
+
+    on_update
+        Optional callable invoked after each successful update
+    '''
+
+    def __init__(self, fileclient, cachedir, interval, retry_interval=900,
+                 registry=None, on_update=None):
+        self.fileclient = fileclient
+        self.cachedir = cachedir
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.registry = registry
+        self.on_update = on_update
+        self.snapshot = load_snapshot(cachedir)
+        self.running = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def start(self, next_update=None):
+        '''
+        Start the update thread. The first update happens at ``next_update``
+        (a timestamp), or now; if it is not now, a snapshot of the current
+        content is published first.
+        '''
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, args=(next_update,),
+                                        name='trubble-fileserver-update')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def update_now(self):
+        '''
+        Ask the update thread to update as soon as possible
+        '''
+        self._wakeup.set()
+
+    def _loop(self, next_update):
+        if next_update is not None and next_update > time.time():
+            try:
+                self.publish()
+            except Exception:
+                log.exception('Error publishing the fileserver snapshot')
+        else:
+            next_update = time.time()
+        while not self._stopped:
+            self._wakeup.wait(max(0, next_update - time.time()))
+            if self._stopped:
+                break
+            self._wakeup.clear()
+            if self.update():
+                next_update = time.time() + self.interval
+            else:
+                next_update = time.time() + self.retry_interval
+                log.info('Trying the fileserver update again in {0} seconds'
+                         .format(self.retry_interval))
+
+    def update(self):
+        '''
+        Update the fileserver backends and publish a new snapshot. Returns
+        False if the update failed; the previous snapshot stays published.
+        '''
+        started = time.time()
+        self.running = True
+        self._set_gauge('trubble_fileserver_update_running', 1,
+                        'Whether a fileserver update is in progress')
+        ok = False
+        try:
+            self.fileclient.channel.fs.update()
+            if self.on_update is not None:
+                self.on_update()
+            self.publish()
+            ok = True
+        except Exception:
+            log.exception('Exception thrown trying to update fileclient.')
+        finally:
+            elapsed = time.time() - started
+            self.running = False
+            self._set_gauge('trubble_fileserver_update_running', 0,
+                            'Whether a fileserver update is in progress')
+            self._record(elapsed, ok)
+        log.info('Fileserver update {0} in {1:.1f}s'
+                 .format('finished' if ok else 'failed', elapsed))
+        return ok
+
+    def publish(self):
+        '''
+        Snapshot the fileserver content and atomically replace the published
+        snapshot. The generation only changes if the content did.
+        '''
+        files = build_snapshot(self.fileclient.channel.fs)
+        digest = _digest(files)
+        with self._lock:
+            previous = self.snapshot
+            generation = previous['generation'] if previous else 0
+            if not previous or previous.get('digest') != digest:
+                generation += 1
+            snapshot = {'generation': generation,
+                        'digest': digest,
+                        'published': time.time(),
+                        'files': files}
+            path = snapshot_path(self.cachedir)
+            tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'w') as fh_:
+                json.dump(snapshot, fh_)
+            os.rename(tmp_path, path)
+            self.snapshot = snapshot
+        if not previous or previous['generation'] != generation:
+            log.info('Published fileserver snapshot generation {0} ({1} files)'
+                     .format(generation, sum(len(paths) for paths in files.values())))
+        self._set_gauge('trubble_fileserver_snapshot_generation', generation,
+                        'Generation of the published fileserver snapshot')
+        return snapshot
+
+    def _set_gauge(self, name, value, help_text):
+        if self.registry is not None:
+            self.registry.set(name, value, help_text=help_text)
+
+    def _record(self, elapsed, ok):
+        if self.registry is None:
+            return
+        self.registry.inc('trubble_fileserver_updates_total',
+                          {'outcome': 'ok' if ok else 'error'},
+                          help_text='Fileserver updates')
+        self.registry.observe('trubble_fileserver_update_seconds', elapsed,
+                              help_text='Duration of the fileserver updates')
+        self.registry.set('trubble_fileserver_last_update_seconds', elapsed,
+                          help_text='Duration of the last fileserver update')
+        if ok:
+            self.registry.set('trubble_fileserver_last_success_timestamp_seconds',
+                              time.time(),
+                              help_text='When the fileserver was last updated')
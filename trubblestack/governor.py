@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+'''
+Resource governor for scheduled jobs.
+
+Audits and queries run on production hosts, next to the workload they
+protect, so jobs can be given a resource policy in the ``schedule`` config:
+
+.. code-block:: yaml
+
+    schedule:
+      audit_daily:
+        function: trubble.audit
+        seconds: 86400
+        # CPU and IO priority of the worker running the job
+        nice: 10
+        ionice: idle            # idle, best-effort[:level] or realtime[:level]
+        # cgroup v2 limits: percent of one CPU, and memory
+        cpu_quota: 50
+        memory_max_mb: 512
+        # Don't start while the 1 minute load average is above 4; pause the
+        # job (SIGSTOP) while it is above 4 once started. Either wait is
+        # capped to max_defer seconds.
+        max_loadavg: 4
+        loadavg_pause: True
+        max_defer: 3600
+
+Policies apply to the worker process running the job (process lanes only,
+apart from the load average deferral). Such workers are recycled after the
+job, so the next job starts with the daemon's priority and limits.
+
+cgroup limits need cgroup v2 and a delegated cgroup (``Delegate=yes`` in the
+systemd unit). The daemon moves itself to a ``daemon`` leaf of its cgroup,
+and creates a ``job-<name>`` cgroup next to it per job with limits. Set
+``resource_cgroups: False`` to leave cgroups alone.
+'''
+
+import errno
+import logging
+import os
+import re
+import subprocess
+import time
+
+log = logging.getLogger(__name__)
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+POLICY_KEYS = ('nice', 'ionice', 'cpu_quota', 'memory_max_mb', 'max_loadavg',
+               'loadavg_pause', 'max_defer')
+# cgroup v2 cpu.max period, in microseconds
+CPU_PERIOD = 100000
+LOAD_POLL_INTERVAL = 5
+
+# Base cgroup for job cgroups, set up by setup_cgroups()
+CGROUP_BASE = None
+
+
+def loadavg():
+    try:
+        return os.getloadavg()[0]
+    except (OSError, AttributeError):
+        return 0.0
+
+
+class ResourcePolicy(object):
+    '''
+    Validated resource policy of a scheduled job. Raises ``ValueError`` for
+    invalid values.
+    '''
+
+    def __init__(self, name, data):
+        self.name = name
+        try:
+            self.nice = int(data['nice']) if data.get('nice') is not None else None
+            self.ionice = _parse_ionice(data['ionice']) if data.get('ionice') else None
+            self.cpu_quota = float(data['cpu_quota']) if data.get('cpu_quota') else None
+            self.memory_max_mb = int(data['memory_max_mb']) if data.get('memory_max_mb') else None
+            self.max_loadavg = float(data['max_loadavg']) if data.get('max_loadavg') else None
+            self.max_defer = float(data.get('max_defer', 3600))
+        except (TypeError, ValueError) as exc:
+            raise ValueError('Scheduled job {0} has an invalid resource policy: {1}'
+                             .format(name, exc))
+        self.loadavg_pause = bool(data.get('loadavg_pause', False)) and \
+            self.max_loadavg is not None
+
+    @classmethod
+    def from_data(cls, name, data):
+        '''
+        Policy for job ``name``, or None if its config has no policy
+        '''
+        if not any(data.get(key) is not None for key in POLICY_KEYS):
+            return None
+        return cls(name, data)
+
+    @property
+    def process_limits(self):
+        '''
+        Whether the policy changes the worker process running the job
+        '''
+        return self.nice is not None or self.ionice is not None or self.uses_cgroup
+
+    @property
+    def uses_cgroup(self):
+        return self.cpu_quota is not None or self.memory_max_mb is not None
+
+    def load_high(self):
+        return self.max_loadavg is not None and loadavg() > self.max_loadavg
+
+    def defer(self, sleep=time.sleep):
+        '''
+        Wait while the load average is above ``max_loadavg``, for at most
+        ``max_defer`` seconds. Returns the seconds waited.
+        '''
+        if not self.load_high():
+            return 0.0
+        started = time.time()
+        log.info('Load average is above {0}, deferring job {1}'
+                 .format(self.max_loadavg, self.name))
+        while self.load_high() and time.time() - started < self.max_defer:
+            sleep(LOAD_POLL_INTERVAL)
+        return time.time() - started
+
+
+def _parse_ionice(value):
+    '''
+    ``(class, level)`` from ``idle``, ``best-effort:7``...
+    '''
+    value = str(value)
+    name, _, level = value.partition(':')
+    if name not in IONICE_CLASSES:
+        raise ValueError('unknown ionice class {0}'.format(name))
+    return IONICE_CLASSES[name], int(level) if level else None
+
+
+def _write(path, value):
+    with open(path, 'w') as fh_:
+        fh_.write(value)
+
+
+def _own_cgroup():
+    '''
+    cgroup v2 path of this process, relative to the cgroup root
+    '''
+    try:
+        with open('/proc/self/cgroup') as fh_:
+            for line in fh_:
+                if line.startswith('0::'):
+                    return line.strip()[3:]
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def setup_cgroups(root=CGROUP_ROOT, own=None):
+    '''
+    Prepare the daemon's cgroup to hold job cgroups: move the daemon to a
+    ``daemon`` leaf and enable the cpu and memory controllers for its
+    children. Returns the base cgroup directory, or None if cgroup v2 isn't
+    available or delegated to us.
+    '''
+    global CGROUP_BASE
+    CGROUP_BASE = None
+    if not os.path.isfile(os.path.join(root, 'cgroup.controllers')):
+        log.debug('cgroup v2 is not available, cgroup limits are disabled')
+        return None
+    own = own or _own_cgroup()
+    if not own or own == '/':
+        log.info('Not running in a delegated cgroup, cgroup limits are disabled')
+        return None
+    base = os.path.join(root, own.lstrip('/'))
+    if os.path.basename(base) == 'daemon':
+        base = os.path.dirname(base)
+    leaf = os.path.join(base, 'daemon')
+    try:
+        if not os.path.isdir(leaf):
+            os.mkdir(leaf)
+        _write(os.path.join(leaf, 'cgroup.procs'), str(os.getpid()))
+        with open(os.path.join(base, 'cgroup.controllers')) as fh_:
+            available = fh_.read().split()
+        controllers = [name for name in ('cpu', 'memory') if name in available]
+        if controllers:
+            _write(os.path.join(base, 'cgroup.subtree_control'),
+                   ' '.join('+' + name for name in controllers))
+    except (IOError, OSError) as exc:
+        log.info('Could not set up cgroup {0}, cgroup limits are disabled: {1}'
+                 .format(base, exc))
+        return None
+    log.info('Job cgroups will be created in {0}'.format(base))
+    CGROUP_BASE = base
+    return base
+
+
+class JobCgroup(object):
+    '''
+    cgroup of a job, with the CPU and memory limits of its policy
+    '''
+
+    def __init__(self, base, policy):
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', policy.name)
+        self.path = os.path.join(base, 'job-{0}'.format(name))
+        try:
+            os.mkdir(self.path)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        if policy.cpu_quota is not None:
+            _write(os.path.join(self.path, 'cpu.max'), '{0} {1}'.format(
+                int(CPU_PERIOD * policy.cpu_quota / 100), CPU_PERIOD))
+        if policy.memory_max_mb is not None:
+            _write(os.path.join(self.path, 'memory.max'),
+                   str(policy.memory_max_mb * 1024 * 1024))
+        self._throttled = self.throttled_seconds()
+
+    def add(self, pid):
+        _write(os.path.join(self.path, 'cgroup.procs'), str(pid))
+
+    def throttled_seconds(self):
+        '''
+        Total time the cgroup was throttled by its CPU quota
+        '''
+        try:
+            with open(os.path.join(self.path, 'cpu.stat')) as fh_:
+                for line in fh_:
+                    if line.startswith('throttled_usec'):
+                        return int(line.split()[1]) / 1000000.0
+        except (IOError, OSError, ValueError, IndexError):
+            pass
+        return 0.0
+
+    def throttled_since_created(self):
+        return max(0.0, self.throttled_seconds() - self._throttled)
+
+
+def apply(policy, pid=None):
+    '''
+    Apply the process limits of ``policy`` to this process (a job pool
+    worker). Returns the :class:`JobCgroup` of the job, if any. Failures are
+    logged; the job runs regardless.
+    '''
+    pid = pid or os.getpid()
+    if policy.nice is not None:
+        try:
+            os.nice(policy.nice - os.nice(0))
+        except OSError as exc:
+            log.warning('Could not set the niceness of job {0}: {1}'.format(policy.name, exc))
+    if policy.ionice is not None:
+        ioclass, level = policy.ionice
+        cmd = ['ionice', '-c', str(ioclass)]
+        if level is not None:
+            cmd.extend(['-n', str(level)])
+        cmd.extend(['-p', str(pid)])
+        try:
+            subprocess.check_call(cmd)
+        except (OSError, subprocess.CalledProcessError) as exc:
+            log.warning('Could not set the IO priority of job {0}: {1}'.format(policy.name, exc))
+    if not policy.uses_cgroup:
+        return None
+    if CGROUP_BASE is None:
+        log.warning('cgroup limits are not available, running job {0} without them'
+                    .format(policy.name))
+        return None
+    try:
+        cgroup = JobCgroup(CGROUP_BASE, policy)
+        cgroup.add(pid)
+        return cgroup
+    except (IOError, OSError) as exc:
+        log.warning('Could not apply the cgroup limits of job {0}: {1}'.format(policy.name, exc))
+        return None
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+'''
+Concurrent grains collection with per-grain deadlines and an on-disk cache.
+
+``salt.loader.grains`` runs every grain function one after the other, so a
+single hung metadata request or shell-out holds up the whole refresh. Here
+each grain function runs in its own thread with its own deadline. Results
+are cached in ``<cachedir>/grains_cache.json``; a grain which fails or misses
+its deadline serves its last known value, and a grain whose cached value is
+younger than its TTL is not run at all.
+
+The results are still merged in the order ``salt.loader.grains`` uses (core
+grains first), so the resulting grains are the same as a serial run.
+
+.. code-block:: yaml
+
+    grains_parallel: True
+    grains_workers: 8
+    # Deadline, in seconds, for each grain function
+    grains_timeout: 30
+    grains_timeouts:
+      cloud_details.get_cloud_details: 15
+    # Serve cached values younger than this many seconds without running the
+    # grain function. Keys are grain functions or grain modules.
+    grains_cache_ttl:
+      cloud_details: 86400
+      custom_grains_pillar: 3600
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import salt.config
+import salt.loader
+import salt.utils.dictupdate
+
+log = logging.getLogger(__name__)
+
+CACHE_FILE = 'grains_cache.json'
+SNAPSHOT_FILE = 'grains_snapshot.json'
+# Marks tuples in the grains snapshot, json would turn them into lists
+TUPLE_KEY = '__tuple__'
+
+# Grain functions which missed their deadline and are still running. They
+# are not started again until they finish.
+_RUNNING = {}
+_RUNNING_LOCK = threading.Lock()
+
+
+def _lookup(mapping, key, default):
+    '''
+    Per-grain setting for ``module.function``, falling back to ``module``
+    '''
+    if not isinstance(mapping, dict):
+        return default
+    if key in mapping:
+        return mapping[key]
+    return mapping.get(key.split('.', 1)[0], default)
+
+
+def _static_grains(opts):
+    '''
+    Grains set in the config files, as ``salt.loader.grains`` reads them
+    '''
+    if 'conf_file' not in opts:
+        return {}
+    pre_opts = {}
+    pre_opts.update(salt.config.load_config(
+        opts['conf_file'], 'SALT_MINION_CONFIG',
+        salt.config.DEFAULT_MINION_OPTS['conf_file']
+    ))
+    default_include = pre_opts.get('default_include', opts['default_include'])
+    include = pre_opts.get('include', [])
+    pre_opts.update(salt.config.include_config(default_include, opts['conf_file'],
+                                               verbose=False))
+    pre_opts.update(salt.config.include_config(include, opts['conf_file'],
+                                               verbose=True))
+    return pre_opts.get('grains', {})
+
+
+def load_cache(path):
+    try:
+        with open(path) as fh_:
+            cache = json.load(fh_)
+    except (IOError, OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def save_cache(path, cache):
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.tmp', 'w') as fh_:
+            os.chmod(path + '.tmp', 0o600)
+            json.dump(cache, fh_)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError) as exc:
+        log.error('Could not write the grains cache {0}: {1}'.format(path, exc))
+
+
+def _encode(value):
+    if isinstance(value, tuple):
+        return {TUPLE_KEY: [_encode(item) for item in value]}
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, _encode(val)) for key, val in value.items())
+    return value
+
+
+def _decode(value):
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    if isinstance(value, dict):
+        if list(value) == [TUPLE_KEY]:
+            return tuple(_decode(item) for item in value[TUPLE_KEY])
+        return dict((key, _decode(val)) for key, val in value.items())
+    return value
+
+
+def _lossless(value):
+    '''
+    Whether ``value`` comes back from the snapshot as it was
+    '''
+    try:
+        return _decode(json.loads(json.dumps(_encode(value)))) == value
+    except (TypeError, ValueError):
+        return False
+
+
+def save_snapshot(opts, grains):
+    '''
+    Save the result of a full grains refresh, for fast single function runs.
+    Nothing is saved if some grains can't be stored as json as they are, so
+    that fast runs never see other grains than a full refresh.
+    '''
+    path = os.path.join(opts['cachedir'], SNAPSHOT_FILE)
+    lossy = sorted(str(key) for key, val in grains.items() if not _lossless({key: val}))
+    if lossy:
+        log.debug('Not saving the grains snapshot, these grains can\'t be stored as '
+                  'json: {0}'.format(', '.join(lossy)))
+        # An older snapshot would be used instead
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return
+    data = json.dumps({'time': time.time(), 'grains': _encode(grains)})
+    try:
+        if not os.path.isdir(opts['cachedir']):
+            os.makedirs(opts['cachedir'])
+        with open(path + '.tmp', 'w') as fh_:
+            os.chmod(path + '.tmp', 0o600)
+            fh_.write(data)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError) as exc:
+        log.debug('Could not write the grains snapshot {0}: {1}'.format(path, exc))
+
+
+def load_snapshot(opts, max_age):
+    '''
+    Grains from the last snapshot, or None if there is no snapshot younger
+    than ``max_age`` seconds
+    '''
+    snapshot = load_cache(os.path.join(opts['cachedir'], SNAPSHOT_FILE))
+    if not isinstance(snapshot.get('grains'), dict):
+        return None
+    if time.time() - snapshot.get('time', 0) > max_age:
+        return None
+    return _decode(snapshot['grains'])
+
+
+def _run_grain(key, func, results):
+    try:
+        # salt passes grain functions taking an argument the proxy module
+        if getattr(func, '__code__', None) is not None and func.__code__.co_argcount == 1:
+            ret = func(None)
+        else:
+            ret = func()
+    except Exception:
+        log.critical('Failed to load grains defined in grain file {0} in '
+                     'function {1}, error:\n'.format(key, func), exc_info=True)
+        ret = None
+    results.put((key, ret))
+    with _RUNNING_LOCK:
+        _RUNNING.pop(key, None)
+
+
+def collect(opts):
+    '''
+    Return the grains, like ``salt.loader.grains(opts)``
+    '''
+    if opts.get('skip_grains', False):
+        return {}
+    static = _static_grains(opts)
+    opts['grains'] = static
+    default_timeout = float(opts.get('grains_timeout', 30))
+    timeouts = opts.get('grains_timeouts', {})
+    ttls = opts.get('grains_cache_ttl', {})
+    workers = max(1, int(opts.get('grains_workers', 8)))
+    cache_path = os.path.join(opts['cachedir'], CACHE_FILE)
+    cache = load_cache(cache_path)
+
+    funcs = salt.loader.grain_funcs(opts)
+    keys = [key for key in funcs if key.startswith('core.')]
+    keys.extend(key for key in funcs if not key.startswith('core.') and key != '_errors')
+    # Resolve the functions up front, the loader isn't meant to be loaded
+    # from several threads
+    funcs = [(key, funcs[key]) for key in keys]
+
+    started = time.time()
+    values = {}
+    todo = []
+    for key, func in funcs:
+        cached = cache.get(key)
+        ttl = float(_lookup(ttls, key, 0))
+        if cached and ttl > 0 and started - cached.get('time', 0) < ttl:
+            values[key] = cached.get('value')
+            continue
+        with _RUNNING_LOCK:
+            if key in _RUNNING:
+                log.warning('Grain {0} is still running since the last refresh, '
+                            'using its cached value'.format(key))
+                if cached:
+                    values[key] = cached.get('value')
+                continue
+        todo.append((key, func))
+
+    # Start the grains as workers free up, each one gets its own deadline
+    results = queue.Queue()
+    deadlines = {}
+    pending = list(todo)
+    while pending or deadlines:
+        while pending and len(deadlines) < workers:
+            key, func = pending.pop(0)
+            thread = threading.Thread(target=_run_grain, args=(key, func, results),
+                                      name='trubble-grain-{0}'.format(key))
+            thread.daemon = True
+            with _RUNNING_LOCK:
+                _RUNNING[key] = thread
+            deadlines[key] = time.time() + float(_lookup(timeouts, key, default_timeout))
+            thread.start()
+        try:
+            key, ret = results.get(timeout=max(0, min(deadlines.values()) - time.time()))
+        except queue.Empty:
+            now = time.time()
+            for key in [key for key, deadline in deadlines.items() if deadline <= now]:
+                del deadlines[key]
+                cached = cache.get(key)
+                log.error('Grain {0} missed its deadline, {1}'
+                          .format(key, 'using its cached value' if cached else 'skipping it'))
+                if cached:
+                    values[key] = cached.get('value')
+            continue
+        if key not in deadlines:
+            # Finished after its deadline, too late for this refresh
+            if isinstance(ret, dict):
+                cache[key] = {'value': ret, 'time': time.time()}
+            continue
+        del deadlines[key]
+        if isinstance(ret, dict):
+            values[key] = ret
+            cache[key] = {'value': ret, 'time': time.time()}
+        elif key in cache:
+            values[key] = cache[key].get('value')
+
+    grains_deep_merge = opts.get('grains_deep_merge', False) is True
+    grains_data = {}
+    for key in keys:
+        ret = values.get(key)
+        if not isinstance(ret, dict):
+            continue
+        if grains_deep_merge:
+            salt.utils.dictupdate.update(grains_data, ret)
+        else:
+            grains_data.update(ret)
+    grains_data.update(static)
+
+    known = set(keys)
+    save_cache(cache_path, _jsonable(dict((key, val) for key, val in cache.items()
+                                          if key in known)))
+    log.debug('Collected {0} grain functions ({1} run) in {2:.2f}s'
+              .format(len(keys), len(todo), time.time() - started))
+    return grains_data
+
+
+def _jsonable(cache):
+    '''
+    Drop the cache entries which can't be stored as json
+    '''
+    ret = {}
+    for key, val in cache.items():
+        try:
+            json.dumps(val)
+        except (TypeError, ValueError):
+            log.debug('Not caching grain {0}, its value is not serializable'.format(key))
+            continue
+        ret[key] = val
+    return ret
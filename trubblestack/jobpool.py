@@ -0,0 +1,772 @@
+# -*- coding: utf-8 -*-
+'''
+Concurrent execution pool for scheduled trubble jobs.
+
+Jobs are routed to *lanes*. Each lane has a fixed number of worker slots and
+runs its jobs either in long-lived worker processes forked from the daemon
+(``mode: process``) or in threads inside the daemon itself
+(``mode: thread``). By default heavy jobs (audits, queries) share the
+``default`` process lane while pulsar gets its own ``pulsar`` thread lane, so a
+long ``trubble.audit`` can never hold up ``pulsar.process``. Pulsar must run
+inside the daemon process as it keeps its inotify watches in ``__context__``.
+
+Lanes are configured via ``scheduler_lanes`` in the trubble config:
+
+.. code-block:: yaml
+
+    scheduler_lanes:
+      default:
+        mode: process
+        workers: 2
+      pulsar:
+        mode: thread
+        workers: 1
+
+Worker processes are recycled (replaced by a fresh fork of the daemon before
+their next job) after ``max_jobs`` jobs, or after a job which left them with
+more than ``max_rss_mb`` megabytes resident, so memory that audits and
+queries accumulate in a worker (caches in ``__context__``, fragmentation) is
+given back. Set either to 0 to disable it.
+
+Forking while another thread holds a lock (a logging handler's, for
+instance) leaves the worker with a lock nobody will release. Worker processes
+are forked holding the logging locks, and in the daemon only by its main
+thread: slot threads which need a new worker hand the fork to it (see
+``JobPool.serve_forks``).
+
+Per job, the following optional keys are supported in the ``schedule``
+config:
+
+lane
+    Name of the lane to run the job in. Defaults to ``pulsar`` for pulsar
+    functions and ``default`` for everything else.
+
+max_concurrency
+    How many instances of the job may be active at once. Defaults to 1.
+
+overlap
+    What to do when the job is due but ``max_concurrency`` instances are
+    still active: ``skip`` (default) drops the new run, ``queue`` runs it as
+    soon as an instance finishes (at most one run is kept waiting) and
+    ``kill`` terminates the oldest active instance and starts the new one.
+    ``kill`` is only possible in process lanes, elsewhere it behaves like
+    ``skip``.
+
+nice, ionice, cpu_quota, memory_max_mb, max_loadavg, loadavg_pause, max_defer
+    Resource policy of the job, see :mod:`trubblestack.governor`
+'''
+
+import contextlib
+import logging
+import multiprocessing
+import os
+import pickle
+import signal
+import sys
+import threading
+import time
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from trubblestack import governor
+from trubblestack.metrics import ResourceUsage, rss_bytes
+
+log = logging.getLogger(__name__)
+
+DEFAULT_LANES = {
+    'default': {'mode': 'process', 'workers': 2, 'max_jobs': 100, 'max_rss_mb': 512},
+    'pulsar': {'mode': 'thread', 'workers': 1},
+}
+PULSAR_FUNCTIONS = ('pulsar.', 'win_pulsar.')
+OVERLAP_POLICIES = ('skip', 'queue', 'kill')
+
+
+class JobRun(object):
+    '''
+    A single submission of a job to the pool
+    '''
+
+    def __init__(self, name, function, args=None, kwargs=None, lane=None,
+                 max_concurrency=1, overlap='skip', context=None, policy=None):
+        self.name = name
+        self.function = function
+        self.args = args or []
+        self.kwargs = kwargs or {}
+        self.lane = lane
+        self.max_concurrency = max_concurrency
+        self.overlap = overlap
+        self.context = context
+        self.policy = policy
+        self.submitted = time.time()
+        self.started = None
+        self.cancelled = False
+        self.slot = None
+
+    def __repr__(self):
+        return 'JobRun({0}, {1})'.format(self.name, self.function)
+
+    @classmethod
+    def from_job(cls, job):
+        '''
+        Build a run from a :class:`trubblestack.scheduler.ScheduledJob`. Bad
+        values for the pool settings are logged and replaced by the defaults.
+        '''
+        data = job.data
+        try:
+            max_concurrency = max(1, int(data.get('max_concurrency', 1)))
+        except (TypeError, ValueError):
+            log.error('Scheduled job {0} has an invalid value for max_concurrency'
+                      .format(job.name))
+            max_concurrency = 1
+        overlap = data.get('overlap', 'skip')
+        if overlap not in OVERLAP_POLICIES:
+            log.error('Scheduled job {0} has an invalid overlap policy {1}, '
+                      'using skip'.format(job.name, overlap))
+            overlap = 'skip'
+        try:
+            policy = governor.ResourcePolicy.from_data(job.name, data)
+        except ValueError as exc:
+            log.error('{0}, ignoring it'.format(exc))
+            policy = None
+        return cls(job.name, job.function, args=job.args, kwargs=job.kwargs,
+                   lane=data.get('lane'), max_concurrency=max_concurrency,
+                   overlap=overlap, context=job, policy=policy)
+
+
+class JobResult(object):
+    '''
+    Outcome of a :class:`JobRun`. ``ret`` is the function's return value if
+    ``ok`` is True, ``error`` is a description of the failure otherwise.
+
+    ``cpu_time``, ``rss_delta`` (peak RSS growth of the worker process) and
+    ``result_bytes`` (pickled size of ``ret``) are None where they could not
+    be measured. ``throttled_time``, ``deferred_time`` and ``paused_time``
+    are the seconds the job's resource policy held it back.
+    '''
+
+    def __init__(self, ok, ret=None, error=None, started=None, finished=None,
+                 cpu_time=None, rss_delta=None, result_bytes=None,
+                 throttled_time=None, deferred_time=None, paused_time=None):
+        self.ok = ok
+        self.ret = ret
+        self.error = error
+        self.started = started
+        self.finished = finished
+        self.cpu_time = cpu_time
+        self.rss_delta = rss_delta
+        self.result_bytes = result_bytes
+        self.throttled_time = throttled_time
+        self.deferred_time = deferred_time
+        self.paused_time = paused_time
+
+    @property
+    def wall_time(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+
+def _run_measured(runner, function, args, kwargs, process):
+    '''
+    Run a job, returning ``(ok, payload, usage)`` where payload is the
+    pickled return value or a traceback
+    '''
+    with ResourceUsage(process=process) as usage:
+        try:
+            ok, payload = True, runner(function, args, kwargs)
+        except Exception:
+            ok, payload = False, traceback.format_exc()
+    if ok:
+        try:
+            payload = pickle.dumps(payload, 2)
+        except Exception:
+            log.exception('Could not serialize the result of {0}'.format(function))
+            ok, payload = False, 'unable to serialize job result'
+    return ok, payload, {'cpu_time': usage.cpu_time, 'rss_delta': usage.rss_delta}
+
+
+def _result(ok, payload, usage):
+    if not ok:
+        return JobResult(False, error=payload, **usage)
+    return JobResult(True, ret=pickle.loads(payload), result_bytes=len(payload), **usage)
+
+
+def _logging_locks():
+    '''
+    The locks of the logging module and of its handlers, which the parent
+    holds while forking a worker. None where logging does this itself (it
+    re-creates its locks in the child since Python 3.7).
+    '''
+    if hasattr(os, 'register_at_fork'):
+        return []
+    locks = [logging._lock]
+    for ref in list(logging._handlerList):
+        handler = ref() if callable(ref) else ref
+        if handler is not None and handler.lock is not None:
+            locks.append(handler.lock)
+    return [lock for lock in locks if lock is not None]
+
+
+def _worker_main(runner, conn, locks=()):
+    '''
+    Main loop of a worker process. Receives ``(function, args, kwargs,
+    policy)`` tuples, runs them and sends back ``(ok, payload, usage, rss)``.
+    '''
+    # Held by the parent while forking
+    for lock in reversed(locks):
+        lock.release()
+    # The daemon's handlers would clean up the daemon's pidfile
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, IOError, OSError):
+            break
+        if msg is None:
+            break
+        function, args, kwargs, policy = msg
+        cgroup = None
+        if policy is not None and policy.process_limits:
+            cgroup = governor.apply(policy)
+        ok, payload, usage = _run_measured(runner, function, args, kwargs, process=True)
+        if cgroup is not None:
+            usage['throttled_time'] = cgroup.throttled_since_created()
+        conn.send((ok, payload, usage, rss_bytes()))
+
+
+class WorkerProcess(object):
+    '''
+    Parent-side handle on a long-lived worker process
+    '''
+
+    def __init__(self, runner, name):
+        self.name = name
+        self.jobs = 0
+        self.rss = None
+        self.paused = False
+        self.conn, child_conn = multiprocessing.Pipe()
+        locks = _logging_locks()
+        self.process = multiprocessing.Process(target=_worker_main,
+                                               args=(runner, child_conn, locks),
+                                               name=name)
+        self.process.daemon = True
+        # No other thread may hold a logging lock which the child would inherit
+        for lock in locks:
+            lock.acquire()
+        try:
+            self.process.start()
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+        child_conn.close()
+        log.debug('Started worker process {0} (pid {1})'.format(name, self.process.pid))
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def alive(self):
+        return self.process.is_alive()
+
+    def execute(self, run):
+        '''
+        Run ``run`` in the worker and wait for its result
+        '''
+        self.conn.send((run.function, run.args, run.kwargs, run.policy))
+        self.jobs += 1
+        paused_time = None
+        try:
+            if run.policy is not None and run.policy.loadavg_pause:
+                paused_time = self._wait_pausing(run.policy)
+            ok, payload, usage, self.rss = self.conn.recv()
+        except (EOFError, IOError, OSError):
+            # The worker died (or was killed); reap it so it gets replaced
+            self.process.join(5)
+            return JobResult(False, error='worker process {0} exited (exitcode {1})'
+                             .format(self.name, self.process.exitcode))
+        result = _result(ok, payload, usage)
+        result.paused_time = paused_time
+        return result
+
+    def _wait_pausing(self, policy):
+        '''
+        Wait for the job to finish, stopping the worker while the load average
+        is above the policy's ``max_loadavg`` (for at most ``max_defer``
+        seconds in total). Returns the seconds the job was paused.
+        '''
+        paused_time = 0.0
+        paused_at = None
+        while not self.conn.poll(governor.LOAD_POLL_INTERVAL):
+            if not self.alive():
+                break
+            if paused_at is None:
+                if policy.load_high() and paused_time < policy.max_defer:
+                    log.info('Load average is above {0}, pausing job {1}'
+                             .format(policy.max_loadavg, policy.name))
+                    os.kill(self.pid, signal.SIGSTOP)
+                    self.paused = True
+                    paused_at = time.time()
+            elif not policy.load_high() or \
+                    paused_time + time.time() - paused_at >= policy.max_defer:
+                self._resume()
+                paused_time += time.time() - paused_at
+                paused_at = None
+        if paused_at is not None:
+            self._resume()
+            paused_time += time.time() - paused_at
+        return paused_time
+
+    def _resume(self):
+        if self.paused:
+            self.paused = False
+            try:
+                os.kill(self.pid, signal.SIGCONT)
+            except OSError:
+                pass
+
+    def kill(self):
+        if self.alive():
+            self.process.terminate()
+            # A stopped worker only handles the SIGTERM once continued
+            self._resume()
+
+    def stop(self, timeout=5):
+        try:
+            self.conn.send(None)
+        except Exception:
+            pass
+        self.process.join(timeout)
+        if self.alive():
+            self.process.terminate()
+            self.process.join(timeout)
+        self.conn.close()
+
+
+class Slot(object):
+    '''
+    One unit of concurrency in a lane, driven by its own thread. In process
+    lanes, the slot thread hands jobs to a dedicated worker process and waits
+    for the result; in thread lanes it runs them directly.
+    '''
+
+    def __init__(self, pool, lane, index):
+        self.pool = pool
+        self.lane = lane
+        self.name = 'trubble-{0}-{1}'.format(lane.name, index)
+        self.worker = None
+        self.generation = None
+        self.current = None
+        self.thread = threading.Thread(target=self._loop, name=self.name)
+        self.thread.daemon = True
+
+    def start(self):
+        if self.lane.mode == 'process':
+            self._spawn()
+        self.thread.start()
+
+    def _spawn(self):
+        self.generation = self.pool.generation
+        self.worker = self.pool.fork_worker(self.name)
+
+    def _ensure_worker(self):
+        if self.worker is not None and self.worker.alive() \
+                and self.generation == self.pool.generation:
+            return
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
+        self._spawn()
+
+    def _loop(self):
+        while True:
+            run = self.lane.queue.get()
+            if run is None:
+                break
+            if run.cancelled or self.pool.stopping:
+                self.pool._finished(run, None)
+                continue
+            deferred_time = None
+            if run.policy is not None:
+                deferred_time = run.policy.defer()
+                if run.cancelled:
+                    self.pool._finished(run, None)
+                    continue
+            self.current = run
+            run.slot = self
+            run.started = time.time()
+            try:
+                if self.lane.mode == 'process':
+                    self._ensure_worker()
+                    result = self.worker.execute(run)
+                    self._check_recycle(run)
+                else:
+                    if run.policy is not None and run.policy.process_limits:
+                        log.warning('Job {0} runs in thread lane {1}, its nice, ionice '
+                                    'and cgroup limits are not applied'
+                                    .format(run.name, self.lane.name))
+                    with self.pool._thread_job():
+                        result = _result(*_run_measured(self.pool.runner, run.function,
+                                                        run.args, run.kwargs, process=False))
+            except Exception:
+                result = JobResult(False, error=traceback.format_exc())
+            result.deferred_time = deferred_time
+            result.started = run.started
+            result.finished = time.time()
+            self.current = None
+            if run.cancelled:
+                # Killed to make room for a newer run
+                result = None
+            self.pool._finished(run, result)
+        if self.worker is not None:
+            self.worker.stop()
+
+    def _check_recycle(self, run):
+        '''
+        Stop the worker if it reached the lane's job or RSS limit, or if the
+        resource policy of ``run`` changed it. A new one is forked before the
+        next job.
+        '''
+        worker = self.worker
+        reason = None
+        if run.policy is not None and run.policy.process_limits:
+            reason = 'policy'
+        elif self.lane.max_jobs and worker.jobs >= self.lane.max_jobs:
+            reason = 'jobs'
+        elif self.lane.max_rss_mb and worker.rss and \
+                worker.rss > self.lane.max_rss_mb * 1024 * 1024:
+            reason = 'rss'
+        if self.pool.registry is not None and worker.rss is not None:
+            self.pool.registry.set('trubble_worker_rss_bytes', worker.rss,
+                                   {'worker': self.name},
+                                   help_text='RSS of the worker process after its last job')
+        if reason is None:
+            return
+        log.info('Recycling worker {0} (pid {1}) after {2} jobs, RSS {3} bytes'
+                 .format(self.name, worker.pid, worker.jobs, worker.rss))
+        worker.stop()
+        self.worker = None
+        if self.pool.registry is not None:
+            self.pool.registry.inc('trubble_worker_recycles_total',
+                                   {'lane': self.lane.name, 'reason': reason},
+                                   help_text='Worker processes recycled for their job '
+                                             'count, RSS or resource policy')
+
+    def kill(self):
+        '''
+        Terminate the job currently running in this slot. Only possible in
+        process lanes; returns whether anything was killed.
+        '''
+        if self.lane.mode != 'process' or self.worker is None:
+            return False
+        self.worker.kill()
+        return True
+
+
+class Lane(object):
+    '''
+    A named group of slots sharing a queue of runs
+    '''
+
+    def __init__(self, pool, name, mode='process', workers=1, max_jobs=None,
+                 max_rss_mb=None):
+        if mode not in ('process', 'thread'):
+            raise ValueError('Lane {0} has an invalid mode {1}'.format(name, mode))
+        if mode == 'process' and sys.platform.startswith('win'):
+            log.info('Lane {0}: process mode is not supported on Windows, '
+                     'using threads'.format(name))
+            mode = 'thread'
+        self.name = name
+        self.mode = mode
+        self.max_jobs = int(max_jobs or 0)
+        self.max_rss_mb = float(max_rss_mb or 0)
+        self.queue = queue.Queue()
+        self.slots = [Slot(pool, self, i) for i in range(max(1, int(workers)))]
+
+    def start(self):
+        for slot in self.slots:
+            slot.start()
+
+    def stop(self):
+        for _ in self.slots:
+            self.queue.put(None)
+
+
+class ForkRequest(object):
+    '''
+    A worker process which a slot thread asked the main thread to fork
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.worker = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class JobPool(object):
+    '''
+    Execution pool for scheduled jobs.
+
+    runner
+        Callable ``runner(function, args, kwargs)`` which actually runs a job.
+        In process lanes it is called inside the (forked) worker process.
+
+    lanes
+        Lane config, merged over :data:`DEFAULT_LANES`
+
+    on_complete
+        Callable ``on_complete(run, result)`` called in the daemon process
+        after each run finishes. Runs which were skipped or cancelled never
+        reach it.
+
+    registry
+        Optional :class:`trubblestack.metrics.MetricsRegistry` for the worker
+        metrics
+
+    wake
+        Optional callable waking up the thread which created the pool. When
+        given, worker processes are only forked by that thread, which must
+        call :meth:`serve_forks` when woken up; slot threads which need a new
+        worker wait for it.
+    '''
+
+    def __init__(self, runner, lanes=None, on_complete=None, registry=None, wake=None):
+        self.runner = runner
+        self.on_complete = on_complete
+        self.registry = registry
+        self.wake = wake
+        self.generation = 0
+        self.stopping = False
+        self._main_thread = threading.current_thread()
+        self._forks = queue.Queue()
+        self._paused = False
+        self._thread_jobs = 0
+        self._pause_cond = threading.Condition()
+        self._lock = threading.Lock()
+        self._active = {}
+        self._pending = {}
+        lane_config = dict(DEFAULT_LANES)
+        if isinstance(lanes, dict):
+            lane_config.update(lanes)
+        elif lanes:
+            log.error('scheduler_lanes must be a dict, ignoring it')
+        self.lanes = {}
+        for name, data in lane_config.items():
+            data = data or {}
+            defaults = DEFAULT_LANES.get(name, {})
+            try:
+                self.lanes[name] = Lane(self, name,
+                                        mode=data.get('mode', 'process'),
+                                        workers=data.get('workers', 1),
+                                        max_jobs=data.get('max_jobs',
+                                                          defaults.get('max_jobs')),
+                                        max_rss_mb=data.get('max_rss_mb',
+                                                            defaults.get('max_rss_mb')))
+            except (TypeError, ValueError) as exc:
+                log.error('Invalid lane {0}, ignoring it: {1}'.format(name, exc))
+        if 'default' not in self.lanes:
+            self.lanes['default'] = Lane(self, 'default', **DEFAULT_LANES['default'])
+        self._started = False
+
+    def start(self):
+        if self._started:
+            return
+        for lane in self.lanes.values():
+            lane.start()
+        self._started = True
+
+    def shutdown(self):
+        for lane in self.lanes.values():
+            lane.stop()
+
+    def stop(self, timeout=5):
+        '''
+        Stop the pool for good: drop the queued runs, terminate the worker
+        processes along with the jobs running in them, and wait at most
+        ``timeout`` seconds for the slot threads. Jobs running in thread lanes
+        can't be interrupted.
+        '''
+        self.stopping = True
+        slots = []
+        for lane in self.lanes.values():
+            lane.stop()
+            for slot in lane.slots:
+                slots.append(slot)
+                run = slot.current
+                if run is not None:
+                    # Flag it first so the slot does not report the killed run
+                    run.cancelled = True
+                    if not slot.kill():
+                        run.cancelled = False
+        self.serve_forks()
+        end = time.time() + timeout
+        for slot in slots:
+            if slot.thread.is_alive():
+                slot.thread.join(max(0, end - time.time()))
+
+    @contextlib.contextmanager
+    def paused(self):
+        '''
+        Hold back the jobs of thread lanes, which run in the daemon itself,
+        for the duration of the ``with`` block. Entering it waits for those
+        already running to finish.
+        '''
+        with self._pause_cond:
+            while self._paused:
+                self._pause_cond.wait()
+            self._paused = True
+            while self._thread_jobs:
+                self._pause_cond.wait()
+        try:
+            yield
+        finally:
+            with self._pause_cond:
+                self._paused = False
+                self._pause_cond.notify_all()
+
+    @contextlib.contextmanager
+    def _thread_job(self):
+        with self._pause_cond:
+            while self._paused:
+                self._pause_cond.wait()
+            self._thread_jobs += 1
+        try:
+            yield
+        finally:
+            with self._pause_cond:
+                self._thread_jobs -= 1
+                self._pause_cond.notify_all()
+
+    def fork_worker(self, name):
+        '''
+        Fork the worker process of slot ``name``. With ``wake``, the fork is
+        left to the thread which created the pool unless it is the caller.
+        '''
+        if self.wake is None or threading.current_thread() is self._main_thread:
+            return WorkerProcess(self.runner, name)
+        request = ForkRequest(name)
+        self._forks.put(request)
+        self.wake()
+        while not request.done.wait(1):
+            if self.stopping:
+                self.serve_forks()
+        if request.error is not None:
+            raise request.error
+        return request.worker
+
+    def serve_forks(self):
+        '''
+        Fork the worker processes which the slot threads are waiting for. Once
+        the pool is stopping, the requests fail instead.
+        '''
+        while True:
+            try:
+                request = self._forks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                if self.stopping:
+                    raise RuntimeError('the job pool is stopping')
+                request.worker = WorkerProcess(self.runner, request.name)
+            except Exception as exc:
+                request.error = exc
+            request.done.set()
+
+    def recycle(self):
+        '''
+        Make process workers restart before their next job, for instance after
+        the daemon's grains and loaders have been refreshed.
+        '''
+        self.generation += 1
+
+    def lane_for(self, run):
+        name = run.lane
+        if name is None:
+            name = 'pulsar' if run.function.startswith(PULSAR_FUNCTIONS) else 'default'
+        if name not in self.lanes:
+            log.error('Scheduled job {0} requested unknown lane {1}, using default'
+                      .format(run.name, name))
+            name = 'default'
+        return self.lanes[name]
+
+    def submit(self, run):
+        '''
+        Submit a run. Returns one of ``started`` (queued in its lane),
+        ``queued`` (waiting for an active instance to finish), ``killed``
+        (an active instance was terminated to make room) or ``skipped``.
+        '''
+        lane = self.lane_for(run)
+        run.lane = lane.name
+        with self._lock:
+            active = self._active.setdefault(run.name, [])
+            if len(active) < run.max_concurrency:
+                active.append(run)
+                lane.queue.put(run)
+                return 'started'
+            if run.overlap == 'queue':
+                if run.name in self._pending:
+                    log.info('Job {0} is still running and already has a run '
+                             'queued, skipping'.format(run.name))
+                    return 'skipped'
+                self._pending[run.name] = run
+                log.info('Job {0} is still running, queueing'.format(run.name))
+                return 'queued'
+            if run.overlap == 'kill':
+                oldest = active[0]
+                if oldest.started is None:
+                    # Never started, just drop it from the lane queue
+                    oldest.cancelled = True
+                    active.pop(0)
+                elif self._kill(oldest):
+                    active.pop(0)
+                else:
+                    log.warning('Job {0} is still running in thread lane {1} and '
+                                'cannot be killed, skipping'.format(run.name, lane.name))
+                    return 'skipped'
+                log.warning('Job {0} is still running, killed the previous run'
+                            .format(run.name))
+                active.append(run)
+                lane.queue.put(run)
+                return 'killed'
+        log.info('Job {0} is still running, skipping'.format(run.name))
+        return 'skipped'
+
+    def _kill(self, run):
+        if run.slot is None:
+            return False
+        # Flag it first so the slot does not report the killed run
+        run.cancelled = True
+        if run.slot.kill():
+            return True
+        run.cancelled = False
+        return False
+
+    def active(self, name):
+        '''
+        Number of active (queued in a lane or running) instances of job
+        ``name``
+        '''
+        with self._lock:
+            return len(self._active.get(name, []))
+
+    def _finished(self, run, result):
+        with self._lock:
+            active = self._active.get(run.name, [])
+            if run in active:
+                active.remove(run)
+            pending = self._pending.get(run.name)
+            if pending is not None and len(active) < pending.max_concurrency:
+                del self._pending[run.name]
+                active.append(pending)
+                self.lanes[pending.lane].queue.put(pending)
+        if result is None or self.on_complete is None:
+            return
+        try:
+            self.on_complete(run, result)
+        except Exception:
+            log.exception('Error handling the result of job {0}'.format(run.name))
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+'''
+Metrics registry for the trubble daemon.
+
+The daemon records metrics about scheduled jobs (wall time, CPU time, peak
+RSS growth, result size), returners (latency, failures) and its own
+machinery in :data:`REGISTRY`. They can be exported in the Prometheus text
+format as a node-exporter textfile, and over HTTP on localhost:
+
+.. code-block:: yaml
+
+    # Rewritten every metrics_interval seconds
+    metrics_textfile: /var/lib/node_exporter/textfile_collector/trubble.prom
+    metrics_interval: 15
+    # Serves http://127.0.0.1:9919/metrics
+    metrics_http_port: 9919
+    metrics_http_host: 127.0.0.1
+'''
+
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+log = logging.getLogger(__name__)
+
+# Per-thread rusage is linux only, and python 2 doesn't name it
+if resource is not None:
+    RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD',
+                            1 if sys.platform.startswith('linux') else None)
+else:
+    RUSAGE_THREAD = None
+
+
+def rss_bytes():
+    '''
+    Resident set size of this process in bytes, or None if unknown
+    '''
+    try:
+        with open('/proc/self/statm') as fh_:
+            return int(fh_.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        pass
+    return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    '''
+    Peak resident set size of this process in bytes
+    '''
+    try:
+        with open('/proc/self/status') as fh_:
+            for line in fh_:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on OS X
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _reset_peak_rss():
+    '''
+    Reset the peak RSS of this process to its current RSS (linux 4.0+)
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh_:
+            fh_.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+class ResourceUsage(object):
+    '''
+    CPU time and peak RSS growth of a piece of work.
+
+    In a process which only does that work (a job pool worker), pass
+    ``process=True``: CPU time is then the process' and the peak RSS is reset
+    first where possible. Otherwise CPU time is the calling thread's, and
+    RSS is not measured as it is shared with everything else.
+    '''
+
+    def __init__(self, process=True):
+        self.process = process
+        self.cpu_time = None
+        self.rss_delta = None
+        self._cpu = None
+        self._rss = None
+
+    def _cpu_seconds(self):
+        if resource is None:
+            return None
+        who = resource.RUSAGE_SELF if self.process else RUSAGE_THREAD
+        if who is None:
+            return None
+        try:
+            usage = resource.getrusage(who)
+        except (ValueError, resource.error):
+            return None
+        return usage.ru_utime + usage.ru_stime
+
+    def __enter__(self):
+        self._cpu = self._cpu_seconds()
+        if self.process:
+            self._rss = rss_bytes() if _reset_peak_rss() else peak_rss_bytes()
+        return self
+
+    def __exit__(self, *exc_info):
+        cpu = self._cpu_seconds()
+        if cpu is not None and self._cpu is not None:
+            self.cpu_time = cpu - self._cpu
+        if self._rss is not None and peak_rss_bytes() is not None:
+            self.rss_delta = max(0, peak_rss_bytes() - self._rss)
+        return False
+
+
+def deep_sizeof(obj, seen=None):
+    '''
+    Approximate memory used by ``obj`` and the containers and strings it
+    references, in bytes. Objects referenced several times are counted once.
+    '''
+    if seen is None:
+        seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        try:
+            total += sys.getsizeof(obj)
+        except TypeError:
+            continue
+        try:
+            if isinstance(obj, dict):
+                for key, value in list(obj.items()):
+                    stack.append(key)
+                    stack.append(value)
+            elif isinstance(obj, (list, tuple, set, frozenset)):
+                stack.extend(list(obj))
+        except RuntimeError:
+            # Changed by another thread while we looked at it
+            pass
+    return total
+
+
+def largest_keys(mapping, top=10):
+    '''
+    The ``top`` keys of ``mapping`` using the most memory, as a list of
+    ``(key, bytes)`` tuples, largest first
+    '''
+    seen = set([id(mapping)])
+    sizes = []
+    for key, value in list(mapping.items()):
+        sizes.append((key, deep_sizeof(value, seen)))
+    sizes.sort(key=lambda item: item[1], reverse=True)
+    return sizes[:top]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, _escape(val))
+                          for key, val in sorted(labels.items())) + '}'
+
+
+class MetricsRegistry(object):
+    '''
+    Thread-safe store of counters, gauges and summaries (as ``_sum`` and
+    ``_count`` series), rendered in the Prometheus text format
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._values = {}
+        self._collectors = []
+
+    def _key(self, name, kind, help_text, labels):
+        if name not in self._meta:
+            self._meta[name] = (kind, help_text)
+        return (name, tuple(sorted((labels or {}).items())))
+
+    def inc(self, name, labels=None, value=1, help_text=''):
+        '''
+        Increment counter ``name``
+        '''
+        with self._lock:
+            key = self._key(name, 'counter', help_text, labels)
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, labels=None, help_text=''):
+        '''
+        Set gauge ``name``
+        '''
+        with self._lock:
+            self._values[self._key(name, 'gauge', help_text, labels)] = value
+
+    def observe(self, name, value, labels=None, help_text=''):
+        '''
+        Add an observation to summary ``name``
+        '''
+        with self._lock:
+            key = self._key(name, 'summary', help_text, labels)
+            total, count = self._values.get(key, (0.0, 0))
+            self._values[key] = (total + value, count + 1)
+
+    def get(self, name, labels=None):
+        with self._lock:
+            return self._values.get((name, tuple(sorted((labels or {}).items()))))
+
+    def add_collector(self, collector):
+        '''
+        Register ``collector()``, called at render time, which returns
+        ``(name, kind, help_text, labels, value)`` tuples
+        '''
+        self._collectors.append(collector)
+
+    def render(self):
+        '''
+        All metrics in the Prometheus text exposition format
+        '''
+        with self._lock:
+            meta = dict(self._meta)
+            values = dict(self._values)
+        for collector in self._collectors:
+            try:
+                samples = collector()
+            except Exception:
+                log.exception('Error collecting metrics')
+                continue
+            for name, kind, help_text, labels, value in samples:
+                meta.setdefault(name, (kind, help_text))
+                values[(name, tuple(sorted((labels or {}).items())))] = value
+        lines = []
+        for name in sorted(meta):
+            kind, help_text = meta[name]
+            if help_text:
+                lines.append('# HELP {0} {1}'.format(name, help_text))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            for (key_name, labels), value in sorted(values.items()):
+                if key_name != name or value is None:
+                    continue
+                labels = _format_labels(dict(labels))
+                if kind == 'summary':
+                    lines.append('{0}_sum{1} {2}'.format(name, labels, repr(float(value[0]))))
+                    lines.append('{0}_count{1} {2}'.format(name, labels, value[1]))
+                else:
+                    lines.append('{0}{1} {2}'.format(name, labels, repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        '''
+        Atomically (re)write ``path`` for the node-exporter textfile collector
+        '''
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as fh_:
+            fh_.write(self.render())
+        os.rename(tmp_path, path)
+
+
+REGISTRY = MetricsRegistry()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsHTTPServer(object):
+    '''
+    Serves the registry on ``http://<host>:<port>/metrics``
+    '''
+
+    def __init__(self, registry, port, host='127.0.0.1'):
+        self.registry = registry
+        self.port = int(port)
+        self.host = host
+        self._server = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                log.debug('metrics http: ' + fmt % args)
+
+        self._server = _ThreadingHTTPServer((self.host, self.port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever, name='trubble-metrics-http')
+        thread.daemon = True
+        thread.start()
+        log.info('Serving metrics on http://{0}:{1}/metrics'.format(self.host, self.port))
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def record_job(registry, run, result, now=None):
+    '''
+    Record the metrics of a finished job pool run
+    '''
+    labels = {'job': run.name, 'function': run.function}
+    registry.inc('trubble_job_runs_total', dict(labels, status='ok' if result.ok else 'error'),
+                 help_text='Scheduled job runs')
+    registry.set('trubble_job_last_run_timestamp_seconds', now or time.time(), labels,
+                 help_text='When the job last finished')
+    if result.wall_time is not None:
+        registry.observe('trubble_job_wall_seconds', result.wall_time, labels,
+                         help_text='Wall time of the job runs')
+        registry.set('trubble_job_last_wall_seconds', result.wall_time, labels,
+                     help_text='Wall time of the last run of the job')
+    if result.cpu_time is not None:
+        registry.observe('trubble_job_cpu_seconds', result.cpu_time, labels,
+                         help_text='CPU time of the job runs')
+        registry.set('trubble_job_last_cpu_seconds', result.cpu_time, labels,
+                     help_text='CPU time of the last run of the job')
+    if result.rss_delta is not None:
+        registry.set('trubble_job_last_peak_rss_delta_bytes', result.rss_delta, labels,
+                     help_text='Peak RSS growth of the worker during the last run of the job')
+    for name, value, help_text in (
+            ('trubble_job_cpu_throttled_seconds_total', result.throttled_time,
+             'Time the job was throttled by its cgroup CPU quota'),
+            ('trubble_job_deferred_seconds_total', result.deferred_time,
+             'Time the job waited for the load average to drop before starting'),
+            ('trubble_job_paused_seconds_total', result.paused_time,
+             'Time the job was paused because of the load average')):
+        if value is not None:
+            registry.inc(name, labels, value=value, help_text=help_text)
+    if result.result_bytes is not None:
+        registry.set('trubble_job_last_result_bytes', result.result_bytes, labels,
+                     help_text='Pickled size of the last result of the job')
+
+
+def record_returner(registry, returner, function, elapsed, ok):
+    '''
+    Record the latency and outcome of a returner call
+    '''
+    labels = {'returner': returner, 'function': function}
+    registry.observe('trubble_returner_seconds', elapsed, labels,
+                     help_text='Time spent in returner calls')
+    if not ok:
+        registry.inc('trubble_returner_failures_total', labels,
+                     help_text='Returner calls which raised an error')
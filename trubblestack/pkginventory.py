@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+'''
+Shared snapshot of the installed packages.
+
+Several nova modules (pkg, cve_scan_v2, vulners_scanner) and the nebula
+fallback queries need the installed packages. Rather than each of them
+asking the package manager, possibly once per check, they share one
+snapshot, which is read again only when the package database changes.
+
+The snapshot is parsed natively from ``/var/lib/dpkg/status`` on Debian,
+and from a single ``rpm -qa`` dump on RedHat and Suse. On the other
+platforms it is taken from ``pkg.list_pkgs``. Package names and versions
+follow ``pkg.list_pkgs``: foreign architectures are appended to the name,
+and rpm versions are ``[epoch:]version-release``.
+'''
+
+import fnmatch
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+# Package databases, the snapshot is taken again when one of them changes
+PKG_DBS = ('/var/lib/rpm/Packages',
+           '/var/lib/rpm/rpmdb.sqlite',
+           DPKG_STATUS,
+           '/var/lib/pacman/local',
+           '/var/db/pkg/local.sqlite',
+           '/lib/apk/db/installed')
+
+RPM_QUERYFORMAT = '%{NAME}\\t%{EPOCH}\\t%{VERSION}\\t%{RELEASE}\\t%{ARCH}\\n'
+ARCHES_32 = ('i386', 'i486', 'i586', 'i686', 'athlon')
+
+# The last snapshot, with the state of the package databases it was taken at
+_SNAPSHOT = {'key': None, 'packages': None}
+_SNAPSHOT_LOCK = threading.Lock()
+
+
+def db_state():
+    '''
+    (mtime, size, inode) of each package database, None for those missing
+    '''
+    ret = []
+    for path in PKG_DBS:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            ret.append(None)
+            continue
+        ret.append((stat.st_mtime, stat.st_size, stat.st_ino))
+    return tuple(ret)
+
+
+def snapshot(salt, grains):
+    '''
+    ``{name: [versions]}`` of the installed packages, shared by all the
+    callers until the package databases change. It must not be modified.
+    '''
+    state = db_state()
+    key = (state, grains.get('os_family'), grains.get('osarch'))
+    with _SNAPSHOT_LOCK:
+        # Without a known package database, changes can't be seen
+        if _SNAPSHOT['key'] != key or _SNAPSHOT['packages'] is None \
+                or not any(state):
+            _SNAPSHOT['packages'] = _read_packages(salt, grains)
+            _SNAPSHOT['key'] = key
+        return _SNAPSHOT['packages']
+
+
+def _read_packages(salt, grains):
+    os_family = grains.get('os_family')
+    try:
+        if os_family == 'Debian' and os.path.isfile(DPKG_STATUS):
+            with open(DPKG_STATUS) as fh_:
+                return parse_dpkg_status(fh_, grains)
+        if os_family in ('RedHat', 'Suse'):
+            out = salt['cmd.run_all'](['rpm', '-qa', '--queryformat', RPM_QUERYFORMAT],
+                                      python_shell=False,
+                                      output_loglevel='trace')
+            if out['retcode'] == 0:
+                return parse_rpm_packages(out['stdout'], grains)
+            log.warning('rpm -qa failed, listing the packages with pkg.list_pkgs: {0}'
+                        .format(out['stderr']))
+    except (IOError, OSError) as exc:
+        log.warning('Could not read the package database, listing the packages '
+                    'with pkg.list_pkgs: {0}'.format(exc))
+    packages = salt['pkg.list_pkgs'](versions_as_list=True)
+    return dict((name, sorted(versions if isinstance(versions, list) else [versions]))
+                for name, versions in packages.items())
+
+
+def parse_dpkg_status(lines, grains):
+    '''
+    Installed packages of a dpkg status file, the way ``pkg.list_pkgs``
+    reports them
+    '''
+    osarch = grains.get('osarch', '')
+    foreign = grains.get('cpuarch', '') == 'x86_64' and osarch == 'amd64'
+    ret = {}
+    fields = {}
+    for line in list(lines) + ['']:
+        line = line.rstrip('\n')
+        if line and line[0] not in ' \t':
+            field, _, value = line.partition(':')
+            fields[field] = value.strip()
+            continue
+        if line:
+            # Continuation of a multiline field
+            continue
+        status = fields.get('Status', '').split()
+        if fields.get('Package') and len(status) == 3 \
+                and status[0] in ('install', 'hold') and status[2] == 'installed':
+            name = fields['Package']
+            arch = fields.get('Architecture', '')
+            if foreign and arch and arch not in ('all', osarch):
+                name = '{0}:{1}'.format(name, arch)
+            ret.setdefault(name, []).append(fields.get('Version', ''))
+        fields = {}
+    for versions in ret.values():
+        versions.sort()
+    return ret
+
+
+def parse_rpm_packages(out, grains):
+    '''
+    Installed packages of ``rpm -qa --queryformat RPM_QUERYFORMAT``, the way
+    ``pkg.list_pkgs`` reports them
+    '''
+    osarch = grains.get('osarch', '')
+    ret = {}
+    for line in out.splitlines():
+        cols = line.split('\t')
+        if len(cols) != 5:
+            continue
+        name, epoch, version, release, arch = cols
+        if arch not in (osarch, 'noarch') \
+                and not (arch in ARCHES_32 and osarch in ARCHES_32):
+            name = '{0}.{1}'.format(name, arch)
+        version = '{0}-{1}'.format(version, release)
+        if epoch not in ('(none)', '0'):
+            version = '{0}:{1}'.format(epoch, version)
+        ret.setdefault(name, []).append(version)
+    for versions in ret.values():
+        versions.sort()
+    return ret
+
+
+class PackageInventory(object):
+    '''
+    The installed packages for one audit. The snapshot is taken when first
+    used, and the same one is used for the whole audit.
+    '''
+
+    def __init__(self, salt, grains):
+        self.salt = salt
+        self.grains = grains
+        self._packages = None
+        self._lock = threading.Lock()
+
+    @property
+    def packages(self):
+        with self._lock:
+            if self._packages is None:
+                self._packages = snapshot(self.salt, self.grains)
+            return self._packages
+
+    def list_pkgs(self, versions_as_list=False):
+        '''
+        Same as ``pkg.list_pkgs``
+        '''
+        if versions_as_list:
+            return dict((name, list(versions)) for name, versions in self.packages.items())
+        return dict((name, ','.join(versions)) for name, versions in self.packages.items())
+
+    def version(self, name):
+        '''
+        Same as ``pkg.version`` for a single package: its versions separated
+        by commas, or an empty string if it isn't installed
+        '''
+        if any(char in name for char in '*?['):
+            matched = fnmatch.filter(self.packages, name)
+            return dict((pkg, ','.join(self.packages[pkg])) for pkg in matched)
+        return ','.join(self.packages.get(name, []))
@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+'''
+Event-driven scheduler engine for the trubble daemon.
+
+Scheduled jobs are validated once, when the ``schedule`` config is loaded (or
+changes), and then kept in a priority queue keyed by their next fire time. The
+daemon main loop asks the scheduler for the jobs which are due and then sleeps
+until the next one is due (or until another thread wakes it up, see
+:meth:`Scheduler.wake`), instead of re-parsing every job on a fixed polling
+interval.
+
+.. code-block:: python
+
+    sched = Scheduler()
+    sched.load(__opts__['schedule'])
+    for job in sched.pop_due():
+        run(job)
+    sched.wait(sched.seconds_until_next())
+'''
+
+import errno
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+from croniter import croniter
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+
+class CronSchedule(object):
+    '''
+    Fire times of a cron expression, in local time. Expressions have five
+    fields, or six with seconds as the last one (``* * * * * */10``).
+
+    Raises ``ValueError`` if the expression is not valid.
+    '''
+
+    def __init__(self, cron_exp):
+        try:
+            croniter(cron_exp)
+        except Exception as exc:
+            raise ValueError('invalid cron expression {0}: {1}'.format(cron_exp, exc))
+        self.cron_exp = cron_exp
+
+    def _iter(self, now):
+        return croniter(self.cron_exp, datetime.fromtimestamp(now))
+
+    def next_after(self, now):
+        '''
+        First fire time strictly after ``now``
+        '''
+        return time.mktime(self._iter(now).get_next(datetime).timetuple())
+
+    def last_before(self, now):
+        '''
+        Last fire time at or before ``now``
+        '''
+        # get_prev is strictly before its base, so start just after now
+        return time.mktime(self._iter(math.floor(now) + 1).get_prev(datetime).timetuple())
+
+    def period(self, now, samples=16):
+        '''
+        Shortest interval between the next ``samples`` fire times after
+        ``now``. Fire times can be moved by less than that without running
+        into the following one.
+        '''
+        cron_iter = self._iter(now)
+        times = [time.mktime(cron_iter.get_next(datetime).timetuple())
+                 for _ in range(samples + 1)]
+        return max(1, min(later - earlier for earlier, later in zip(times, times[1:])))
+
+
+def stable_fraction(key):
+    '''
+    Map ``key`` to a number in [0, 1), uniformly distributed over keys and
+    stable across hosts, restarts and python versions
+    '''
+    if not isinstance(key, bytes):
+        key = str(key).encode('utf-8')
+    digest = hashlib.sha256(key).digest()
+    return struct.unpack('>Q', digest[:8])[0] / float(2 ** 64)
+
+
+def bucket_offset(key, seconds, buckets, fleet_size=None):
+    '''
+    Offset in [0, ``seconds``) at which the host identified by ``key`` runs
+    a job scheduled with ``buckets``.
+
+    With a number of buckets, the host is placed in a bucket by a stable hash
+    of ``key`` and runs at a random time within its bucket. With ``spread``,
+    the host's whole offset comes from the hash, so it doesn't change across
+    restarts; given the ``fleet_size``, the window is cut into one slot per
+    host and each host runs at the start of its slot.
+    '''
+    fraction = stable_fraction(key)
+    if buckets == 'spread':
+        if fleet_size:
+            fleet_size = int(fleet_size)
+            return int(fraction * fleet_size) * float(seconds) / fleet_size
+        return fraction * seconds
+    buckets = int(buckets) if int(buckets) != 0 else 256
+    bucket = int(fraction * buckets)
+    log.debug('bucket number is {0} out of {1}'.format(bucket, buckets))
+    width = float(seconds) / buckets
+    return bucket * width + random.uniform(0, width)
+
+
+def getlastrunbybuckets(buckets, seconds, key, now=None, fleet_size=None):
+    '''
+    this function will use the host's trubble_uuid to place the host in a
+    bucket where each bucket executes trubble processes at a different time
+    '''
+    if now is None:
+        now = time.time()
+    base_time = seconds * math.floor(now / seconds)
+    bucket_execution_time = base_time + bucket_offset(key, seconds, buckets, fleet_size)
+    if bucket_execution_time < now:
+        return bucket_execution_time
+    return bucket_execution_time - seconds
+
+
+class ScheduledJob(object):
+    '''
+    A single, pre-validated entry from the ``schedule`` config.
+
+    Raises ``ValueError`` if the job data is not valid, with a message suitable
+    for logging.
+    '''
+
+    def __init__(self, name, data):
+        if not data or not isinstance(data, dict):
+            raise ValueError('Scheduled job {0} does not have valid data'.format(name))
+        if 'function' not in data or 'seconds' not in data:
+            raise ValueError('Scheduled job {0} is missing a ``function`` or '
+                             '``seconds`` argument'.format(name))
+        self.name = name
+        self.data = data
+        self.function = data['function']
+        self.cron = None
+        try:
+            if 'cron' in data:
+                self.cron = CronSchedule(data['cron'])
+                self.seconds = self.cron.period(time.time())
+            else:
+                self.seconds = int(data['seconds'])
+            self.splay = int(data.get('splay', 0))
+        except (TypeError, ValueError):
+            raise ValueError('Scheduled job {0} has an invalid value for seconds or '
+                             'splay.'.format(name))
+        try:
+            if data.get('buckets', 'spread') != 'spread':
+                int(data['buckets'])
+            self.fleet_size = int(data['fleet_size']) if data.get('fleet_size') else None
+        except (TypeError, ValueError):
+            raise ValueError('Scheduled job {0} has an invalid value for buckets or '
+                             'fleet_size.'.format(name))
+        self.args = data.get('args', [])
+        if not isinstance(self.args, list):
+            raise ValueError('Scheduled job {0} has args not formed as a list: {1}'
+                             .format(name, self.args))
+        self.kwargs = data.get('kwargs', {})
+        if not isinstance(self.kwargs, dict):
+            raise ValueError('Scheduled job {0} has kwargs not formed as a dict: {1}'
+                             .format(name, self.kwargs))
+        returners = data.get('returner', [])
+        if not isinstance(returners, list):
+            returners = [returners]
+        self.returners = returners
+        self.returner_retry = data.get('returner_retry', False)
+        self.signature = job_signature(data)
+        self.last_run = None
+        self.next_run = None
+        # Seconds after each fire time of a cron job at which this host runs it
+        self.offset = 0
+
+    def __repr__(self):
+        return 'ScheduledJob({0}, {1}, next_run={2})'.format(self.name,
+                                                             self.function,
+                                                             self.next_run)
+
+    def first_run(self, now, host_id=None, fleet_size=None):
+        '''
+        Decide when the job should fire for the first time. This follows the
+        original semantics of the polling scheduler, where ``last_run`` was
+        faked so that the job became due at the right moment.
+
+        ``host_id`` (the ``trubble_uuid``) places the host in its bucket for
+        jobs with ``buckets``, and ``fleet_size`` is the default fleet size for
+        ``buckets: spread``.
+        '''
+        if self.cron is not None:
+            return self._first_cron_run(now, host_id, fleet_size)
+        data = self.data
+        seconds = self.seconds
+        splay = self.splay
+        if data.get('run_on_start', False):
+            if splay:
+                # Run `splay` seconds in the future, by telling the scheduler we last ran it
+                # `seconds - splay` seconds ago.
+                self.last_run = now - (seconds - random.randint(0, splay))
+            else:
+                # Run now
+                self.last_run = now - seconds
+        else:
+            if splay:
+                # Run `seconds + splay` seconds in the future by telling the scheduler we last
+                # ran it at now + `splay` seconds.
+                self.last_run = now + random.randint(0, splay)
+            elif 'buckets' in data:
+                # Place the host in a bucket and fix the execution time.
+                self.last_run = getlastrunbybuckets(data['buckets'], seconds,
+                                                    host_id or socket.gethostname(),
+                                                    now=now,
+                                                    fleet_size=self.fleet_size or fleet_size)
+                log.debug('last_run according to bucket is {0}'.format(self.last_run))
+            else:
+                # Run in `seconds` seconds.
+                self.last_run = now
+        self.next_run = self.last_run + seconds
+        return self.next_run
+
+    def _first_cron_run(self, now, host_id, fleet_size):
+        '''
+        Cron jobs run at the fire times of their expression, all moved by the
+        same ``offset``: a random delay of up to ``splay`` seconds, or with
+        ``buckets`` the host's place in the interval between two fire times.
+        '''
+        data = self.data
+        if self.splay:
+            self.offset = random.randint(0, self.splay)
+        elif 'buckets' in data:
+            self.offset = bucket_offset(host_id or socket.gethostname(), self.seconds,
+                                        data['buckets'], self.fleet_size or fleet_size)
+            log.debug('offset according to bucket is {0}'.format(self.offset))
+        self.last_run = self.cron.last_before(now - self.offset) + self.offset
+        if data.get('run_on_start', False):
+            # Run now, or after the splay
+            self.next_run = now + (self.offset if self.splay else 0)
+        else:
+            self.next_run = self.cron.next_after(now - self.offset) + self.offset
+        return self.next_run
+
+    def fired(self, now):
+        '''
+        Record that the job was handed off for execution at ``now`` and
+        compute the next fire time.
+        '''
+        self.last_run = now
+        if self.cron is not None:
+            self.next_run = self.cron.next_after(now - self.offset) + self.offset
+        else:
+            self.next_run = now + self.seconds
+        return self.next_run
+
+
+def job_signature(data):
+    '''
+    Stable signature for a job's config, used to detect changes to the
+    ``schedule`` between wakeups.
+    '''
+    try:
+        return json.dumps(data, sort_keys=True, default=repr)
+    except (TypeError, ValueError):
+        return repr(data)
+
+
+class Waker(object):
+    '''
+    Interruptible sleep for the scheduler loop. On POSIX this is a self-pipe
+    which ``select`` blocks on, so a sleeping daemon really is idle; on Windows
+    we fall back to a ``threading.Event``.
+    '''
+
+    def __init__(self):
+        self._event = None
+        self._rfd = None
+        self._wfd = None
+        if sys.platform.startswith('win'):
+            self._event = threading.Event()
+        else:
+            self._rfd, self._wfd = os.pipe()
+            try:
+                import fcntl
+                for fd in (self._rfd, self._wfd):
+                    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            except ImportError:
+                pass
+
+    def wake(self):
+        '''
+        Wake up a sleeping ``wait()``. Safe to call from other threads and
+        from signal handlers.
+        '''
+        if self._event is not None:
+            self._event.set()
+            return
+        try:
+            os.write(self._wfd, b'x')
+        except OSError as exc:
+            # The pipe is full, so a wakeup is already pending
+            if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def wait(self, timeout):
+        '''
+        Sleep for at most ``timeout`` seconds. Returns True if we were woken up
+        early.
+        '''
+        timeout = max(0, timeout)
+        if self._event is not None:
+            woken = self._event.wait(timeout)
+            self._event.clear()
+            return bool(woken)
+        try:
+            readable, _, _ = select.select([self._rfd], [], [], timeout)
+        except (select.error, OSError, IOError) as exc:
+            # EINTR -- a signal arrived, let the caller re-evaluate
+            if exc.args and exc.args[0] == errno.EINTR:
+                return True
+            raise
+        if not readable:
+            return False
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except OSError as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return True
+
+
+class Scheduler(object):
+    '''
+    Priority queue of pre-validated scheduled jobs, keyed by next fire time.
+    '''
+
+    def __init__(self, host_id=None, fleet_size=None):
+        self.jobs = {}
+        self.host_id = host_id
+        self.fleet_size = fleet_size
+        self._heap = []
+        self._counter = itertools.count()
+        self._signature = None
+        self._waker = Waker()
+
+    def load(self, schedule_config, now=None):
+        '''
+        (Re)load the ``schedule`` config. This is cheap when nothing changed.
+        Jobs whose config did not change keep their fire times; new or
+        modified jobs are validated and scheduled as if the daemon had just
+        started. Returns True if the schedule changed.
+        '''
+        signature = job_signature(schedule_config)
+        if signature == self._signature:
+            return False
+        self._signature = signature
+        if now is None:
+            now = time.time()
+
+        jobs = {}
+        for jobname, jobdata in schedule_config.items():
+            previous = self.jobs.get(jobname)
+            if previous is not None and previous.signature == job_signature(jobdata):
+                jobs[jobname] = previous
+                continue
+            try:
+                job = ScheduledJob(jobname, jobdata)
+            except ValueError as exc:
+                log.error(exc)
+                continue
+            job.first_run(now, self.host_id, self.fleet_size)
+            log.debug('Scheduled job {0} will first run at {1}'.format(jobname, job.next_run))
+            jobs[jobname] = job
+
+        self.jobs = jobs
+        self._heap = []
+        for job in self.jobs.values():
+            self._push(job)
+        return True
+
+    def _push(self, job):
+        heapq.heappush(self._heap, (job.next_run, next(self._counter), job))
+
+    def pop_due(self, now=None):
+        '''
+        Return the list of jobs which are due, in fire-time order, and
+        reschedule each of them for its next run.
+        '''
+        if now is None:
+            now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, job = heapq.heappop(self._heap)
+            if self.jobs.get(job.name) is not job:
+                # Stale entry from a job which has since been replaced
+                continue
+            due.append(job)
+        for job in due:
+            job.fired(now)
+            self._push(job)
+        return due
+
+    def pop_early(self, window, predicate, now=None):
+        '''
+        Return the jobs matching ``predicate`` which are due within the next
+        ``window`` seconds, so they can run along with the jobs due now. Each
+        of them is rescheduled as if it had fired on time.
+        '''
+        if now is None:
+            now = time.time()
+        early = []
+        kept = []
+        while self._heap and self._heap[0][0] <= now + window:
+            entry = heapq.heappop(self._heap)
+            job = entry[2]
+            if self.jobs.get(job.name) is not job:
+                continue
+            if predicate(job):
+                early.append(job)
+            else:
+                kept.append(entry)
+        for entry in kept:
+            heapq.heappush(self._heap, entry)
+        for job in early:
+            job.fired(max(now, job.next_run))
+            self._push(job)
+        return early
+
+    def next_run(self):
+        '''
+        The time at which the next job is due, or None if nothing is scheduled
+        '''
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def seconds_until_next(self, now=None, default=None):
+        '''
+        Seconds until the next job is due (never negative). If nothing is
+        scheduled, return ``default``.
+        '''
+        next_run = self.next_run()
+        if next_run is None:
+            return default
+        if now is None:
+            now = time.time()
+        return max(0, next_run - now)
+
+    def wait(self, timeout):
+        '''
+        Sleep until ``timeout`` expires or ``wake()`` is called
+        '''
+        return self._waker.wait(timeout)
+
+    def wake(self):
+        '''
+        Interrupt the scheduler's sleep from another thread. The job pool
+        does this when a slot needs the main thread to fork its worker.
+        '''
+        self._waker.wake()
@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+'''
+Durable on-disk spool for returner payloads.
+
+The spool is a write-ahead log under ``<cachedir>/returner_spool``, made of
+append-only segment files. Returners append their payloads to the spool and
+return immediately; a drainer thread in the daemon delivers the records in
+order and commits its read position after each successful delivery. As the
+position is only committed after delivery, records are delivered at least
+once, and delivery resumes where it left off after a daemon restart.
+
+Each record is stored as a 4-byte length and a 4-byte CRC32 followed by the
+payload. Segments roll over at ``returner_spool_segment_mb`` and fully
+delivered segments are deleted. When the spool grows beyond
+``returner_spool_max_mb``, the oldest segments are discarded.
+
+Writes are flushed immediately, but fsync'ed at most every
+``returner_spool_fsync_interval`` seconds.
+
+.. code-block:: yaml
+
+    returner_spool: True
+    returner_spool_max_mb: 256
+    returner_spool_segment_mb: 4
+    returner_spool_fsync_interval: 1.0
+'''
+
+import contextlib
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from trubblestack.scheduler import Waker
+
+log = logging.getLogger(__name__)
+
+HEADER = struct.Struct('>II')
+SEGMENT_SUFFIX = '.seg'
+OFFSET_FILE = 'offset'
+LOCK_FILE = 'lock'
+
+_SPOOLS = {}
+_SPOOLS_LOCK = threading.Lock()
+
+
+class SpoolRecordRejected(Exception):
+    '''
+    Raised by a deliver function when a record can never be delivered (for
+    instance the endpoint rejected it as malformed), so it should be skipped
+    rather than retried.
+    '''
+
+
+class Spool(object):
+    '''
+    Segmented, append-only spool directory. Appends are safe across threads
+    and processes (the latter via ``flock``); there must be a single reader.
+    '''
+
+    def __init__(self, directory, segment_bytes=4 * 1024 * 1024,
+                 max_bytes=256 * 1024 * 1024, fsync_interval=1.0):
+        self.directory = directory
+        self.segment_bytes = max(1, int(segment_bytes))
+        self.max_bytes = max(self.segment_bytes, int(max_bytes))
+        self.fsync_interval = float(fsync_interval)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        self._lock = threading.RLock()
+        self._fh = None
+        self._fh_segment = None
+        self._dirty = False
+        self._last_fsync = 0
+        self._listeners = []
+        self.position = self._load_offset()
+        self.counters = {'appended': 0,
+                         'appended_bytes': 0,
+                         'delivered': 0,
+                         'rejected': 0,
+                         'discarded_bytes': 0}
+
+    def _path(self, segment):
+        return os.path.join(self.directory, '{0:016d}{1}'.format(segment, SEGMENT_SUFFIX))
+
+    def segments(self):
+        '''
+        Sorted list of the ids of the segment files currently on disk
+        '''
+        ret = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    ret.append(int(name[:-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(ret)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.directory, LOCK_FILE), 'a') as lock_fh:
+                fcntl.flock(lock_fh.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_fh.fileno(), fcntl.LOCK_UN)
+
+    def add_listener(self, callback):
+        '''
+        Call ``callback()`` after every append made by this process
+        '''
+        self._listeners.append(callback)
+
+    def append(self, data):
+        '''
+        Append a single record (bytes, or text which is utf-8 encoded)
+        '''
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        record = HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff) + data
+        with self._locked():
+            segments = self.segments()
+            if segments:
+                segment = segments[-1]
+            else:
+                segment = self.position[0] + 1
+            if self._fh_segment != segment or self._fh is None:
+                self._close()
+            size = os.path.getsize(self._path(segment)) if segment in segments else 0
+            if size and size + len(record) > self.segment_bytes:
+                self._close()
+                segment += 1
+                self._enforce_cap(segments)
+            if self._fh is None:
+                self._fh = open(self._path(segment), 'ab')
+                self._fh_segment = segment
+                os.chmod(self._path(segment), 0o600)
+            self._fh.write(record)
+            self._fh.flush()
+            self._dirty = True
+            if time.time() - self._last_fsync >= self.fsync_interval:
+                self._fsync()
+            self.counters['appended'] += 1
+            self.counters['appended_bytes'] += len(record)
+        for callback in self._listeners:
+            try:
+                callback()
+            except Exception:
+                log.exception('Error notifying spool listener')
+
+    def sync(self):
+        '''
+        fsync any appended data which has not been fsync'ed yet
+        '''
+        with self._lock:
+            if self._dirty:
+                self._fsync()
+
+    def _fsync(self):
+        if self._fh is not None:
+            os.fsync(self._fh.fileno())
+        self._dirty = False
+        self._last_fsync = time.time()
+
+    def _close(self):
+        if self._fh is not None:
+            if self._dirty:
+                self._fsync()
+            self._fh.close()
+        self._fh = None
+        self._fh_segment = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _enforce_cap(self, segments):
+        '''
+        Discard the oldest segments while the spool is bigger than
+        ``max_bytes``. Called with the lock held, when rolling to a new
+        segment.
+        '''
+        sizes = []
+        for segment in segments:
+            try:
+                sizes.append((segment, os.path.getsize(self._path(segment))))
+            except OSError:
+                continue
+        total = sum(size for _, size in sizes)
+        for segment, size in sizes:
+            if total + self.segment_bytes <= self.max_bytes:
+                break
+            log.warning('Returner spool is over {0} bytes, discarding segment {1} '
+                        '({2} bytes of undelivered data)'.format(self.max_bytes, segment, size))
+            try:
+                os.remove(self._path(segment))
+            except OSError:
+                continue
+            total -= size
+            self.counters['discarded_bytes'] += size
+
+    def pending_bytes(self):
+        '''
+        Approximate number of bytes appended but not yet committed
+        '''
+        total = 0
+        for segment in self.segments():
+            if segment < self.position[0]:
+                continue
+            try:
+                size = os.path.getsize(self._path(segment))
+            except OSError:
+                continue
+            if segment == self.position[0]:
+                size = max(0, size - self.position[1])
+            total += size
+        return total
+
+    def _load_offset(self):
+        try:
+            with open(os.path.join(self.directory, OFFSET_FILE)) as fh_:
+                data = json.load(fh_)
+            return (int(data['segment']), int(data['offset']))
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return (0, 0)
+
+    def read(self, max_records=100):
+        '''
+        Read up to ``max_records`` records starting at the committed position.
+        Returns a list of ``(data, position)`` tuples, where ``position`` is
+        what to pass to :meth:`commit` once ``data`` has been delivered.
+        '''
+        ret = []
+        segment, offset = self.position
+        # Appends are atomic under the lock, so anything short we read while
+        # holding it is damage (e.g. a crash mid-write), not a write in progress
+        with self._locked():
+            while len(ret) < max_records:
+                segments = [seg for seg in self.segments() if seg >= segment]
+                if not segments:
+                    break
+                if segments[0] != segment:
+                    # Our segment is gone (delivered or discarded), move on
+                    segment, offset = segments[0], 0
+                records, offset, complete = self._read_segment(segment, offset,
+                                                               max_records - len(ret))
+                ret.extend((data, (segment, end)) for data, end in records)
+                if not complete:
+                    break
+                later = [seg for seg in self.segments() if seg > segment]
+                if not later:
+                    break
+                # Finished this segment, continue with the next one
+                segment, offset = later[0], 0
+                if records:
+                    ret[-1] = (ret[-1][0], (segment, offset))
+        return ret
+
+    def _read_segment(self, segment, offset, max_records):
+        '''
+        Returns ``(records, offset, complete)`` where ``complete`` says whether
+        the end of the segment was reached. Called with the lock held.
+        '''
+        records = []
+        try:
+            fh_ = open(self._path(segment), 'rb')
+        except (IOError, OSError):
+            return records, offset, True
+        with fh_:
+            fh_.seek(offset)
+            while len(records) < max_records:
+                header = fh_.read(HEADER.size)
+                if not header:
+                    return records, offset, True
+                data = b''
+                if len(header) == HEADER.size:
+                    length, crc = HEADER.unpack(header)
+                    data = fh_.read(length)
+                if len(header) < HEADER.size or len(data) < length \
+                        or zlib.crc32(data) & 0xffffffff != crc:
+                    log.error('Corrupt record in returner spool segment {0} at offset '
+                              '{1}, skipping the rest of the segment'.format(segment, offset))
+                    self.counters['discarded_bytes'] += os.path.getsize(self._path(segment)) - offset
+                    self._roll(segment)
+                    return records, offset, True
+                offset += HEADER.size + length
+                records.append((data, offset))
+        return records, offset, False
+
+    def _roll(self, segment):
+        '''
+        Make sure appends no longer go to ``segment``. Called with the lock
+        held.
+        '''
+        if self.segments()[-1] == segment:
+            self._close()
+            path = self._path(segment + 1)
+            open(path, 'ab').close()
+            os.chmod(path, 0o600)
+
+    def commit(self, position):
+        '''
+        Persist the read position and delete fully delivered segments
+        '''
+        segment, offset = position
+        path = os.path.join(self.directory, OFFSET_FILE)
+        with open(path + '.tmp', 'w') as fh_:
+            json.dump({'segment': segment, 'offset': offset}, fh_)
+            fh_.flush()
+            os.fsync(fh_.fileno())
+        os.rename(path + '.tmp', path)
+        self.position = (segment, offset)
+        for old in self.segments():
+            if old >= segment:
+                break
+            try:
+                os.remove(self._path(old))
+            except OSError:
+                pass
+
+    @contextlib.contextmanager
+    def reader(self, blocking=True):
+        '''
+        Hold the (cross-process) reader lock. Yields False if ``blocking`` is
+        False and another process is already reading this spool.
+        '''
+        if fcntl is None:
+            yield True
+            return
+        with open(os.path.join(self.directory, LOCK_FILE + '.reader'), 'a') as lock_fh:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_fh.fileno(), flags)
+            except (IOError, OSError):
+                yield False
+                return
+            try:
+                # Another reader may have moved on since we loaded the offset
+                self.position = self._load_offset()
+                yield True
+            finally:
+                fcntl.flock(lock_fh.fileno(), fcntl.LOCK_UN)
+
+
+class SpoolDrainer(object):
+    '''
+    Delivers spooled records, in order, using ``deliver(data)``.
+
+    ``deliver`` returns True once the record has been delivered and False
+    for a transient failure, in which case the drainer backs off and retries
+    the same record. It raises :class:`SpoolRecordRejected` if the record
+    must be skipped.
+    '''
+
+    def __init__(self, spool, deliver, batch=100, poll_interval=30, max_backoff=300):
+        self.spool = spool
+        self.deliver = deliver
+        self.batch = batch
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.backoff = 0
+        self._stopped = False
+        self._waker = Waker()
+        self._thread = None
+        spool.add_listener(self.notify)
+
+    def notify(self):
+        self._waker.wake()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name='trubble-spool-drainer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped = True
+        self.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _loop(self):
+        with self.spool.reader() as acquired:
+            while not self._stopped:
+                ok = self.drain()
+                self.spool.sync()
+                if not ok:
+                    self.backoff = min(self.max_backoff, max(1, self.backoff * 2))
+                    log.info('Returner spool delivery failed, retrying in {0} seconds '
+                             '({1} bytes pending)'.format(self.backoff,
+                                                          self.spool.pending_bytes()))
+                    self._waker.wait(self.backoff)
+                    continue
+                self.backoff = 0
+                self._waker.wait(self.poll_interval)
+
+    def drain(self, deadline=None):
+        '''
+        Deliver records until the spool is empty, a delivery fails or
+        ``deadline`` (a timestamp) passes. Returns False if a delivery failed.
+        The caller must hold the spool's reader lock.
+        '''
+        while not self._stopped:
+            records = self.spool.read(self.batch)
+            if not records:
+                return True
+            for data, position in records:
+                try:
+                    delivered = self.deliver(data)
+                except SpoolRecordRejected as exc:
+                    log.error('Returner spool record rejected, skipping it: {0}'.format(exc))
+                    self.spool.counters['rejected'] += 1
+                    delivered = True
+                except Exception:
+                    log.exception('Error delivering spooled record')
+                    delivered = False
+                if not delivered:
+                    return False
+                self.spool.commit(position)
+                self.spool.counters['delivered'] += 1
+                if deadline is not None and time.time() > deadline:
+                    return True
+        return True
+
+
+def returner_spool(opts):
+    '''
+    The process-wide spool for returner payloads, or None if
+    ``returner_spool`` is not enabled in the config
+    '''
+    if not opts.get('returner_spool', False):
+        return None
+    directory = os.path.join(opts['cachedir'], 'returner_spool')
+    with _SPOOLS_LOCK:
+        if directory not in _SPOOLS:
+            _SPOOLS[directory] = Spool(
+                directory,
+                segment_bytes=float(opts.get('returner_spool_segment_mb', 4)) * 1024 * 1024,
+                max_bytes=float(opts.get('returner_spool_max_mb', 256)) * 1024 * 1024,
+                fsync_interval=opts.get('returner_spool_fsync_interval', 1.0))
+        return _SPOOLS[directory]
+
+
+def spool_splunk_hec(spool, server_uris, token, body, ssl_verify=True, proxy=None,
+                     timeout=9.05):
+    '''
+    Spool a batch of events for the splunk HTTP event collector
+    '''
+    spool.append(json.dumps({'kind': 'splunk_hec',
+                             'uris': server_uris,
+                             'token': token,
+                             'body': body,
+                             'ssl_verify': ssl_verify,
+                             'proxy': proxy or {},
+                             'timeout': timeout}))
+
+
+def _deliver_splunk_hec(record):
+    import requests
+    headers = {'Authorization': 'Splunk ' + record['token']}
+    for uri in record['uris']:
+        try:
+            r = requests.post(uri, data=record['body'], headers=headers,
+                              verify=record['ssl_verify'], proxies=record['proxy'],
+                              timeout=record['timeout'])
+            r.raise_for_status()
+            return True
+        except requests.exceptions.HTTPError as http_err:
+            status = http_err.response.status_code if http_err.response is not None else None
+            if status is not None and 400 <= status < 500 and status not in (408, 429):
+                raise SpoolRecordRejected('splunk server {0} rejected the batch: {1}'
+                                          .format(uri, http_err))
+            log.info('HTTP Error received while connecting to splunk server {0}: {1}'
+                     .format(uri, http_err))
+        except requests.exceptions.RequestException as exc:
+            log.info('Request to splunk server {0} failed: {1}'.format(uri, exc))
+    return False
+
+
+DELIVERERS = {
+    'splunk_hec': _deliver_splunk_hec,
+}
+
+
+def deliver_record(data):
+    '''
+    Deliver a spooled record, dispatching on its ``kind``
+    '''
+    try:
+        record = json.loads(data.decode('utf-8'))
+        deliver = DELIVERERS[record['kind']]
+    except (ValueError, KeyError, TypeError) as exc:
+        raise SpoolRecordRejected('unreadable record: {0}'.format(exc))
+    return deliver(record)
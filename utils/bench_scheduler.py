@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark of the scheduling of cron jobs.
+
+Compares the cost of computing the last and next run of a cron job with
+:class:`trubblestack.scheduler.CronSchedule` against the previous approach,
+which stepped from 2018-01-01 up to now in intervals of the expression's
+first period. The previous approach is only run for a bounded number of
+steps and extrapolated, as it takes minutes for per-second expressions.
+
+Usage::
+
+    python utils/bench_scheduler.py [iterations]
+'''
+from __future__ import print_function
+
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from croniter import croniter  # noqa: E402
+from trubblestack.scheduler import CronSchedule  # noqa: E402
+
+CRON_BASE = datetime(2018, 1, 1, 0, 0)
+MAX_LEGACY_STEPS = 2000000
+
+EXPRESSIONS = [
+    ('per minute', '* * * * *'),
+    ('every 15 minutes', '*/15 * * * *'),
+    ('twice a day on weekdays', '0 9,17 * * 1-5'),
+    ('per second', '* * * * * *'),
+    ('every 10 seconds', '* * * * * */10'),
+]
+
+
+def legacy_seconds(cron_exp):
+    '''
+    Period the previous approach used for an expression: the interval from
+    2018-01-01 to its first fire time
+    '''
+    next_datetime = croniter(cron_exp, CRON_BASE).get_next(datetime)
+    return int(time.mktime(next_datetime.timetuple())) - int(time.mktime(CRON_BASE.timetuple()))
+
+
+def legacy_last_run(seconds, now):
+    '''
+    Stepping loop of the previous ``getlastrunbycron``. Returns the number
+    of steps it needs and the seconds it took for at most MAX_LEGACY_STEPS.
+    '''
+    epoch_datetime = time.mktime(CRON_BASE.timetuple())
+    steps = int((now - epoch_datetime) // seconds)
+    bounded = min(steps, MAX_LEGACY_STEPS)
+    started = time.time()
+    step = 0
+    while step < bounded and (epoch_datetime + seconds) < now:
+        epoch_datetime = epoch_datetime + seconds
+        step += 1
+    elapsed = time.time() - started
+    return steps, elapsed * steps / bounded if bounded else elapsed
+
+
+def bench(cron_exp, now, iterations):
+    cron = CronSchedule(cron_exp)
+    started = time.time()
+    for _ in range(iterations):
+        cron.last_before(now)
+        cron.next_after(now)
+    return (time.time() - started) / iterations
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    now = time.time()
+    print('{0:<26} {1:>14} {2:>14} {3:>14}'.format('expression', 'legacy steps',
+                                                  'legacy (s)', 'croniter (s)'))
+    for label, cron_exp in EXPRESSIONS:
+        seconds = legacy_seconds(cron_exp)
+        steps, legacy = legacy_last_run(seconds, now)
+        current = bench(cron_exp, now, iterations)
+        print('{0:<26} {1:>14} {2:>14.6f} {3:>14.6f}'.format(label, steps, legacy, current))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+'''
+Simulate the load a fleet puts on the returner endpoint for a scheduled job
+with ``buckets``.
+
+Each simulated host gets a random ``trubble_uuid`` and is placed the same way
+the daemon places it. The tool prints the expected requests per second over
+the job's ``seconds`` window, grouped into rows, and the mean, p99 and peak.
+``--legacy`` places hosts like the previous bucketing did, by the sum of the
+octets of an IPv4 address in ``--subnet``, for comparison.
+
+Usage::
+
+    python utils/simulate_buckets.py --fleet-size 20000 --seconds 3600 --buckets 64
+    python utils/simulate_buckets.py --fleet-size 20000 --seconds 3600 --buckets spread
+    python utils/simulate_buckets.py --fleet-size 20000 --buckets 64 --legacy --subnet 172.17.0.0/29
+'''
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from trubblestack.scheduler import bucket_offset  # noqa: E402
+
+
+def legacy_offset(ip_address, seconds, buckets):
+    '''
+    Placement of the previous bucketing, by the sum of the IPv4 octets
+    '''
+    buckets = int(buckets) if int(buckets) != 0 else 256
+    ips = ip_address.split('.')
+    total = (int(ips[0])*256*256*256)+(int(ips[1])*256*256)+(int(ips[2])*256)+int(ips[3])
+    splay = seconds // buckets
+    random_int = random.randint(0, splay - 1) if splay != 0 else 0
+    return splay * (total % buckets) + random_int
+
+
+def random_ip(subnet):
+    octets = [int(octet) for octet in subnet.split('/')[0].split('.')]
+    prefix = int(subnet.split('/')[1]) if '/' in subnet else 24
+    address = (octets[0] << 24) | (octets[1] << 16) | (octets[2] << 8) | octets[3]
+    host_bits = 32 - prefix
+    address = (address >> host_bits << host_bits) | random.randint(0, (1 << host_bits) - 1)
+    return '.'.join(str((address >> shift) & 255) for shift in (24, 16, 8, 0))
+
+
+def simulate(fleet_size, seconds, buckets, legacy=False, subnet='10.0.0.0/16'):
+    '''
+    Number of requests starting in each second of the window
+    '''
+    per_second = [0] * seconds
+    for _ in range(fleet_size):
+        if legacy:
+            offset = legacy_offset(random_ip(subnet), seconds, buckets)
+        else:
+            offset = bucket_offset(str(uuid.uuid4()), seconds, buckets, fleet_size)
+        per_second[int(offset) % seconds] += 1
+    return per_second
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--fleet-size', type=int, default=10000)
+    parser.add_argument('--seconds', type=int, default=3600)
+    parser.add_argument('--buckets', default='spread',
+                        help='number of buckets, or spread')
+    parser.add_argument('--legacy', action='store_true',
+                        help='place hosts by the sum of their IPv4 octets')
+    parser.add_argument('--subnet', default='10.0.0.0/16',
+                        help='subnet of the simulated hosts, with --legacy')
+    parser.add_argument('--rows', type=int, default=30,
+                        help='number of rows of the curve')
+    parser.add_argument('--width', type=int, default=50,
+                        help='width of the bars of the curve')
+    args = parser.parse_args()
+
+    per_second = simulate(args.fleet_size, args.seconds, args.buckets,
+                          legacy=args.legacy, subnet=args.subnet)
+    ordered = sorted(per_second)
+    mean = float(args.fleet_size) / args.seconds
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    peak = ordered[-1]
+    print('fleet_size={0} seconds={1} buckets={2}{3}'.format(
+        args.fleet_size, args.seconds, args.buckets, ' (legacy)' if args.legacy else ''))
+    print('requests/s: mean {0:.2f}  p99 {1}  peak {2}'.format(mean, p99, peak))
+    print('')
+    print('{0:>15} {1:>8} {2:>6}'.format('window (s)', 'mean/s', 'max/s'))
+    rows = max(1, min(args.rows, args.seconds))
+    for row in range(rows):
+        start = row * args.seconds // rows
+        end = (row + 1) * args.seconds // rows
+        chunk = per_second[start:end]
+        row_mean = float(sum(chunk)) / len(chunk)
+        bar = '#' * int(round(args.width * max(chunk) / float(peak))) if peak else ''
+        print('{0:>7}-{1:<7} {2:>8.2f} {3:>6} {4}'.format(start, end, row_mean, max(chunk), bar))
+
+
+if __name__ == '__main__':
+    main()